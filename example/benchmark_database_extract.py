@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012-2014 Romain Dorgueil
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compares OFFSET/LIMIT and keyset pagination in DatabaseExtract, on a local SQLite table.
+
+Usage: python example/benchmark_database_extract.py [rows] [pack_size]
+
+"""
+
+import os
+import sys
+import tempfile
+from sqlalchemy import create_engine
+from rdc.etl.extra.db.extract import DatabaseExtract
+from rdc.etl.util import Timer
+
+rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+pack_size = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+fd, path = tempfile.mkstemp(suffix='.db')
+os.close(fd)
+engine = create_engine('sqlite:///' + path)
+
+try:
+    print('Creating a {0} rows table in {1} ...'.format(rows, path))
+    engine.execute('CREATE TABLE item (id INTEGER PRIMARY KEY, name TEXT, value REAL)')
+    with engine.begin() as connection:
+        connection.execute('INSERT INTO item VALUES (?, ?, ?)', [
+            (i, 'item {0}'.format(i), i * 0.5) for i in xrange(rows)
+        ])
+
+    for name, key in (('keyset', ('id', )), ('offset', None), ):
+        extract = DatabaseExtract(engine, 'SELECT id, name, value FROM item', key=key, pack_size=pack_size)
+        timer = Timer()
+        with timer:
+            count = sum(1 for row in extract.extract())
+        print('{0:>8}: {1} rows in {2} ({3:.0f} rows/s)'.format(name, count, timer, count / timer.duration))
+finally:
+    os.unlink(path)
@@ -15,7 +15,7 @@
 # limitations under the License.
 
 from .sql import SqlExec
-from .extract import DatabaseExtract
+from .extract import DatabaseExtract, PartitionedDatabaseExtract
 from .join import DatabaseJoin
-from .load import DatabaseLoad
+from .load import DatabaseLoad, DatabaseStagingLoad
 from .misc import DatabaseCreateTable
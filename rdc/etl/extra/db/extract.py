@@ -14,9 +14,59 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import threading
+from Queue import Queue, Full
+from rdc.etl.extra.db.util import get_placeholder
 from rdc.etl.transform.extract import Extract
 
 
+def _put(queue, item, stopped):
+    """Puts an item in a bounded queue, without blocking forever so that the producer thread can stop when the
+    consumer is gone. Returns False if stopped."""
+    while not stopped.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def prefetch(iterable, depth):
+    """Iterates on `iterable` in a background thread, keeping at most `depth` items ready in advance. Exceptions are
+    raised again in the consumer thread."""
+    queue, stopped, done = Queue(depth), threading.Event(), object()
+
+    def produce():
+        try:
+            for item in iterable:
+                if not _put(queue, item, stopped):
+                    return
+        except Exception as e:
+            _put(queue, e, stopped)
+        else:
+            _put(queue, done, stopped)
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+
+    try:
+        while True:
+            item = queue.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stopped.set()
+        producer.join()
+
+
 class DatabaseExtract(Extract):
     """
     Extract data from a database using some raw SQL and yield one output line per query result.
@@ -33,12 +83,34 @@ class DatabaseExtract(Extract):
 
         The number of records to retrieve at a time (will be used to add OFFSET/LIMIT clauses to SQL).
 
+    .. attribute:: key
+
+        Optional tuple of result columns forming a unique key, to use keyset pagination instead of OFFSET/LIMIT. The
+        query is wrapped in a sub-query, and each page only selects rows with a key greater than the last one seen
+        (ordered by key), so the database can seek directly to the page start using an index instead of scanning and
+        skipping all previous rows. Composite keys are supported.
+
+    .. attribute:: stream
+
+        If true, the query is executed once, without pagination, using a streaming (server side) cursor when the
+        database driver supports it, and rows are fetched by chunks of :attr:`pack_size`. Memory use is bounded, and
+        the rows come from one consistent snapshot. The connection is kept open until the extraction is complete.
+
+    .. attribute:: prefetch
+
+        If set, pages (or chunks, in stream mode) are fetched by a background thread, which keeps at most this number
+        of pages ready in advance, so the database works on the next pages while the current one is processed
+        downstream. Memory use is bounded by (prefetch + 1) * :attr:`pack_size` rows.
+
     """
 
     query = 'SELECT 1'
     pack_size = 1000
+    key = None
+    stream = False
+    prefetch = 0
 
-    def __init__(self, engine, query=None, limit=None):
+    def __init__(self, engine, query=None, limit=None, key=None, pack_size=None, stream=None, prefetch=None):
         super(DatabaseExtract, self).__init__()
 
         self.engine = engine
@@ -47,11 +119,36 @@ class DatabaseExtract(Extract):
         except AttributeError as e:
             pass
         self.limit = limit
+        self.key = key or self.key
+        self.pack_size = pack_size or self.pack_size
+        self.stream = stream if stream is not None else self.stream
+        self.prefetch = prefetch or self.prefetch
 
-    def extract(self):
+    def get_query(self):
         query = self.query.strip()
         if query[-1] == ';':
             query = query[0:-1]
+        return query
+
+    def extract(self):
+        pages = self.get_pages()
+        if self.prefetch:
+            pages = prefetch(pages, self.prefetch)
+
+        for rows in pages:
+            for row in rows:
+                yield row
+
+    def get_pages(self):
+        """Generator of result pages (lists of rows), using the configured pagination mode."""
+        if self.stream:
+            return self.get_stream_pages()
+        if self.key:
+            return self.get_keyset_pages()
+        return self.get_offset_pages()
+
+    def get_offset_pages(self):
+        query = self.get_query()
 
         offset = 0
         while not self.limit or offset * self.pack_size < self.limit:
@@ -60,8 +157,228 @@ class DatabaseExtract(Extract):
             if not len(results):
                 break
 
-            for row in results:
-                yield row
+            yield results
 
             offset += 1
 
+    def get_keyset_pages(self):
+        page = 0
+        last = None
+        while not self.limit or page * self.pack_size < self.limit:
+            query, params = self.get_keyset_query(last)
+            results = self.engine.execute(query, params).fetchall()
+            if not len(results):
+                break
+
+            yield results
+
+            last = tuple(results[-1][column] for column in self.key)
+            page += 1
+
+    def get_stream_pages(self):
+        connection = self.engine.connect().execution_options(stream_results=True)
+        try:
+            results = connection.execute(self.get_query())
+            try:
+                page = 0
+                while not self.limit or page * self.pack_size < self.limit:
+                    rows = results.fetchmany(self.pack_size)
+                    if not len(rows):
+                        break
+
+                    yield rows
+
+                    page += 1
+            finally:
+                results.close()
+        finally:
+            connection.close()
+
+    def get_keyset_query(self, last=None):
+        """Builds the query for the page following the `last` key values (first page if None), and its parameters.
+        The "greater than" condition on a composite key is expanded (a > ? OR (a = ? AND b > ?) ...), as row value
+        comparisons are not supported by every database."""
+        where, params = '', ()
+        if last is not None:
+            placeholder = get_placeholder(self.engine)
+            criteria = []
+            for i, column in enumerate(self.key):
+                criteria.append('(' + ' AND '.join(
+                    ['{0} = {1}'.format(previous, placeholder) for previous in self.key[:i]] +
+                    ['{0} > {1}'.format(column, placeholder)]
+                ) + ')')
+                params += tuple(last[:i + 1])
+            where = ' WHERE ' + ' OR '.join(criteria)
+
+        return (
+            'SELECT * FROM (' + self.get_query() + ') _keyset' + where +
+            ' ORDER BY ' + ', '.join(self.key) + ' LIMIT ' + str(self.pack_size) + ';',
+            params,
+        )
+
+
+class PartitionedDatabaseExtract(DatabaseExtract):
+    """
+    Extract data using N concurrent queries, each one on its own connection and reading one range of values of a
+    numeric or date column, to use more than one database core (and more than one disk) for big extractions. Each
+    partition is streamed by chunks of :attr:`pack_size` rows, and at most a few chunks per partition are waiting to
+    be consumed, so memory use stays bounded.
+
+    .. attribute:: partition_key
+
+        Column on which to partition data. Should be indexed (or be the partitioning key of the table).
+
+    .. attribute:: partitions
+
+        Number of partitions, computed by splitting evenly the range between the MIN and MAX values of
+        :attr:`partition_key` in the query results.
+
+    .. attribute:: boundaries
+
+        Explicit sorted sequence of boundaries, instead of MIN/MAX ranges. Partition 0 contains rows with keys lower
+        than the first boundary, partition 1 rows with keys between the first (included) and the second (excluded)
+        boundaries, etc. Rows with a NULL key always go to partition 0.
+
+    .. attribute:: ordered
+
+        If true, each partition is sorted by :attr:`partition_key`, and partitions are yielded one after the other, so
+        the output is sorted by key. Next partitions are still read in the background, until their buffer is full.
+        Otherwise (default), rows are yielded as soon as any partition gets them.
+
+    Number of rows extracted by partition (part1, part2, ...) and number of complete partitions are available in the
+    transform statistics.
+
+    """
+
+    partition_key = None
+    partitions = 4
+    boundaries = None
+    ordered = False
+
+    # Number of chunks each partition can read in advance.
+    buffer_size = 4
+
+    def __init__(self, engine, query=None, partition_key=None, partitions=None, boundaries=None, ordered=None,
+                 limit=None, pack_size=None):
+        super(PartitionedDatabaseExtract, self).__init__(engine, query, limit=limit, pack_size=pack_size)
+
+        self.partition_key = partition_key or self.partition_key
+        self.boundaries = boundaries or self.boundaries
+        self.partitions = len(self.boundaries) + 1 if self.boundaries is not None else partitions or self.partitions
+        self.ordered = ordered if ordered is not None else self.ordered
+
+        if not self.partition_key:
+            raise ValueError('PartitionedDatabaseExtract needs a partition key.')
+
+        self._partition_rows = [0] * self.partitions
+        self._partitions_done = 0
+
+    def get_boundaries(self):
+        """Explicit boundaries, or N-1 values splitting evenly the [MIN, MAX] range of the partition key."""
+        if self.boundaries is not None:
+            return list(self.boundaries)
+
+        low, high = self.engine.execute('SELECT MIN({key}), MAX({key}) FROM ({query}) _partition'.format(
+            key=self.partition_key, query=self.get_query(),
+        )).fetchone()
+        if low is None:
+            return []
+
+        boundaries = []
+        for i in xrange(1, self.partitions):
+            # Works with numbers, and with dates (date - date being a timedelta).
+            boundary = low + (high - low) * i / self.partitions
+            if boundary > low and (not len(boundaries) or boundary > boundaries[-1]):
+                boundaries.append(boundary)
+        return boundaries
+
+    def get_partition_queries(self, boundaries):
+        """One (query, params) tuple per partition."""
+        placeholder = get_placeholder(self.engine)
+        query = 'SELECT * FROM (' + self.get_query() + ') _partition WHERE '
+        order_by = ' ORDER BY ' + self.partition_key if self.ordered else ''
+
+        queries = []
+        for i in xrange(len(boundaries) + 1):
+            criteria, params = [], ()
+            if i > 0:
+                criteria.append('{0} >= {1}'.format(self.partition_key, placeholder))
+                params += (boundaries[i - 1], )
+            if i < len(boundaries):
+                criteria.append('{0} < {1}'.format(self.partition_key, placeholder))
+                params += (boundaries[i], )
+            where = ' AND '.join(criteria) or '1 = 1'
+            if i == 0:
+                where = '(' + where + ' OR ' + self.partition_key + ' IS NULL)'
+            queries.append((query + where + order_by, params, ))
+        return queries
+
+    def extract(self):
+        queries = self.get_partition_queries(self.get_boundaries())
+        self._partition_rows = [0] * len(queries)
+        self._partitions_done = 0
+
+        stopped = threading.Event()
+        if self.ordered:
+            queues = [Queue(self.buffer_size) for query in queries]
+        else:
+            queues = [Queue(self.buffer_size * len(queries))] * len(queries)
+
+        workers = [
+            threading.Thread(target=self._read_partition, args=(i, query, params, queues[i], stopped, ))
+            for i, (query, params) in enumerate(queries)
+        ]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        try:
+            count = 0
+            for queue in (queues if self.ordered else queues[:1]):
+                while self._partitions_done < len(queries):
+                    partition, rows = queue.get()
+                    if isinstance(rows, Exception):
+                        raise rows
+                    if rows is None:
+                        self._partitions_done += 1
+                        if self.ordered:
+                            break
+                        continue
+
+                    self._partition_rows[partition] += len(rows)
+                    for row in rows:
+                        if self.limit and count >= self.limit:
+                            return
+                        count += 1
+                        yield row
+        finally:
+            stopped.set()
+            for worker in workers:
+                worker.join()
+
+    def get_local_stats(self, debug=False, profile=False):
+        return tuple(
+            ('part%d' % (i + 1, ), rows, ) for i, rows in enumerate(self._partition_rows)
+        ) + (
+            ('done', '%d/%d' % (self._partitions_done, len(self._partition_rows), ), ),
+        ) + tuple(super(PartitionedDatabaseExtract, self).get_local_stats(debug=debug, profile=profile))
+
+    def _read_partition(self, partition, query, params, queue, stopped):
+        try:
+            connection = self.engine.connect().execution_options(stream_results=True)
+            try:
+                results = connection.execute(query, params)
+                while not stopped.is_set():
+                    rows = results.fetchmany(self.pack_size)
+                    if not len(rows):
+                        break
+                    if not _put(queue, (partition, rows, ), stopped):
+                        return
+                results.close()
+            finally:
+                connection.close()
+        except Exception as e:
+            _put(queue, (partition, e, ), stopped)
+            return
+
+        _put(queue, (partition, None, ), stopped)
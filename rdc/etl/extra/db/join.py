@@ -14,12 +14,83 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
+import cPickle
 import itertools
+import os
+import sqlite3
+import tempfile
 
+from repoze.lru import LRUCache
 from rdc.etl.error import AbstractError
-from rdc.etl.io import STDIN
+from rdc.etl.extra.db.util import get_key_criteria, get_placeholder
+from rdc.etl.hash import Hash
+from rdc.etl.io import STDIN, STDERR
 from rdc.etl.transform.join import Join
+from rdc.etl.util import Timer, fingerprint
+
+_marker = object()
+
+
+class _MemoryIndex(object):
+    """Lookup index of row values by key tuple, in a dict."""
+
+    def __init__(self):
+        self._data = defaultdict(list)
+        self.rows = 0
+
+    def add(self, key, values):
+        self._data[key].append(values)
+        self.rows += 1
+
+    def get(self, key):
+        return self._data.get(key, ())
+
+    def close(self):
+        self._data = None
+
+    def __len__(self):
+        return len(self._data)
+
+
+class _DiskIndex(object):
+    """Lookup index of row values by key tuple, in a temporary local sqlite database, for tables that do not fit in
+    memory. Rows are indexed on the key fingerprint, and the key itself is checked on lookup."""
+
+    def __init__(self):
+        fd, self._path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        self._db = sqlite3.connect(self._path, check_same_thread=False)
+        self._db.execute('CREATE TABLE idx (fp INTEGER, k BLOB, v BLOB)')
+        self._pending = []
+        self.rows = 0
+
+    def add(self, key, values):
+        self._pending.append((fingerprint(key), sqlite3.Binary(cPickle.dumps(key, 2)),
+                              sqlite3.Binary(cPickle.dumps(values, 2)), ))
+        self.rows += 1
+        if len(self._pending) >= 10000:
+            self.flush()
+
+    def flush(self):
+        self._db.executemany('INSERT INTO idx VALUES (?, ?, ?)', self._pending)
+        self._pending = []
+
+    def build(self):
+        self.flush()
+        self._db.execute('CREATE INDEX idx_fp ON idx (fp)')
+        self._db.commit()
+
+    def get(self, key):
+        rows = self._db.execute('SELECT k, v FROM idx WHERE fp = ?', (fingerprint(key), ))
+        return [cPickle.loads(str(v)) for k, v in rows if cPickle.loads(str(k)) == key]
+
+    def close(self):
+        self._db.close()
+        os.unlink(self._path)
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(DISTINCT fp) FROM idx').fetchone()[0]
 
 
 class DatabaseJoin(Join):
@@ -39,39 +110,188 @@ class DatabaseJoin(Join):
         this tuple can be ('id', ), meaning that for each input line, the "id" field value will be used to execute
         the statement. Each sql statement output row will be joined with the input row.
 
+    As each join is a database round trip, consider using the join cache (see :class:`rdc.etl.transform.join.Join`),
+    usually with cache_key=dataset_keys_for_values, or the batch mode.
+
+    .. attribute:: batch_size
+
+        If set, input rows are buffered and joined by batches of this size, using :attr:`batch_query`. Keys are
+        deduplicated within a batch, and fetched using IN (...) criteria (or OR'ed equalities for composite keys), with
+        at most :attr:`in_list_size` keys per query. Rows are yielded in input order, with the same inner/outer join
+        semantics as the row by row mode. Join cache is not used in batch mode.
+
+    .. attribute:: batch_query
+
+        SQL query template used in batch mode, containing a "{criteria}" placeholder, for example
+        "SELECT id, name FROM user WHERE {criteria}".
+
+    .. attribute:: key_columns
+
+        Column names, matching dataset_keys_for_values (same order), used in batch criteria and to dispatch result
+        rows to their input rows. They must be selected under their own name. Defaults to dataset_keys_for_values.
+
+        In batch and preload modes, result rows are matched with input rows by Python equality, not by the database
+        type coercion, so input key values must have the same types as the ones read from the database (for example,
+        convert CSV strings to integers before joining on an integer column). Otherwise rows are not joined, and are
+        dropped by inner joins.
+
+    .. attribute:: in_list_size
+
+        Maximum number of keys in one batch query.
+
+    .. attribute:: preload_query
+
+        If set, this query is executed once at initialization (typically a full or filtered SELECT on a dimension
+        table), its result is indexed on :attr:`key_columns`, and all joins are served from this index without any
+        further database query. Load time and number of indexed keys are available in statistics.
+
+    .. attribute:: preload_on_disk
+
+        Keep the preloaded index in a temporary local sqlite file instead of memory, for tables too big for RAM.
+
     """
 
     query = None
     dataset_keys_for_values = []
-
-    def __init__(self, engine, query=None, dataset_keys_for_values=None, is_outer=False, default_outer_join_data=None):
-        super(DatabaseJoin, self).__init__(is_outer=is_outer, default_outer_join_data=default_outer_join_data)
+    batch_size = None
+    batch_query = None
+    key_columns = None
+    in_list_size = 1000
+    preload_query = None
+    preload_on_disk = False
+
+    def __init__(self, engine, query=None, dataset_keys_for_values=None, is_outer=False, default_outer_join_data=None,
+                 cache_key=None, cache_size=None, cache_ttl=None, cache_negative=None, batch_size=None,
+                 batch_query=None, key_columns=None, in_list_size=None, preload_query=None, preload_on_disk=None):
+        super(DatabaseJoin, self).__init__(is_outer=is_outer, default_outer_join_data=default_outer_join_data,
+                                           cache_key=cache_key, cache_size=cache_size, cache_ttl=cache_ttl,
+                                           cache_negative=cache_negative)
 
         # parameters
         self.engine = engine
         self.query = query or self.query
         self.dataset_keys_for_values = dataset_keys_for_values or self.dataset_keys_for_values
+        self.batch_size = batch_size or self.batch_size
+        self.batch_query = batch_query or self.batch_query
+        self.key_columns = key_columns or self.key_columns or self.dataset_keys_for_values
+        self.in_list_size = in_list_size or self.in_list_size
+        self.preload_query = preload_query or self.preload_query
+        self.preload_on_disk = preload_on_disk or self.preload_on_disk
 
         # database connection
         self._connection = None
 
+        # batch mode buffer
+        self._batch = []
+
+        # preload mode index
+        self._index = None
+        self._index_columns = None
+        self._preload_stats = None
+
+    def initialize(self):
+        super(DatabaseJoin, self).initialize()
+
+        if self.preload_query:
+            self.preload()
+
+    def preload(self):
+        """Loads and indexes the result of :attr:`preload_query`."""
+        index = _DiskIndex() if self.preload_on_disk else _MemoryIndex()
+
+        timer = Timer()
+        with timer:
+            result = self.connection.execute(self.preload_query)
+            self._index_columns = result.keys()
+            while True:
+                rows = result.fetchmany(10000)
+                if not rows:
+                    break
+                for row in rows:
+                    index.add(tuple(row[column] for column in self.key_columns), tuple(row))
+            if self.preload_on_disk:
+                index.build()
+
+        self._index = index
+        self._preload_stats = (
+            ('preload', '%.2fs' % (timer.duration, ), ),
+            ('keys', len(index), ),
+            ('rows', index.rows, ),
+        )
+
     def join(self, hash, channel=STDIN):
-        """Get data to join with from database."""
+        """Get data to join with from database (or from the preloaded index)."""
+        if self._index is not None:
+            return [
+                Hash(zip(self._index_columns, values))
+                for values in self._index.get(tuple(hash[key] for key in self.dataset_keys_for_values))
+            ]
+
         return self.connection.execute(self.query, [
             hash[key] for key in self.dataset_keys_for_values
         ])
 
+    def join_batch(self, keys):
+        """Get data to join with from database for a list of distinct key tuples, as a dict of result row lists
+        indexed by key tuple."""
+        results = defaultdict(list)
+        for i in xrange(0, len(keys), self.in_list_size):
+            query, values = self.get_batch_query(keys[i:i + self.in_list_size])
+            for row in self.connection.execute(query, values):
+                results[tuple(row[column] for column in self.key_columns)].append(row)
+        return results
+
+    def get_batch_query(self, keys):
+        """SQL and parameter values for a batch of distinct key tuples."""
+        criteria = get_key_criteria(self.engine, self.key_columns, len(keys))
+        return self.batch_query.format(criteria=criteria), list(itertools.chain(*keys))
+
+    def transform(self, hash, channel=STDIN):
+        if not self.batch_size or self._index is not None:
+            for row in super(DatabaseJoin, self).transform(hash, channel):
+                yield row
+            return
+
+        self._batch.append(hash)
+        if len(self._batch) >= self.batch_size:
+            for row in self.flush():
+                yield row
+
+    def flush(self):
+        """Joins all buffered rows (batch mode)."""
+        batch, self._batch = self._batch, []
+        if not len(batch):
+            return
+
+        keys = [tuple(hash[key] for key in self.dataset_keys_for_values) for hash in batch]
+        results = self.join_batch(list(OrderedDict.fromkeys(keys)))
+
+        for hash, key in zip(batch, keys):
+            for row in self.product(hash, results.get(key)):
+                yield row
+
     def finalize(self):
         """
         Finalize the transformation.
 
-        DBAPI connection should be cleaned up.
+        Remaining buffered rows are joined, then DBAPI connection should be cleaned up.
 
         """
         super(DatabaseJoin, self).finalize()
 
+        for row in self.flush():
+            yield row
+
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+
         self._close_connection()
 
+    def get_local_stats(self, debug=False, profile=False):
+        return (self._preload_stats or ()) + tuple(super(DatabaseJoin, self).get_local_stats(debug=debug,
+                                                                                             profile=profile))
+
     @property
     def connection(self):
         """
@@ -106,19 +326,78 @@ class DatabaseJoinOrCreate(Join):
 
     Values are cached, so you cannot yield different modifications from the same object. For more informations, RTFS.
 
+    .. attribute:: result_cache_size
+
+        If set, at most this number of outputs are cached, least recently used ones being evicted first. Otherwise,
+        the cache is unbounded and grows with the number of distinct identities.
+
+    .. attribute:: prewarm
+
+        If true, the cache is filled at initialization with the output of each row of the related table (or of
+        :attr:`prewarm_query` results), using one query, so that only identities created after that need a database
+        round trip. Needs :attr:`identity_fields`. If the cache is bounded, only the last rows are kept.
+
+    .. attribute:: prewarm_query
+
+        SQL query used to pre-warm the cache, defaults to "SELECT * FROM <table_name>".
+
+    .. attribute:: identity_fields
+
+        Columns of the related table that identity dictionaries are made of. Values read from the database must be
+        equal to the ones computed from input rows.
+
+    .. attribute:: batch_size
+
+        If set, input rows are buffered, and unknown identities of each batch are resolved at once: one query to find
+        the existing objects (at most :attr:`in_list_size` parameters each), one multi-row insert for the missing ones,
+        and one more query to read them back. Rows are yielded in input order. Identities (and params) of a batch
+        should have the same fields, or they will be resolved in as many groups. If a set-based query fails, the
+        batch identities are resolved one by one, and rows of the ones that still fail are sent to STDERR.
+
+    Cache hits, misses and evictions (if bounded) are available in the transform statistics.
+
     """
 
     table_name = None
-
-    def __init__(self, engine, table_name = None, identity = None, params = None, output = None):
+    result_cache_size = None
+    prewarm = False
+    prewarm_query = None
+    identity_fields = None
+    batch_size = None
+    in_list_size = 500
+
+    def __init__(self, engine, table_name = None, identity = None, params = None, output = None,
+                 result_cache_size=None, prewarm=None, prewarm_query=None, identity_fields=None, batch_size=None,
+                 in_list_size=None):
         super(DatabaseJoinOrCreate, self).__init__()
         self.engine = engine
         self.table_name = table_name or self.table_name
         self.identity = callable(identity) and identity or self.identity
         self.params = callable(params) and params or self.params
         self.output = callable(output) and output or self.output
+        self.result_cache_size = result_cache_size or self.result_cache_size
+        self.prewarm = prewarm if prewarm is not None else self.prewarm
+        self.prewarm_query = prewarm_query or self.prewarm_query
+        self.identity_fields = identity_fields or self.identity_fields
+        self.batch_size = batch_size or self.batch_size
+        self.in_list_size = in_list_size or self.in_list_size
+
+        if self.prewarm and not self.identity_fields:
+            raise ValueError('DatabaseJoinOrCreate needs identity fields to pre-warm its cache.')
+
+        self._result_cache = LRUCache(self.result_cache_size) if self.result_cache_size else {}
+        self._hits = 0
+        self._misses = 0
+        self._prewarmed = None
+
+        # batch mode buffer
+        self._batch = []
 
-        self._result_cache = {}
+    def initialize(self):
+        super(DatabaseJoinOrCreate, self).initialize()
+
+        if self.prewarm:
+            self.prewarm_cache()
 
     def identity(self, hash):
         raise AbstractError(self.identity)
@@ -133,6 +412,36 @@ class DatabaseJoinOrCreate(Join):
     def get_cache_key(cls, identity):
         return hash(tuple(sorted(identity.items())))
 
+    def get_cached(self, key):
+        """Cached output for a cache key, or _marker if unknown."""
+        result = self._result_cache.get(key, _marker)
+        if result is _marker:
+            self._misses += 1
+        else:
+            self._hits += 1
+        return result
+
+    def set_cached(self, key, result):
+        if self.result_cache_size:
+            self._result_cache.put(key, result)
+        else:
+            self._result_cache[key] = result
+
+    def prewarm_cache(self):
+        """Caches the output of each row of the related table (or of :attr:`prewarm_query` results)."""
+        self._prewarmed = 0
+        result = self.engine.execute(self.prewarm_query or 'SELECT * FROM {table_name}'.format(
+            table_name=self.table_name,
+        ))
+        while True:
+            rows = result.fetchmany(10000)
+            if not rows:
+                break
+            for row in rows:
+                identity = OrderedDict((field, row[field], ) for field in self.identity_fields)
+                self.set_cached(self.get_cache_key(identity), self.output(row))
+                self._prewarmed += 1
+
     def get_find_sql(self, identity):
         """Get SQL for object retrieval.
 
@@ -146,11 +455,21 @@ class DatabaseJoinOrCreate(Join):
             LIMIT 1
         '''.strip().format(
             table_name = self.table_name,
-            where = ' AND '.join(('t.{field} = %s'.format(field=field) for field, value in identity.items()))
+            where = ' AND '.join(('t.{field} = {placeholder}'.format(
+                field=field, placeholder=get_placeholder(self.engine)
+            ) for field, value in identity.items()))
+        )
+
+    def get_find_many_sql(self, fields, count):
+        """Get SQL for retrieval of `count` objects with identities on given fields (flattened identity values are the
+        parameters)."""
+        return '''SELECT * FROM {table_name} WHERE {criteria}'''.format(
+            table_name=self.table_name,
+            criteria=get_key_criteria(self.engine, fields, count),
         )
 
-    def get_create_sql(self, params):
-        """Get SQL for object creation.
+    def get_create_sql(self, params, count=1):
+        """Get SQL for object creation (of `count` objects at once, using a multi-row insert, if more than one).
 
         :param identity:
         :param params:
@@ -158,11 +477,11 @@ class DatabaseJoinOrCreate(Join):
         """
         return '''
             INSERT INTO {table_name}
-            ({fields}) VALUES ({values})
+            ({fields}) VALUES {values}
         '''.strip().format(
             table_name = self.table_name,
             fields = ', '.join((field for field in params.keys())),
-            values = ', '.join(['%s'] * len(params)),
+            values = ', '.join(['(' + ', '.join([get_placeholder(self.engine)] * len(params)) + ')'] * count),
             )
 
     def find(self, identity):
@@ -176,6 +495,23 @@ class DatabaseJoinOrCreate(Join):
             *identity.values()
         ).fetchone()
 
+    def find_many(self, identities):
+        """Find objects based on a list of identities, and return them in a dict indexed by cache key.
+
+        :param identities:
+        :return:
+        """
+        mapped = {}
+        for fields, group in self._group_by_fields(identities):
+            for chunk in self._chunks(group, len(fields)):
+                rows = self.engine.execute(
+                    self.get_find_many_sql(fields, len(chunk)),
+                    list(itertools.chain(*[[identity[field] for field in fields] for identity in chunk]))
+                )
+                for row in rows:
+                    mapped.setdefault(self.get_cache_key(dict((field, row[field], ) for field in fields)), row)
+        return mapped
+
     def create(self, identity, params):
         """Create an object based on identity and params.
 
@@ -190,6 +526,26 @@ class DatabaseJoinOrCreate(Join):
         )
         return self.find(identity)
 
+    def create_many(self, identities, params):
+        """Create objects based on lists of identities and params, using multi-row inserts, and return them in a dict
+        indexed by cache key.
+
+        :param identities:
+        :param params:
+        :return:
+        """
+        params = [
+            OrderedDict(itertools.chain(_params.iteritems(), identity.iteritems()))
+            for identity, _params in zip(identities, params)
+        ]
+        for fields, group in self._group_by_fields(params):
+            for chunk in self._chunks(group, len(fields)):
+                self.engine.execute(
+                    self.get_create_sql(chunk[0], len(chunk)),
+                    list(itertools.chain(*[[_params[field] for field in fields] for _params in chunk]))
+                )
+        return self.find_many(identities)
+
     def join(self, hash, channel=STDIN):
         if channel != STDIN:
             raise ValueError('Unsupported channel')
@@ -199,18 +555,131 @@ class DatabaseJoinOrCreate(Join):
 
         _key = self.get_cache_key(identity)
 
-        if not _key in self._result_cache:
+        result = self.get_cached(_key)
+        if result is _marker:
             try:
-                mapped = self.find(identity)
-                if not mapped:
-                    mapped = self.create(identity, self.params(hash))
-                if not mapped:
-                    raise RuntimeError('Could not find or create associated object, aborting.')
-                self._result_cache[_key] = self.output(mapped)
+                result = self.resolve(identity, hash)
             except:
-                self._result_cache[_key] = False
+                self.set_cached(_key, False)
                 raise
 
-        if self._result_cache[_key]:
-            yield hash.copy(self._result_cache[_key])
+        if result:
+            yield hash.copy(result)
+
+    def transform(self, hash, channel=STDIN):
+        if not self.batch_size:
+            for row in super(DatabaseJoinOrCreate, self).transform(hash, channel):
+                yield row
+            return
 
+        if channel != STDIN:
+            raise ValueError('Unsupported channel')
+
+        self._batch.append(hash)
+        if len(self._batch) >= self.batch_size:
+            for row in self.flush():
+                yield row
+
+    def flush(self):
+        """Joins all buffered rows (batch mode)."""
+        batch, self._batch = self._batch, []
+        if not len(batch):
+            return
+
+        keys, results, unknown = [], {}, OrderedDict()
+        for hash in batch:
+            identity = self.identity(hash)
+            assert len(identity), 'Identity should not be empty.'
+            _key = self.get_cache_key(identity)
+            keys.append(_key)
+            if not _key in results and not _key in unknown:
+                result = self.get_cached(_key)
+                if result is _marker:
+                    unknown[_key] = identity, hash
+                else:
+                    results[_key] = result
+
+        errors = {}
+        if len(unknown):
+            try:
+                # Kept aside, as the cache may be too small for the whole batch.
+                results.update(self.resolve_many(unknown))
+            except Exception:
+                # Resolve identities one by one, so that only rows of the failing ones are sent to STDERR.
+                for _key, (identity, hash) in unknown.iteritems():
+                    try:
+                        results[_key] = self.resolve(identity, hash)
+                    except Exception as e:
+                        errors[_key] = e
+
+        for hash, _key in zip(batch, keys):
+            if _key in errors:
+                yield Hash((
+                    ('_input', hash, ),
+                    ('_transform', self, ),
+                    ('_error', errors[_key], ),
+                )), STDERR
+            elif results[_key]:
+                yield hash.copy(results[_key])
+
+    def resolve(self, identity, hash):
+        """Finds or creates the object for one identity, and returns (and caches) its output."""
+        mapped = self.find(identity)
+        if not mapped:
+            mapped = self.create(identity, self.params(hash))
+        if not mapped:
+            raise RuntimeError('Could not find or create associated object, aborting.')
+        result = self.output(mapped)
+        self.set_cached(self.get_cache_key(identity), result)
+        return result
+
+    def resolve_many(self, unknown):
+        """Finds or creates the objects for an ordered dict of cache key => (identity, hash) tuples, using set-based
+        queries, and returns (and caches) their outputs in a dict indexed by cache key. Raises if any of them fails,
+        and nothing is cached in this case."""
+        mapped = self.find_many([identity for identity, hash in unknown.itervalues()])
+        missing = [_key for _key in unknown if not _key in mapped]
+        if len(missing):
+            mapped.update(self.create_many(
+                [unknown[_key][0] for _key in missing],
+                [self.params(unknown[_key][1]) for _key in missing],
+            ))
+
+        results = {}
+        for _key in unknown:
+            if not _key in mapped:
+                raise RuntimeError('Could not find or create associated object, aborting.')
+            results[_key] = self.output(mapped[_key])
+
+        for _key, result in results.iteritems():
+            self.set_cached(_key, result)
+        return results
+
+    def finalize(self):
+        super(DatabaseJoinOrCreate, self).finalize()
+
+        for row in self.flush():
+            yield row
+
+    def get_local_stats(self, debug=False, profile=False):
+        stats = (
+            ('hits', self._hits, ),
+            ('misses', self._misses, ),
+        )
+        if self.result_cache_size:
+            stats += (('evictions', self._result_cache.evictions, ), )
+        if self._prewarmed is not None:
+            stats += (('prewarmed', self._prewarmed, ), )
+        return stats + tuple(super(DatabaseJoinOrCreate, self).get_local_stats(debug=debug, profile=profile))
+
+    def _group_by_fields(self, dicts):
+        """Groups dicts by field names tuple, returning a list of (fields, dicts) tuples."""
+        groups = OrderedDict()
+        for item in dicts:
+            groups.setdefault(tuple(item.keys()), []).append(item)
+        return groups.items()
+
+    def _chunks(self, items, width):
+        """Splits items so that each chunk needs at most in_list_size parameters of `width` values each."""
+        size = max(1, self.in_list_size // max(1, width))
+        return [items[i:i + size] for i in xrange(0, len(items), size)]
@@ -14,19 +14,106 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import itertools
+import sys
+import threading
+import time
+import types
+from Queue import Queue, Empty
+from bisect import bisect_left
+from collections import OrderedDict
 from copy import copy
-from sqlalchemy import MetaData, Table
+from sqlalchemy import Integer, MetaData, Table, and_, bindparam, text
+from sqlalchemy.exc import CompileError
 from rdc.etl.error import ProhibitedOperationError
+from rdc.etl.extra.db.util import get_placeholder, get_key_criteria
 from rdc.etl.hash import Hash
-from rdc.etl.io import STDIN, INSERT, UPDATE, SELECT, STDERR
+from rdc.etl.io import STDIN, INSERT, UPDATE, UPSERT, UNCHANGED, SELECT, STDERR, End, InputMultiplexer, \
+    OutputDemultiplexer
 from rdc.etl.transform import Transform
-from rdc.etl.util import now, cached_property
+from rdc.etl.util import Timer, now, cached_property, fingerprint
+
+FETCH_RETURNING = 'returning'
+FETCH_LASTROWID = 'lastrowid'
+FETCH_SELECT = 'select'
 
 
 class DatabaseLoad(Transform):
     """
+    Loads rows into a database table, inserting rows whose :attr:`discriminant` is not found in the table and updating
+    the others. Rows are buffered and loaded by batches, each one in one transaction. Rows that cannot be loaded are
+    sent to STDERR.
+
+    .. attribute:: bulk
+
+        If true, each batch is loaded using set-based statements: existing rows are looked up with IN (...) queries
+        (at most :attr:`in_list_size` keys each), then all inserts and all updates are sent using executemany (one
+        call per distinct set of columns). If a statement fails, its rows are retried one by one so that only the
+        faulty ones go to STDERR. Discriminant values must have the same types as the ones read from the database.
+
+    .. attribute:: upsert
+
+        If true, and if the database supports it, rows are written using one native "insert or update" statement
+        instead of a lookup followed by an insert or an update: INSERT ... ON CONFLICT (discriminant) DO UPDATE on
+        SQLite (3.24+) and PostgreSQL (9.5+), INSERT ... ON DUPLICATE KEY UPDATE on MySQL. The discriminant columns must
+        be the primary key or a unique index (on MySQL, any unique key conflict triggers the update). Insert only
+        fields and the created at field are not overwritten on update. Both INSERT and UPDATE operations must be
+        allowed. For other databases, the lookup then write path is used. As inserts and updates cannot be told apart,
+        written rows are counted in an "upsert" statistic.
+
+    .. attribute:: skip_unchanged
+
+        If true, rows found in the table are only updated if some value changed, to avoid rewriting identical rows
+        (and bumping their updated at field) on full reloads. Incoming values are compared with the ones of the
+        existing row or, if :attr:`content_hash_field` is set, their hash is compared to the stored one. Skipped rows
+        are counted in an "unchanged" statistic. Not available with :attr:`upsert`, as there is no lookup.
+
+    .. attribute:: content_hash_field
+
+        Optional integer (64 bits) column in which a hash of each written row values is stored (see
+        :func:`rdc.etl.util.fingerprint`). Created at, updated at and content hash fields are not part of the hash.
+        Comparing hashes is cheaper than comparing all values, and does not depend on how the database returns them.
+
+    .. attribute:: writers
+
+        If more than 1, rows are loaded by this number of writer threads, each one with its own connection (so the
+        engine pool should allow as many connections), buffer and transactions. Rows are dispatched on a hash of the
+        discriminant, so rows with the same key always go to the same writer and writers do not conflict on locks.
+        Output rows (including STDERR ones) are yielded as writers commit them, so their order is not kept. If a
+        commit fails, its rows are sent to STDERR and the writer goes on with the next rows, as a single writer would.
+        Statistics are the sums of the writers ones.
+
+    .. attribute:: savepoints
+
+        If true, failing rows are isolated using savepoints: a batch is loaded in a savepoint and, if something fails,
+        rolled back to it and split in two halves retried separately, until the failing rows are found and sent to
+        STDERR, while the other rows are loaded in as large groups as possible. This is needed by databases where a
+        failed statement aborts the whole transaction (like PostgreSQL), so that big commit sizes can be used. In bulk
+        mode, each executemany call is bisected this way. The database driver must support savepoints (with SQLite,
+        the pysqlite transaction handling must be disabled, see SQLAlchemy documentation).
 
-    TODO doc this !!! test this !!!!
+    .. attribute:: commit_size
+
+        Number of rows loaded in each transaction (initial value, if :attr:`target_commit_duration` is set).
+
+    .. attribute:: target_commit_duration
+
+        If set, the number of rows by transaction is adapted after each commit, using the measured throughput, so
+        that a commit lasts about this number of seconds. It changes at most by a factor 2 at each commit, and stays
+        between :attr:`min_commit_size` and :attr:`max_commit_size`.
+
+    .. attribute:: max_commit_age
+
+        If set, buffered rows are committed when this number of seconds elapsed since the last commit, even if the
+        buffer is not full, so that slow input still reaches the database in a timely manner. This is checked on each
+        input row, and about every second when no input comes.
+
+    Values of fetch columns are read back after inserts using RETURNING or the cursor lastrowid when possible (see
+    :attr:`fetch_strategy`), so only databases supporting neither need one more query by inserted row (or by batch,
+    in bulk mode, where RETURNING is used with multi-row inserts).
+
+    Current commit size and a histogram of commit durations are available in the transform statistics, as well as
+    the hit rate of the compiled statement cache (see :meth:`get_statement`).
 
     """
 
@@ -38,9 +125,26 @@ class DatabaseLoad(Transform):
     created_at_field = 'created_at'
     updated_at_field = 'updated_at'
     allowed_operations = (INSERT, UPDATE, )
+    bulk = False
+    upsert = False
+    skip_unchanged = False
+    content_hash_field = None
+    writers = 1
+    savepoints = False
+    in_list_size = 500
+    commit_size = 1000
+    min_commit_size = 10
+    max_commit_size = 100000
+    target_commit_duration = None
+    max_commit_age = None
+
+    # Upper bounds of commit duration histogram buckets, in seconds.
+    commit_duration_buckets = (0.01, 0.1, 1, 10, )
 
     def __init__(self, engine=None, table_name=None, fetch_columns=None, discriminant=None, created_at_field=None,
-                 updated_at_field=None, insert_only_fields=None, allowed_operations=None):
+                 updated_at_field=None, insert_only_fields=None, allowed_operations=None, bulk=None, upsert=None,
+                 commit_size=None, target_commit_duration=None, max_commit_age=None, skip_unchanged=None,
+                 content_hash_field=None, writers=None, savepoints=None):
         super(DatabaseLoad, self).__init__()
 
         self.engine = engine or self.engine
@@ -58,13 +162,33 @@ class DatabaseLoad(Transform):
         self.updated_at_field = updated_at_field or self.updated_at_field
         self.insert_only_fields = insert_only_fields or self.insert_only_fields
         self.allowed_operations = allowed_operations or self.allowed_operations
+        self.bulk = bulk if bulk is not None else self.bulk
+        self.upsert = upsert if upsert is not None else self.upsert
+        self.commit_size = commit_size or self.commit_size
+        self.target_commit_duration = target_commit_duration or self.target_commit_duration
+        self.max_commit_age = max_commit_age or self.max_commit_age
+        self.skip_unchanged = skip_unchanged if skip_unchanged is not None else self.skip_unchanged
+        self.content_hash_field = content_hash_field or self.content_hash_field
+
+        self.writers = writers or self.writers
+        self.savepoints = savepoints if savepoints is not None else self.savepoints
 
+        self._reset()
+
+    def _reset(self):
+        """Initializes the per instance loading state (buffer, connection, statement cache, statistics)."""
         self._buffer = []
         self._connection = None
-        self._max_buffer_size = 1000
+        self._max_buffer_size = self.commit_size
         self._last_duration = None
         self._last_commit_at = None
+        self._commit_durations = [0] * (len(self.commit_duration_buckets) + 1)
+        self._statements = {}
+        self._statement_hits = 0
+        self._statement_misses = 0
         self._query_count = 0
+        self._writers = []
+        self._stopped = False
 
     @property
     def connection(self):
@@ -72,23 +196,269 @@ class DatabaseLoad(Transform):
             self._connection = self.engine.connect()
         return self._connection
 
+    def flush(self):
+        """Commits the buffer content, measures how long the database work took (not counting the time spent by the
+        consumer of yielded rows) and adapts the commit size. Only full buffers are used to adapt the commit size, as
+        buffers flushed because they are too old (or at the end) are not representative. If the commit fails, rows
+        that were not yielded yet are sent to STDERR before the exception is raised again."""
+        inputs = list(self._buffer)
+        size = len(inputs)
+        full = size >= self._max_buffer_size
+
+        done, duration = 0, 0
+        try:
+            commit = self.commit()
+            while True:
+                timer = Timer()
+                try:
+                    with timer:
+                        _out = next(commit)
+                except StopIteration:
+                    break
+                finally:
+                    duration += timer.duration
+                done += 1
+                yield _out
+        except Exception as e:
+            # Yielding clears the current exception, keep it to raise it again.
+            exc_info = sys.exc_info()
+            for hash in inputs[done:]:
+                yield self.get_error_row(hash, e)
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        self._last_commit_at = time.time()
+        self._last_duration = duration
+        if size:
+            self._commit_durations[bisect_left(self.commit_duration_buckets, self._last_duration)] += 1
+            if self.target_commit_duration and full:
+                self._max_buffer_size = self.get_next_commit_size(size, self._last_duration)
+
+    def get_next_commit_size(self, size, duration):
+        """Commit size for which a commit should last about :attr:`target_commit_duration`, given that the last one
+        loaded `size` rows in `duration` seconds."""
+        target = size * self.target_commit_duration / max(duration, 1e-6)
+        target = max(self._max_buffer_size / 2.0, min(self._max_buffer_size * 2.0, target))
+        return int(max(self.min_commit_size, min(self.max_commit_size, target)))
+
     def commit(self):
+        if self.bulk:
+            for _out in self.commit_bulk():
+                yield _out
+            return
+
+        # Taken before anything can fail, so that rows sent to STDERR by a failed flush are not loaded again later.
+        inputs, self._buffer = self._buffer, []
         with self.connection.begin():
-            while len(self._buffer):
-                hash = self._buffer.pop(0)
+            if self.savepoints:
+                for _out in self.commit_bisect(inputs):
+                    yield _out
+                return
+
+            for hash in inputs:
                 try:
                     yield self.do_transform(copy(hash))
                 except Exception as e:
-                    yield Hash((
-                        ('_input', hash, ),
-                        ('_transform', self, ),
-                        ('_error', e, ),
-                    )), STDERR
+                    yield self.get_error_row(hash, e)
+
+    def commit_bisect(self, inputs):
+        """Loads rows in a savepoint, and returns the output rows. If a row fails, rolls back to the savepoint and
+        retries each half of the rows separately, until failing rows are isolated and sent to STDERR."""
+        stats = dict(self._output._special_stats)
+        savepoint = self.connection.begin_nested()
+        try:
+            outputs = [self.do_transform(copy(hash)) for hash in inputs]
+            savepoint.commit()
+            return outputs
+        except Exception as e:
+            savepoint.rollback()
+            self._output._special_stats.update(stats)
+            if len(inputs) == 1:
+                return [self.get_error_row(inputs[0], e)]
+
+        middle = len(inputs) // 2
+        return self.commit_bisect(inputs[:middle]) + self.commit_bisect(inputs[middle:])
+
+    def commit_bulk(self):
+        """Loads the buffer content using set-based statements (see :attr:`bulk`). Rows are yielded in input order,
+        once the transaction is committed."""
+        inputs, self._buffer = self._buffer, []
+        if not len(inputs):
+            return
+
+        hashes = [copy(hash) for hash in inputs]
+        results = [None] * len(hashes)
+
+        with self.connection.begin():
+            for indexes in self.get_bulk_rounds(hashes):
+                self.commit_bulk_round(inputs, hashes, results, indexes)
+
+        for i, hash in enumerate(hashes):
+            yield results[i] or hash
+
+    def get_bulk_rounds(self, hashes):
+        """Splits row indexes in rounds where each key appears at most once, so that a row whose key was already seen
+        in the batch is planned against the database state left by the previous one (which may have failed). Rows
+        with a NULL discriminant value never match each other, and all go in the first round."""
+        rounds, seen = [], {}
+        for i, hash in enumerate(hashes):
+            key = self.get_key(hash)
+            if None in key:
+                n = 0
+            else:
+                n = seen[key] = seen.get(key, -1) + 1
+            if n == len(rounds):
+                rounds.append([])
+            rounds[n].append(i)
+        return rounds
+
+    def commit_bulk_round(self, inputs, hashes, results, indexes):
+        """Loads rows with distinct keys using set-based statements, storing error rows in `results`."""
+        groups = OrderedDict(((INSERT, OrderedDict(), ), (UPDATE, OrderedDict(), ), ))
+        fetch = self.fetch_columns and len(self.fetch_columns)
+        rows = {} if self.can_upsert else self.find_many([hashes[i] for i in indexes])
+
+        for i in indexes:
+            hash = hashes[i]
+            key = self.get_key(hash)
+
+            # Rows with a NULL key cannot be found again, so their fetch columns are read as they are written.
+            if fetch and None in key:
+                try:
+                    self.do_transform(hash)
+                except Exception as e:
+                    results[i] = self.get_error_row(inputs[i], e)
+                continue
+
+            try:
+                operation, columns = self.prepare(hash, rows.get(key))
+            except Exception as e:
+                results[i] = self.get_error_row(inputs[i], e)
+                continue
+
+            if operation == UNCHANGED:
+                self._output._special_stats[UNCHANGED] += 1
+                continue
+            if self.can_upsert:
+                operation = UPSERT
+            groups.setdefault(operation, OrderedDict()).setdefault(columns, []).append(i)
+
+        returned = {}
+        for operation, group in groups.iteritems():
+            for columns, _indexes in group.iteritems():
+                for i, e in self.execute_many(operation, columns, [hashes[i] for i in _indexes], returned):
+                    results[_indexes[i]] = self.get_error_row(inputs[_indexes[i]], e)
+
+        if fetch:
+            pending = [
+                i for i in indexes
+                if results[i] is None and not None in self.get_key(hashes[i])
+            ]
+            refetched = self.find_many([
+                hashes[i] for i in pending
+                if not self.get_key(hashes[i]) in rows and not self.get_key(hashes[i]) in returned
+            ])
+            for i in pending:
+                hash = hashes[i]
+                key = self.get_key(hash)
+                row = rows.get(key) or returned.get(key) or refetched.get(key)
+                if not row:
+                    e = ValueError('Could not find matching row after load.')
+                    results[i] = self.get_error_row(inputs[i], e)
+                    continue
+                for alias, column in self.fetch_columns.iteritems():
+                    hash[alias] = row[column]
+
+    def execute_many(self, operation, columns, hashes, returned=None):
+        """Executes one statement for many rows, and yields (index, exception) tuples for rows that failed. If the
+        whole statement fails, rows are retried one by one to isolate the faulty ones (or bisected, see
+        :attr:`savepoints`).
+
+        If a `returned` dict is given and the database supports RETURNING, inserts are sent as multi-row INSERT ...
+        RETURNING statements, and returned rows are stored in this dict, indexed by discriminant tuple.
+
+        """
+        query = self.get_statement(operation, columns)
+        values = [self.get_values(operation, columns, hash) for hash in hashes]
+        if not (operation == INSERT and self.fetch_strategy == FETCH_RETURNING):
+            returned = None
+
+        if self.savepoints:
+            for failure in self.execute_bisect(operation, columns, hashes, values, returned):
+                yield failure
+            return
+
+        try:
+            self.write_many(operation, columns, hashes, values, returned)
+        except Exception:
+            # Some drivers apply the rows preceding the failing one. Updates and upserts can be replayed, but inserts
+            # that went through must not be retried.
+            done = self.find_many(hashes) if operation == INSERT else {}
+            for i, _values in enumerate(values):
+                if self.get_key(hashes[i]) in done:
+                    self._output._special_stats[operation] += 1
+                    continue
+                try:
+                    result = self.connection.execute(query, _values)
+                    if operation == UPDATE and result.rowcount == 0:
+                        raise ValueError('No matching row to update.')
+                except Exception as e:
+                    yield i, e
+                else:
+                    if returned is not None:
+                        returned[self.get_key(hashes[i])] = result.first()
+                    self._output._special_stats[operation] += 1
+
+    def execute_bisect(self, operation, columns, hashes, values, returned=None, offset=0):
+        """Writes rows in a savepoint. On failure, rolls back to the savepoint and retries each half separately, until
+        failing rows are isolated, and yields (index, exception) tuples for them."""
+        savepoint = self.connection.begin_nested()
+        try:
+            self.write_many(operation, columns, hashes, values, returned)
+            savepoint.commit()
+            return
+        except Exception as e:
+            savepoint.rollback()
+            if len(hashes) == 1:
+                yield offset, e
+                return
+
+        middle = len(hashes) // 2
+        for failure in self.execute_bisect(operation, columns, hashes[:middle], values[:middle], returned, offset):
+            yield failure
+        for failure in self.execute_bisect(operation, columns, hashes[middle:], values[middle:], returned,
+                                           offset + middle):
+            yield failure
+
+    def write_many(self, operation, columns, hashes, values, returned=None):
+        """Writes rows using one executemany call, or multi-row INSERT ... RETURNING statements (with at most
+        :attr:`in_list_size` parameters each) if `returned` is given. Raises if an UPDATE did not match every row."""
+        if returned is not None:
+            size = max(1, self.in_list_size // max(1, len(columns)))
+            for i in xrange(0, len(hashes), size):
+                statement = self.table.insert().values([
+                    dict((_column, hash[_column], ) for _column in columns)
+                    for hash in hashes[i:i + size]
+                ]).returning(*self.returning_columns)
+                for row in self.connection.execute(statement):
+                    returned[tuple(row[key_atom] for key_atom in self.discriminant)] = row
+        else:
+            result = self.connection.execute(self.get_statement(operation, columns), values)
+            if operation == UPDATE and 0 <= result.rowcount < len(values):
+                raise ValueError('{0} rows to update, but only {1} matched.'.format(len(values), result.rowcount))
+
+        self._output._special_stats[operation] += len(values)
 
     def close_connection(self):
         self._connection.close()
         self._connection = None
 
+    def get_error_row(self, hash, e):
+        return Hash((
+            ('_input', hash, ),
+            ('_transform', self, ),
+            ('_error', e, ),
+        )), STDERR
+
     def get_insert_columns_for(self, hash):
         """List of columns we can use for insert."""
         return self.columns
@@ -111,10 +481,14 @@ class DatabaseLoad(Transform):
 
         return [key for key in hash if key in column_names]
 
+    def get_key(self, hash):
+        """Discriminant values tuple of a hash."""
+        return tuple(hash.get(key_atom) for key_atom in self.discriminant)
+
     def find(self, dataset, connection=None):
         query = '''SELECT * FROM {table} WHERE {criteria} LIMIT 1'''.format(
             table=self.table_name,
-            criteria=' AND '.join([key_atom + ' = %s' for key_atom in self.discriminant]),
+            criteria=' AND '.join([key_atom + ' = ' + get_placeholder(self.engine) for key_atom in self.discriminant]),
         )
         rp = (connection or self.connection).execute(query, [dataset.get(key_atom) for key_atom in self.discriminant])
 
@@ -123,24 +497,67 @@ class DatabaseLoad(Transform):
 
         return rp.fetchone()
 
+    def find_many(self, datasets, connection=None):
+        """Finds existing rows for many datasets at once, and returns them in a dict indexed by discriminant tuple."""
+        # Rows with a NULL discriminant value never match.
+        keys = [key for key in OrderedDict.fromkeys(self.get_key(dataset) for dataset in datasets) if not None in key]
+
+        rows = {}
+        for i in xrange(0, len(keys), self.in_list_size):
+            _keys = keys[i:i + self.in_list_size]
+            query = '''SELECT * FROM {table} WHERE {criteria}'''.format(
+                table=self.table_name,
+                criteria=get_key_criteria(self.engine, self.discriminant, len(_keys)),
+            )
+            for row in (connection or self.connection).execute(query, list(itertools.chain(*_keys))):
+                rows.setdefault(tuple(row[key_atom] for key_atom in self.discriminant), row)
+
+            # Increment stats
+            self._input._special_stats[SELECT] += 1
+
+        return rows
+
     def initialize(self):
         super(DatabaseLoad, self).initialize()
 
         self._input._special_stats[SELECT] = 0
         self._output._special_stats[INSERT] = 0
         self._output._special_stats[UPDATE] = 0
+        if self.skip_unchanged:
+            self._output._special_stats[UNCHANGED] = 0
+        self._last_commit_at = time.time()
 
+        if self.writers > 1:
+            self._results = Queue()
+            self._running = self.writers
+            self._stopped = False
+            self._writers = []
+            for i in xrange(self.writers):
+                # Bounded, so that a slow writer slows down input instead of buffering everything in memory.
+                writer, queue = self.create_writer(), Queue(2 * self.commit_size)
+                thread = threading.Thread(target=self._write, args=(writer, queue, ))
+                thread.daemon = True
+                thread.start()
+                self._writers.append((writer, queue, thread, ))
+        if self.upsert:
+            self._output._special_stats[UPSERT] = 0
 
-    def do_transform(self, hash):
-        """Actual database load transformation logic, without the buffering / transaction logic.
+    def prepare(self, hash, row=None):
+        """Checks that the operation needed for this hash (UPDATE if a matching row exists, INSERT otherwise) is
+        allowed, sets the created/updated at fields and returns an (operation, columns) tuple. For updates, the
+        discriminant columns are not part of the returned columns. If the row does not need to be written (see
+        :attr:`skip_unchanged`), operation is UNCHANGED.
 
         """
+        now = self.now
+        column_names = self.columns
 
-        # find line, if it exist
-        row = self.find(hash)
+        if self.content_hash_field in column_names:
+            hash[self.content_hash_field] = self.get_content_hash(hash)
+
+        if row and self.skip_unchanged and self.is_unchanged(hash, row):
+            return UNCHANGED, ()
 
-        now = self.now
-        column_names = self.table.columns.keys()
         # UpdatedAt field configured ? Let's set the value in source hash
         if self.updated_at_field in column_names:
             hash[self.updated_at_field] = now
@@ -154,52 +571,180 @@ class DatabaseLoad(Transform):
             if not UPDATE in self.allowed_operations:
                 raise ProhibitedOperationError('UPDATE operations are not allowed by this transformation.')
 
-            _columns = self.get_columns_for(hash, row)
-
-            query = '''UPDATE {table} SET {values} WHERE {criteria}'''.format(
-                table=self.table_name,
-                values=', '.join((
-                    '{column} = %s'.format(column=_column) for _column in _columns
-                    if not _column in self.discriminant
-                )),
-                criteria=' AND '.join((
-                    '{key} = %s'.format(key=_key) for _key in self.discriminant
-                ))
+            return UPDATE, tuple(
+                _column for _column in self.get_columns_for(hash, row) if not _column in self.discriminant
             )
-            values = [hash[_column] for _column in _columns if not _column in self.discriminant] + \
-                     [hash[_column] for _column in self.discriminant]
 
         # INSERT
+        if not INSERT in self.allowed_operations:
+            raise ProhibitedOperationError('INSERT operations are not allowed by this transformation.')
+
+        if self.created_at_field in column_names:
+            hash[self.created_at_field] = now
         else:
-            if not INSERT in self.allowed_operations:
-                raise ProhibitedOperationError('INSERT operations are not allowed by this transformation.')
+            if self.created_at_field in hash:
+                del hash[self.created_at_field]
 
-            if self.created_at_field in column_names:
-                hash[self.created_at_field] = now
-            else:
-                if self.created_at_field in hash:
-                    del hash[self.created_at_field]
+        return INSERT, tuple(self.get_columns_for(hash))
 
-            _columns = self.get_columns_for(hash)
-            query = '''INSERT INTO {table} ({keys}) VALUES ({values})'''.format(
-                table=self.table_name,
-                keys=', '.join(_columns),
-                values=', '.join(['%s'] * len(_columns))
+    def get_content_columns(self, hash):
+        """Columns of the hash that are compared (or hashed) to detect changes."""
+        ignored = (self.created_at_field, self.updated_at_field, self.content_hash_field, )
+        return [column for column in hash if column in self.columns and not column in ignored]
+
+    def get_content_hash(self, hash):
+        return fingerprint(itertools.chain(*(
+            (column, hash[column], ) for column in sorted(self.get_content_columns(hash))
+        )))
+
+    def is_unchanged(self, hash, row):
+        """Whether the existing row already has the values of the hash."""
+        try:
+            if self.content_hash_field in self.columns:
+                return row[self.content_hash_field] == hash[self.content_hash_field]
+
+            update_columns = self.get_columns_for(hash, row)
+            for column in self.get_content_columns(hash):
+                if column in update_columns and row[column] != hash[column]:
+                    return False
+            return True
+        except KeyError:
+            # Row from the same batch, written with another set of columns.
+            return False
+
+    @cached_property
+    def can_upsert(self):
+        """Whether native upsert is enabled, allowed and supported by the database."""
+        return bool(
+            self.upsert and INSERT in self.allowed_operations and UPDATE in self.allowed_operations and
+            self.get_upsert_clause(self.discriminant) is not None
+        )
+
+    def get_upsert_clause(self, columns):
+        """Dialect specific clause to append to an INSERT statement on given columns to turn it into an upsert, or None
+        if the database does not support it."""
+        dialect = self.engine.dialect
+        update_columns = [
+            column for column in columns
+            if not column in self.discriminant and not column in self.insert_only_fields
+            and column != self.created_at_field
+        ]
+
+        if dialect.name == 'mysql':
+            return ''' ON DUPLICATE KEY UPDATE {values}'''.format(values=', '.join(
+                '{column} = VALUES({column})'.format(column=column) for column in update_columns
+            ) or '{key} = {key}'.format(key=self.discriminant[0]))
+
+        if dialect.name == 'postgresql' and (dialect.server_version_info or ()) >= (9, 5, ) or \
+                dialect.name == 'sqlite' and dialect.dbapi.sqlite_version_info >= (3, 24, 0, ):
+            return ''' ON CONFLICT ({keys}) {action}'''.format(
+                keys=', '.join(self.discriminant),
+                action='DO UPDATE SET ' + ', '.join(
+                    '{column} = excluded.{column}'.format(column=column) for column in update_columns
+                ) if len(update_columns) else 'DO NOTHING',
             )
-            values = [hash[key] for key in _columns]
 
-        # Execute
-        self.connection.execute(query, values)
+    @cached_property
+    def fetch_strategy(self):
+        """How the values of fetch columns are read after a row is inserted: using a RETURNING clause if the database
+        supports it, using the cursor lastrowid if the only fetched column is an auto-incremented integer primary key
+        (and the database driver supports it), or with a new SELECT query otherwise."""
+        if not self.fetch_columns:
+            return None
 
-        # Increment stats
-        if row:
-            self._output._special_stats[UPDATE] += 1
+        try:
+            self.table.insert().returning(*self.returning_columns).compile(dialect=self.engine.dialect)
+            return FETCH_RETURNING
+        except CompileError:
+            pass
+
+        primary_key = list(self.table.primary_key.columns)
+        if self.engine.dialect.postfetch_lastrowid and len(primary_key) == 1 and \
+                isinstance(primary_key[0].type, Integer) and primary_key[0].autoincrement in ('auto', True, ) and \
+                set(self.fetch_columns.values()) == set((primary_key[0].name, )):
+            return FETCH_LASTROWID
+
+        return FETCH_SELECT
+
+    @cached_property
+    def returning_columns(self):
+        """Table columns to return after an insert: discriminant and fetch columns."""
+        return [
+            self.table.c[column]
+            for column in OrderedDict.fromkeys(tuple(self.discriminant) + tuple(self.fetch_columns.values()))
+        ]
+
+    def get_statement(self, operation, columns):
+        """Compiled SQL statement for an operation on given columns. Statements are built using SQLAlchemy core
+        constructs on the reflected table, compiled once for each distinct (operation, columns) tuple and cached, so
+        rows with the same shape reuse the same statement."""
+        key = (operation, columns, )
+        if key in self._statements:
+            self._statement_hits += 1
+            return self._statements[key]
+        self._statement_misses += 1
+
+        values = dict((_column, bindparam('v_' + _column), ) for _column in columns)
+
+        if operation == UPSERT:
+            # No portable construct for this, use a textual statement with the same parameter names.
+            statement = text('''INSERT INTO {table} ({keys}) VALUES ({values}){clause}'''.format(
+                table=self.table_name,
+                keys=', '.join(columns),
+                values=', '.join(':v_' + _column for _column in columns),
+                clause=self.get_upsert_clause(columns),
+            ) + (
+                ' RETURNING ' + ', '.join(column.name for column in self.returning_columns)
+                if self.fetch_strategy == FETCH_RETURNING else ''
+            ))
+        elif operation == UPDATE:
+            statement = self.table.update().where(and_(*[
+                self.table.c[_key] == bindparam('k_' + _key) for _key in self.discriminant
+            ])).values(values)
         else:
-            self._output._special_stats[INSERT] += 1
+            statement = self.table.insert().values(values)
+            if self.fetch_strategy == FETCH_RETURNING:
+                statement = statement.returning(*self.returning_columns)
+
+        self._statements[key] = statement = statement.compile(dialect=self.engine.dialect)
+        return statement
 
+    def get_values(self, operation, columns, hash):
+        """SQL statement parameters for an operation on given columns."""
+        values = dict(('v_' + _column, hash[_column], ) for _column in columns)
+        if operation == UPDATE:
+            values.update(('k_' + _column, hash[_column], ) for _column in self.discriminant)
+        return values
 
-        # If user required us to fetch some columns, let's query again to get their actual values.
+    def do_transform(self, hash):
+        """Actual database load transformation logic, without the buffering / transaction logic.
+
+        """
+
+        # find line, if it exist
+        row = None if self.can_upsert else self.find(hash)
+
+        operation, columns = self.prepare(hash, row)
+        if self.can_upsert:
+            operation = UPSERT
+
+        # Execute
+        result = None
+        if operation != UNCHANGED:
+            result = self.connection.execute(
+                self.get_statement(operation, columns), self.get_values(operation, columns, hash)
+            )
+
+        # Increment stats
+        self._output._special_stats[operation] += 1
+
+        # If user required us to fetch some columns, get their actual values (from the statement result if possible,
+        # or by querying again).
         if self.fetch_columns and len(self.fetch_columns):
+            if not row and self.fetch_strategy == FETCH_RETURNING:
+                row = result.first()
+            elif not row and self.fetch_strategy == FETCH_LASTROWID and operation == INSERT and result.lastrowid:
+                row = {self.fetch_columns.values()[0]: result.lastrowid}
             if not row:
                 row = self.find(hash)
             if not row:
@@ -211,33 +756,166 @@ class DatabaseLoad(Transform):
         return hash
 
     def transform(self, hash, channel=STDIN):
-        """Transform method. Stores the input in a buffer, and only unstack buffer content if some limit has been
-        exceeded.
-
-        TODO for now buffer limit is hardcoded as 1000, but we may use a few criterias to add intelligence to this:
-             time since last commit, duration of last commit, buffer length ...
+        """Transform method. Stores the input in a buffer, and only unstack buffer content if the buffer is full (see
+        :attr:`commit_size` and :attr:`target_commit_duration`), or too old (see :attr:`max_commit_age`).
 
         """
+        if self._writers:
+            if self._stopped:
+                raise RuntimeError('Parallel writers are stopped.')
+            key = self.get_key(hash)
+            self._writers[fingerprint(key) % len(self._writers)][1].put(hash)
+            for _out in self.collect():
+                yield _out
+            return
+
         self._buffer.append(hash)
 
-        if len(self._buffer) >= self._max_buffer_size:
-            for _out in self.commit():
+        if len(self._buffer) >= self._max_buffer_size or self.expired:
+            for _out in self.flush():
                 yield _out
 
+    def idle(self):
+        if self._writers:
+            return self.collect()
+
+        if len(self._buffer) and self.expired:
+            return self.flush()
+
     def finalize(self):
         """Transform's finalize method.
 
-        Empties the remaining lines in buffer by loading them into database and close database connection.
+        Empties the remaining lines in buffer by loading them into database and close database connection. Errors are
+        not raised (rows of a failed commit are sent to STDERR), so that downstream transforms still get the end of
+        the stream.
 
         """
 
         super(DatabaseLoad, self).finalize()
 
-        for _out in self.commit():
-            yield _out
+        if self._writers:
+            if not self._stopped:
+                self.stop_writers()
+                for _out in self.collect(block=True):
+                    yield _out
+            return
+
+        try:
+            for _out in self.flush():
+                yield _out
+        except Exception:
+            # Rows of the failed commit were sent to STDERR. Raising would prevent End from being sent downstream.
+            pass
 
         self.close_connection()
 
+    def create_writer(self):
+        """Copy of this transform, with its own connection, buffer and statistics, used by parallel loads."""
+        writer = copy(self)
+        # Methods bound to this transform in __init__ (like transform) must be bound to the copy.
+        for name, value in vars(writer).items():
+            if isinstance(value, types.MethodType) and value.__self__ is self:
+                setattr(writer, name, types.MethodType(value.__func__, writer))
+        writer.writers = 1
+        writer._input = InputMultiplexer(self.INPUT_CHANNELS)
+        writer._output = OutputDemultiplexer(self.OUTPUT_CHANNELS)
+        writer._reset()
+        writer.initialize()
+        return writer
+
+    def collect(self, block=False):
+        """Yields rows loaded by parallel writers. If `block` is true, waits until all writers are done. Writers send
+        rows of failed commits to STDERR and keep on loading; unless blocking (in finalize, which must not raise), the
+        first writer error is then raised again once available rows were yielded, as a failed flush does."""
+        error = None
+        while True:
+            try:
+                _out = self._results.get(block and self._running > 0)
+            except Empty:
+                break
+
+            if _out is End:
+                self._running -= 1
+            elif isinstance(_out, Exception):
+                error = error or _out
+            else:
+                yield _out
+
+        self.merge_stats()
+
+        if self._stopped and not self._running:
+            for writer, queue, thread in self._writers:
+                thread.join()
+
+        if error is not None and not block:
+            raise error
+
+    def stop_writers(self):
+        """Tells writers that no more input will come, so that they load their buffers and exit."""
+        self._stopped = True
+        for writer, queue, thread in self._writers:
+            queue.put(End)
+
+    def merge_stats(self):
+        """Sums writers statistics into this transform's ones."""
+        writers = [writer for writer, queue, thread in self._writers]
+        for mux, attribute in ((self._input, '_input', ), (self._output, '_output', ), ):
+            for channel in mux._special_stats:
+                mux._special_stats[channel] = sum(
+                    getattr(writer, attribute)._special_stats.get(channel, 0) for writer in writers
+                )
+        self._commit_durations = [sum(durations) for durations in zip(*[
+            writer._commit_durations for writer in writers
+        ])]
+        self._statement_hits = sum(writer._statement_hits for writer in writers)
+        self._statement_misses = sum(writer._statement_misses for writer in writers)
+        self._max_buffer_size = min(writer._max_buffer_size for writer in writers)
+
+    def _write(self, writer, queue):
+        """Parallel writer thread loop."""
+        while True:
+            try:
+                hash = queue.get(timeout=1)
+            except Empty:
+                hash = None
+
+            if hash is End:
+                break
+
+            try:
+                outputs = writer.idle() if hash is None else writer.transform(hash)
+                for _out in outputs or ():
+                    self._results.put(_out)
+            except Exception as e:
+                self._results.put(e)
+
+        try:
+            for _out in writer.finalize():
+                self._results.put(_out)
+        except Exception as e:
+            self._results.put(e)
+        finally:
+            self._results.put(End)
+
+    @property
+    def expired(self):
+        """Whether the buffer content waited for more than :attr:`max_commit_age` seconds."""
+        return bool(self.max_commit_age and time.time() - self._last_commit_at >= self.max_commit_age)
+
+    def get_local_stats(self, debug=False, profile=False):
+        buckets = ['<%gs' % (bound, ) for bound in self.commit_duration_buckets]
+        buckets.append('>=%gs' % (self.commit_duration_buckets[-1], ))
+        return (
+            ('commit_size', self._max_buffer_size, ),
+            ('commits', ' '.join(
+                '%s:%d' % (bucket, count, ) for bucket, count in zip(buckets, self._commit_durations) if count
+            ) or 0, ),
+            ('statement_hits', '%.1f%%' % (
+                100.0 * self._statement_hits / (self._statement_hits + self._statement_misses)
+                if self._statement_hits + self._statement_misses else 0,
+            ), ),
+        ) + tuple(super(DatabaseLoad, self).get_local_stats(debug=debug, profile=profile))
+
     def add_fetch_column(self, *columns, **aliased_columns):
         self.fetch_columns.update(aliased_columns)
         for column in columns:
@@ -255,10 +933,223 @@ class DatabaseLoad(Transform):
     @cached_property
     def table(self):
         """SQLAlchemy table object, using metadata autoloading from database to avoid the need of column definitions."""
-        return Table(self.table_name, self.metadata, autoload=True, autoload_with=self.engine)
+        return Table(self.table_name, self.metadata, autoload=True, autoload_with=self.connection)
 
     @property
     def now(self):
         """Current timestamp, used for created/updated at fields."""
         return now()
 
+
+
+class DatabaseStagingLoad(DatabaseLoad):
+    """
+    Loads rows into a database table using set-based statements, for big loads: each batch is inserted into a
+    temporary staging table (with the same columns as the target table), then merged into the target table using
+    one UPDATE ... FROM statement for rows whose :attr:`discriminant` already exists and one INSERT ... SELECT ...
+    WHERE NOT EXISTS statement for the others (one of each by distinct set of columns in the batch).
+
+    Works on PostgreSQL, MySQL (using UPDATE ... JOIN) and SQLite (UPDATE ... FROM needs SQLite 3.33+, a correlated
+    sub-query is used with older versions). If the merge fails, the batch is rolled back and loaded again by
+    :class:`DatabaseLoad` (row by row, or using :attr:`bulk` statements), so that faulty rows are sent to STDERR.
+
+    If a batch contains the same key more than once, only the last row is written (and yielded). Existing rows are only looked up
+    if :attr:`skip_unchanged` is set or if only one of INSERT and UPDATE is allowed (and, after the merge, to read
+    fetch columns values). The :attr:`upsert` attribute is only used when falling back to :class:`DatabaseLoad`.
+
+    .. attribute:: staging_table_name
+
+        Name of the temporary staging table (defaults to the target table name prefixed by "_staging_"). It is created
+        once by connection, outside of the load transactions, and dropped when the connection is closed.
+
+    """
+
+    staging_table_name = None
+
+    def __init__(self, engine=None, table_name=None, fetch_columns=None, discriminant=None, created_at_field=None,
+                 updated_at_field=None, insert_only_fields=None, allowed_operations=None, bulk=None, upsert=None,
+                 commit_size=None, target_commit_duration=None, max_commit_age=None, skip_unchanged=None,
+                 content_hash_field=None, writers=None, savepoints=None, staging_table_name=None):
+        super(DatabaseStagingLoad, self).__init__(
+            engine=engine, table_name=table_name, fetch_columns=fetch_columns, discriminant=discriminant,
+            created_at_field=created_at_field, updated_at_field=updated_at_field,
+            insert_only_fields=insert_only_fields, allowed_operations=allowed_operations, bulk=bulk, upsert=upsert,
+            commit_size=commit_size, target_commit_duration=target_commit_duration, max_commit_age=max_commit_age,
+            skip_unchanged=skip_unchanged, content_hash_field=content_hash_field, writers=writers,
+            savepoints=savepoints,
+        )
+        self.staging_table_name = staging_table_name or self.staging_table_name or '_staging_' + self.table_name
+
+    def _reset(self):
+        super(DatabaseStagingLoad, self)._reset()
+        self._staging_table_created = False
+
+    def commit(self):
+        if not len(self._buffer):
+            return
+
+        input_stats, output_stats = dict(self._input._special_stats), dict(self._output._special_stats)
+        try:
+            outputs = self.merge(self._buffer)
+        except Exception:
+            # Let the row based loader find out which rows are faulty.
+            self._input._special_stats.update(input_stats)
+            self._output._special_stats.update(output_stats)
+            for _out in super(DatabaseStagingLoad, self).commit():
+                yield _out
+            return
+
+        self._buffer = []
+        for _out in outputs:
+            yield _out
+
+    def merge(self, inputs):
+        """Loads rows in one transaction using the staging table, and returns the output rows (in input order, without
+        the rows replaced by a later one with the same key). Raises if a set-based statement fails, after the
+        transaction was rolled back."""
+        self.create_staging_table()
+
+        hashes = [copy(hash) for hash in inputs]
+        results = [None] * len(hashes)
+        groups = OrderedDict()
+
+        # Last row wins if a key is repeated, whatever its columns. Rows with NULL key values never match each other.
+        last = dict((self.get_key(hash), i) for i, hash in enumerate(hashes) if not None in self.get_key(hash))
+        replaced = set(i for i, hash in enumerate(hashes) if last.get(self.get_key(hash), i) != i)
+
+        with self.connection.begin():
+            lookup = self.skip_unchanged or not (INSERT in self.allowed_operations and
+                                                 UPDATE in self.allowed_operations)
+            rows = self.find_many(hashes) if lookup else {}
+
+            for i, hash in enumerate(hashes):
+                if i in replaced:
+                    continue
+                try:
+                    operation, columns = self.prepare(hash, rows.get(self.get_key(hash)))
+                except Exception as e:
+                    results[i] = self.get_error_row(inputs[i], e)
+                    continue
+
+                if operation == UNCHANGED:
+                    self._output._special_stats[UNCHANGED] += 1
+                    continue
+                groups.setdefault(tuple(self.get_columns_for(hash)), []).append(hash)
+
+            for columns, group in groups.iteritems():
+                self.merge_group(columns, group)
+
+            if self.fetch_columns and len(self.fetch_columns):
+                rows = self.find_many([
+                    hash for i, hash in enumerate(hashes) if results[i] is None and not i in replaced
+                ])
+                for i, hash in enumerate(hashes):
+                    if results[i] is None and not i in replaced:
+                        row = rows.get(self.get_key(hash))
+                        if not row:
+                            results[i] = self.get_error_row(inputs[i], ValueError(
+                                'Could not find matching row after load.'
+                            ))
+                            continue
+                        for alias, column in self.fetch_columns.iteritems():
+                            hash[alias] = row[column]
+
+        return [results[i] or hash for i, hash in enumerate(hashes) if not i in replaced]
+
+    def merge_group(self, columns, hashes):
+        """Stages rows having values for the same columns, and merges them into the target table."""
+        self.connection.execute('DELETE FROM {staging}'.format(staging=self.staging_table_name))
+        self.connection.execute('INSERT INTO {staging} ({columns}) VALUES ({values})'.format(
+            staging=self.staging_table_name,
+            columns=', '.join(columns),
+            values=', '.join([get_placeholder(self.engine)] * len(columns)),
+        ), [tuple(hash[column] for column in columns) for hash in hashes])
+
+        query = self.get_merge_update_query(columns)
+        if query is not None and UPDATE in self.allowed_operations:
+            self._output._special_stats[UPDATE] += self.connection.execute(query).rowcount
+
+        if INSERT in self.allowed_operations:
+            self._output._special_stats[INSERT] += self.connection.execute(
+                self.get_merge_insert_query(columns)
+            ).rowcount
+
+    def create_staging_table(self):
+        """Creates the staging table on the current connection, if not done yet. The table is created from the target
+        table columns, without any constraint, so values are only checked when merged. A pooled connection may
+        still have it from a previous load, in which case it is reused (it is emptied before each use)."""
+        if not self._staging_table_created:
+            self.connection.execute('''CREATE TEMPORARY TABLE IF NOT EXISTS {staging} AS
+                SELECT * FROM {table} WHERE 1 = 0'''.format(
+                staging=self.staging_table_name,
+                table=self.table_name,
+            ))
+            self._staging_table_created = True
+
+    def close_connection(self):
+        if self._staging_table_created:
+            self.connection.execute('DROP TABLE {staging}'.format(staging=self.staging_table_name))
+            self._staging_table_created = False
+        super(DatabaseStagingLoad, self).close_connection()
+
+    def get_merge_criteria(self):
+        """SQL criteria joining the staging table rows with target table rows having the same key."""
+        return ' AND '.join('{table}.{key} = {staging}.{key}'.format(
+            table=self.table_name, staging=self.staging_table_name, key=key_atom,
+        ) for key_atom in self.discriminant)
+
+    def get_merge_update_query(self, columns):
+        """Set-based UPDATE of target rows found in the staging table, using the dialect specific syntax, or None if
+        there is nothing to update. Insert only fields and the created at field are not overwritten."""
+        update_columns = [
+            column for column in columns
+            if not column in self.discriminant and not column in self.insert_only_fields
+            and column != self.created_at_field
+        ]
+        if not len(update_columns):
+            return None
+
+        dialect = self.engine.dialect
+        if dialect.name == 'mysql':
+            return '''UPDATE {table} JOIN {staging} ON {criteria} SET {values}'''.format(
+                table=self.table_name,
+                staging=self.staging_table_name,
+                criteria=self.get_merge_criteria(),
+                values=', '.join('{table}.{column} = {staging}.{column}'.format(
+                    table=self.table_name, staging=self.staging_table_name, column=column,
+                ) for column in update_columns),
+            )
+
+        if dialect.name == 'postgresql' or \
+                dialect.name == 'sqlite' and dialect.dbapi.sqlite_version_info >= (3, 33, 0, ):
+            return '''UPDATE {table} SET {values} FROM {staging} WHERE {criteria}'''.format(
+                table=self.table_name,
+                staging=self.staging_table_name,
+                criteria=self.get_merge_criteria(),
+                values=', '.join('{column} = {staging}.{column}'.format(
+                    staging=self.staging_table_name, column=column,
+                ) for column in update_columns),
+            )
+
+        return '''UPDATE {table} SET {values} WHERE EXISTS (SELECT 1 FROM {staging} WHERE {criteria})'''.format(
+            table=self.table_name,
+            staging=self.staging_table_name,
+            criteria=self.get_merge_criteria(),
+            values=', '.join('{column} = (SELECT {staging}.{column} FROM {staging} WHERE {criteria})'.format(
+                staging=self.staging_table_name, column=column, criteria=self.get_merge_criteria(),
+            ) for column in update_columns),
+        )
+
+    def get_merge_insert_query(self, columns):
+        """Set-based INSERT of staging table rows not found in the target table."""
+        return '''INSERT INTO {table} ({columns}) SELECT {values} FROM {staging} WHERE NOT EXISTS (
+            SELECT 1 FROM {table} WHERE {criteria}
+        )'''.format(
+            table=self.table_name,
+            staging=self.staging_table_name,
+            columns=', '.join(columns),
+            values=', '.join('{staging}.{column}'.format(
+                staging=self.staging_table_name, column=column,
+            ) for column in columns),
+            criteria=self.get_merge_criteria(),
+        )
@@ -14,12 +14,37 @@
 # see the license for the specific language governing permissions and
 # limitations under the license.
 
+import sys
+import time
+from collections import OrderedDict
 from rdc.etl.error import AbstractError, ValidationError
 from rdc.etl.transform import Transform
 
 
 class SqlExec(Transform):
-    def __init__(self, sql=None, db=None):
+    """
+    Executes a SQL statement for each input row. The :meth:`sql` callable returns a (sql, param1, param2, ...) tuple
+    (or a false value to skip the row), and the execution status ("success" or "failure") is stored in a
+    "@<name>#<id>@status" field of the row.
+
+    .. attribute:: batch_size
+
+        If set, rows are buffered, and statements of buffered rows are grouped by SQL text and sent using one
+        executemany call (so, one transaction) by group, when this number of rows is reached. If a group fails, all
+        its rows are marked as failed (the error is not raised, so that the job goes on). Rows are yielded in input
+        order.
+
+    .. attribute:: max_latency
+
+        If set (in batch mode), buffered rows are executed when the oldest one waited for this number of seconds, even
+        if the buffer is not full. This is checked on each input row, and about every second when no input comes.
+
+    """
+
+    batch_size = None
+    max_latency = None
+
+    def __init__(self, sql=None, db=None, batch_size=None, max_latency=None):
         # Use the callable name if provided
         if sql and not self._name:
             self._name = sql.__name__
@@ -28,7 +53,11 @@ class SqlExec(Transform):
 
         self.db = db
         self.sql = sql or self.sql
+        self.batch_size = batch_size or self.batch_size
+        self.max_latency = max_latency or self.max_latency
 
+        self._buffer = []
+        self._buffered_at = None
 
     def sql(self, hash, channel):
         raise AbstractError(self.sql)
@@ -37,15 +66,84 @@ class SqlExec(Transform):
         if self.db is None:
             raise ValidationError(self, '"db" positional argument is required.')
 
+    @property
+    def status_field(self):
+        return '@{0}#{1}@status'.format(self.__name__, id(self))
+
     def transform(self, hash, channel):
+        if self.batch_size:
+            for _out in self.transform_batch(hash, channel):
+                yield _out
+            return
+
         try:
             params = self.sql(hash, channel)
             if params:
                 sql, params = params[0], params[1:]
                 self.db.execute(sql, params)
-                hash['@{0}#{1}@status'.format(self.__name__, id(self))] = 'success'
+                hash[self.status_field] = 'success'
         except Exception as e:
-            hash['@{0}#{1}@status'.format(self.__name__, id(self))] = 'failure'
+            hash[self.status_field] = 'failure'
             raise
         finally:
             yield hash
+
+    def transform_batch(self, hash, channel):
+        try:
+            statement = self.sql(hash, channel)
+        except Exception:
+            # Yielding clears the current exception, keep it to raise it again.
+            exc_info = sys.exc_info()
+            hash[self.status_field] = 'failure'
+            # Previously buffered rows are not lost, and input order is kept.
+            try:
+                for _out in self.flush():
+                    yield _out
+            finally:
+                yield hash
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        if not len(self._buffer):
+            self._buffered_at = time.time()
+        self._buffer.append((hash, statement, ))
+
+        if len(self._buffer) >= self.batch_size or self.expired:
+            for _out in self.flush():
+                yield _out
+
+    def flush(self):
+        """Executes the buffered statements, one executemany call by distinct SQL text, and yields the buffered rows
+        with their status (failed groups are not raised, their rows have the "failure" status)."""
+        buffer, self._buffer = self._buffer, []
+
+        groups = OrderedDict()
+        for hash, statement in buffer:
+            if statement:
+                groups.setdefault(statement[0], []).append((hash, statement[1:], ))
+
+        for sql, rows in groups.iteritems():
+            try:
+                self.db.execute(sql, [params for hash, params in rows])
+                status = 'success'
+            except Exception:
+                status = 'failure'
+            for hash, params in rows:
+                hash[self.status_field] = status
+
+        for hash, statement in buffer:
+            yield hash
+
+    def idle(self):
+        if len(self._buffer) and self.expired:
+            return self.flush()
+
+    def finalize(self):
+        super(SqlExec, self).finalize()
+
+        for _out in self.flush():
+            yield _out
+
+    @property
+    def expired(self):
+        """Whether the oldest buffered row waited for more than :attr:`max_latency` seconds."""
+        return bool(self.max_latency and len(self._buffer) and time.time() - self._buffered_at >= self.max_latency)
@@ -14,9 +14,31 @@
 # see the license for the specific language governing permissions and
 # limitations under the license.
 
+import threading
+import time
 from threading import Lock
+from sqlalchemy.exc import DBAPIError, OperationalError, TimeoutError
+from rdc.etl.stat import Statisticable
 from rdc.etl.transform import Transform
 
+def get_placeholder(engine):
+    """Positional parameter placeholder to use in raw SQL for this engine's DBAPI (qmark or format paramstyles)."""
+    return '?' if engine.dialect.paramstyle == 'qmark' else '%s'
+
+
+def get_key_criteria(engine, columns, count):
+    """SQL criteria matching `count` key tuples on given columns: an IN (...) list for a single column key, or OR'ed
+    equalities for composite keys. Parameters are the flattened key tuples."""
+    placeholder = get_placeholder(engine)
+
+    if len(columns) == 1:
+        return '{column} IN ({values})'.format(column=columns[0], values=', '.join([placeholder] * count))
+
+    return ' OR '.join(['(' + ' AND '.join(
+        '{column} = {placeholder}'.format(column=column, placeholder=placeholder) for column in columns
+    ) + ')'] * count)
+
+
 class DbTransform(Transform):
     """Base class for transformations needing a database engine.
 
@@ -30,12 +52,174 @@ class DbEngineThreadsafeWrapper(object):
     """Avoid concurrency problems when using the same engine in multiple transforms running at the same time.
     TODO: make generic __getattr__ that returns a locked wrapper around arbitrary named methods.
 
+    All statements are serialized behind one lock, see :class:`DbEnginePool` for a concurrent alternative. Other
+    attributes (dialect, ...) are the engine ones, and are not locked.
+
     """
 
     def __init__(self, engine):
         self._engine = engine
         self._lock = Lock()
 
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._engine, name)
+
     def execute(self, *args, **kwargs):
         with self._lock:
             return self._engine.execute(*args, **kwargs)
+
+
+class DbEnginePool(Statisticable):
+    """Engine wrapper giving each thread (so, each transform of a threaded job) its own connection, so that statements
+    from different transforms run concurrently instead of being serialized behind one lock. Drop-in replacement for
+    :class:`DbEngineThreadsafeWrapper`: :meth:`execute` has the same interface, and other attributes (dialect, ...)
+    are the engine ones.
+
+    A thread keeps its connection until it calls :meth:`release` or finishes (connections of finished threads are
+    reclaimed on the next checkout). At most pool_size idle connections are kept open for reuse, and at most
+    pool_size + max_overflow connections are used at the same time: more threads wait, for at most `timeout`
+    seconds, for a connection to be released. As connections can be reused (or closed) by other threads than the
+    one that opened them, SQLite engines need the check_same_thread=False connect argument.
+
+    If `retries` is set, statements failing with an operational error (lost connection, deadlock, lock timeout...) are
+    executed again, after `retry_delay` seconds, on a new connection if the previous one was invalidated. Only enable
+    this for statements that can safely be replayed (autocommit, not inside an explicit transaction).
+
+    Connections in use, idle and open connections, peak usage, waits and retries are available in statistics.
+
+    """
+
+    def __init__(self, engine, pool_size=5, max_overflow=10, timeout=30, retries=0, retry_delay=0.1):
+        self._engine = engine
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        self._condition = threading.Condition(Lock())
+        self._connections = {}
+        self._idle = []
+        self._reserved = 0
+        self._peak = 0
+        self._waits = 0
+        self._retries = 0
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._engine, name)
+
+    @property
+    def connection(self):
+        """Connection of the current thread, checked out if needed."""
+        thread = threading.current_thread()
+        with self._condition:
+            connection = self._connections.get(thread)
+            if connection is None:
+                connection = self._checkout()
+                if connection is not None:
+                    self._connections[thread] = connection
+        if connection is None:
+            connection = self._connect()
+            with self._condition:
+                self._reserved -= 1
+                self._connections[thread] = connection
+        return connection
+
+    def execute(self, *args, **kwargs):
+        retries = self.retries
+        while True:
+            try:
+                return self.connection.execute(*args, **kwargs)
+            except DBAPIError as e:
+                if not retries or not (isinstance(e, OperationalError) or e.connection_invalidated):
+                    raise
+                retries -= 1
+                with self._condition:
+                    self._retries += 1
+                if e.connection_invalidated:
+                    self.release(close=True)
+                time.sleep(self.retry_delay)
+
+    def release(self, close=False):
+        """Gives the current thread connection back to the pool (or closes it)."""
+        with self._condition:
+            connection = self._connections.pop(threading.current_thread(), None)
+            if connection is not None:
+                self._checkin(connection, close=close)
+
+    def dispose(self):
+        """Closes all connections. Connections still used by running threads are closed too."""
+        with self._condition:
+            for connection in self._idle + self._connections.values():
+                connection.close()
+            self._connections, self._idle = {}, []
+            self._condition.notify_all()
+
+    def get_stats(self, debug=False, profile=False):
+        with self._condition:
+            return (
+                ('in_use', len(self._connections), ),
+                ('idle', len(self._idle), ),
+                ('size', len(self._connections) + len(self._idle), ),
+                ('peak', self._peak, ),
+                ('waits', self._waits, ),
+                ('retries', self._retries, ),
+            )
+
+    def _checkout(self):
+        """Gets an idle connection, or reserves a slot for a new one (returns None, the caller must then call
+        :meth:`_connect` without holding the lock), waiting if the pool is exhausted. Must be called with the lock
+        held."""
+        deadline = time.time() + self.timeout
+        waited = False
+        while True:
+            self._reclaim()
+            if len(self._idle):
+                connection = self._idle.pop()
+                break
+            if len(self._connections) + self._reserved < self.pool_size + self.max_overflow:
+                # Connecting can be slow, it is done outside the lock so that other threads are not blocked.
+                connection = None
+                self._reserved += 1
+                break
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise TimeoutError('Pool limit of size {0} overflow {1} reached, timed out after {2}s.'.format(
+                    self.pool_size, self.max_overflow, self.timeout,
+                ))
+            if not waited:
+                self._waits += 1
+                waited = True
+            # Wake up from time to time, to reclaim connections of threads that finished without releasing them.
+            self._condition.wait(min(remaining, 0.1))
+
+        self._peak = max(self._peak, len(self._connections) + self._reserved + (connection is not None))
+        return connection
+
+    def _connect(self):
+        """Opens a new connection in a slot reserved by :meth:`_checkout`, giving the slot back if it fails."""
+        try:
+            return self._engine.connect()
+        except:
+            with self._condition:
+                self._reserved -= 1
+                self._condition.notify()
+            raise
+
+    def _checkin(self, connection, close=False):
+        """Must be called with the lock held."""
+        if close or connection.invalidated or len(self._idle) >= self.pool_size:
+            connection.close()
+        else:
+            self._idle.append(connection)
+        self._condition.notify()
+
+    def _reclaim(self):
+        """Takes back connections of finished threads. Must be called with the lock held."""
+        for thread in [thread for thread in self._connections if not thread.is_alive()]:
+            self._checkin(self._connections.pop(thread))
@@ -39,6 +39,8 @@ STDOUT2 = 1
 STDOUT3 = 2
 INSERT = 10
 UPDATE = 11
+UPSERT = 12
+UNCHANGED = 13
 
 # Default channels
 DEFAULT_INPUT_CHANNEL = STDIN
@@ -64,10 +66,25 @@ CHANNEL_NAMES = {
         STDOUT3: 'out3',
         INSERT: 'insert',
         UPDATE: 'update',
+        UPSERT: 'upsert',
+        UNCHANGED: 'unchanged',
     },
 }
 
 
+def get_channel_name(type, channel, names=None):
+    """Human friendly name of a channel. Names given by the channel owner (see the multiplexers `names` argument) are
+    used first, then the registered ones. Other channels are numbered the same way as in2/out2/out3."""
+    if names and channel in names:
+        return names[channel]
+    if channel in CHANNEL_NAMES[type]:
+        return CHANNEL_NAMES[type][channel]
+    prefix = 'in' if type == INPUT_TYPE else 'out'
+    if isinstance(channel, (int, long, )) and channel >= 0:
+        return prefix + str(channel + 1)
+    return prefix + repr(channel)
+
+
 class Token(object):
     """Factory for signal oriented queue messages."""
 
@@ -110,17 +127,20 @@ class IWritable:
 
 
 class InputMultiplexer(IReadable, Statisticable):
-    def __init__(self, channels):
+    def __init__(self, channels, names=None):
         self.queues = dict([(channel, Input()) for channel in channels])
         self._plugged = set()
 
+        # channel names used in statistics, overriding the default ones
+        self.names = dict(names or {})
+
         # statistic related
         self._stats = dict([(channel, 0) for channel in channels])
         self._special_stats = dict()
 
     def get_stats(self, debug=False, profile=False):
         stats = itertools.chain(self._stats.iteritems(), self._special_stats.iteritems())
-        return ((CHANNEL_NAMES[INPUT_TYPE][channel], stat) for channel, stat in stats)
+        return ((get_channel_name(INPUT_TYPE, channel, self.names), stat) for channel, stat in stats)
 
     def get(self, block=True, timeout=None):
         """Gets a (data, channel) tuple from the first queue ready for it.
@@ -173,16 +193,19 @@ class InputMultiplexer(IReadable, Statisticable):
 
 
 class OutputDemultiplexer(IWritable, Statisticable):
-    def __init__(self, channels):
+    def __init__(self, channels, names=None):
         self.channels = dict([(channel, []) for channel in channels])
 
+        # channel names used in statistics, overriding the default ones
+        self.names = dict(names or {})
+
         # statistic related
         self._stats = dict([(channel, 0) for channel in channels])
         self._special_stats = dict()
 
     def get_stats(self, debug=False, profile=False):
         stats = itertools.chain(self._stats.iteritems(), self._special_stats.iteritems())
-        return ((CHANNEL_NAMES[OUTPUT_TYPE][channel], stat) for channel, stat in stats)
+        return ((get_channel_name(OUTPUT_TYPE, channel, self.names), stat) for channel, stat in stats)
 
     def put(self, data, block=True, timeout=None):
         data, channel = self.__demux(data)
@@ -233,12 +256,14 @@ class Input(Queue, IReadable, IWritable):
 
         self._runlevel = 0
         self._writable_runlevel = 0
+        self._opened = False
 
     def put(self, data, block=True, timeout=None):
         # Begin token is a metadata to raise the input runlevel.
         if data == Begin:
             self._runlevel += 1
             self._writable_runlevel += 1
+            self._opened = True
             return
 
         # Check we are actually able to receive data.
@@ -277,6 +302,12 @@ class Input(Queue, IReadable, IWritable):
     def alive(self):
         return self._runlevel > 0
 
+    @property
+    def terminated(self):
+        """Whether all writers are done with this input, and all data has been read from it. An input that never
+        received a Begin token is not considered as terminated, as someone may still plug into it."""
+        return self._opened and self._writable_runlevel < 1 and self.empty()
+
 
 IO_TYPES = {
     INPUT_TYPE: InputMultiplexer,
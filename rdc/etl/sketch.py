@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012-2014 Romain Dorgueil
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Constant memory probabilistic data structures, working on 64 bits fingerprints (see :func:`rdc.etl.util.fingerprint`).
+
+"""
+
+import math
+import random
+
+
+class BloomFilter(object):
+    """Set membership with no false negatives, and a bounded false positive rate as long as no more than `capacity`
+    items are added. Needs about 9.6 bits per item for a 1% error rate, 14.4 bits per item for 0.1%.
+
+    >>> bf = BloomFilter(1000, 0.01)
+    >>> bf.add(42)
+    True
+    >>> bf.add(42), 42 in bf, 43 in bf
+    (False, True, False)
+
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        if not 0 < error_rate < 1:
+            raise ValueError('Error rate must be between 0 and 1, got %r.' % (error_rate, ))
+
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hash_count = max(1, int(round(self.size / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _get_positions(self, fingerprint):
+        # Kirsch-Mitzenmacher double hashing, using both halves of the fingerprint.
+        h1 = fingerprint & 0xFFFFFFFF
+        h2 = ((fingerprint >> 32) & 0xFFFFFFFF) | 1
+        return ((h1 + i * h2) % self.size for i in xrange(self.hash_count))
+
+    def add(self, fingerprint):
+        """Adds a fingerprint, returns False if it was (probably) already there."""
+        added = False
+        for position in self._get_positions(fingerprint):
+            byte, mask = position >> 3, 1 << (position & 7)
+            if not self.bits[byte] & mask:
+                self.bits[byte] |= mask
+                added = True
+        return added
+
+    def __contains__(self, fingerprint):
+        for position in self._get_positions(fingerprint):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class HyperLogLog(object):
+    """Cardinality estimator, using 2**precision one byte registers (16KB for the default precision of 14). Standard
+    error is 1.04 / sqrt(2**precision), about 0.8% with default precision.
+
+    >>> from rdc.etl.util import fingerprint
+    >>> hll = HyperLogLog()
+    >>> for i in xrange(1000):
+    ...     hll.add(fingerprint((i % 100, )))
+    >>> abs(hll.cardinality() - 100) < 5
+    True
+
+    """
+
+    def __init__(self, precision=14):
+        if not 4 <= precision <= 18:
+            raise ValueError('HyperLogLog precision must be between 4 and 18, got %r.' % (precision, ))
+
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, fingerprint):
+        value = fingerprint & 0xFFFFFFFFFFFFFFFF
+        index = value >> (64 - self.precision)
+        remaining_bits = 64 - self.precision
+        rank = remaining_bits - (value & ((1 << remaining_bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """Union with another estimator of same precision (in place)."""
+        if other.precision != self.precision:
+            raise ValueError('Cannot merge HyperLogLog estimators of different precisions.')
+        for i, rank in enumerate(other.registers):
+            if rank > self.registers[i]:
+                self.registers[i] = rank
+        return self
+
+    def cardinality(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -rank for rank in self.registers)
+
+        # Small range correction (linear counting).
+        zeros = self.registers.count('\x00')
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / float(zeros))
+
+        return int(round(estimate))
+
+
+class QuantileSketch(object):
+    """Mergeable approximate quantiles (KLL sketch). Keeps O(k) items whatever the stream length, rank error is
+    about 1.7 / k (less than 1% for the default k=200).
+
+    >>> qs = QuantileSketch()
+    >>> for i in xrange(10001):
+    ...     qs.add(i)
+    >>> abs(qs.quantile(0.5) - 5000) < 100
+    True
+
+    """
+
+    def __init__(self, k=200, seed=None):
+        self.k = k
+        self.count = 0
+        self.compactors = [[]]
+        self._random = random.Random(seed)
+
+    def _capacity(self, height):
+        depth = len(self.compactors) - height - 1
+        return int(math.ceil(self.k * (2.0 / 3) ** depth)) + 1
+
+    def _size(self):
+        return sum(len(compactor) for compactor in self.compactors)
+
+    def _max_size(self):
+        return sum(self._capacity(height) for height in xrange(len(self.compactors)))
+
+    def _compress(self):
+        while self._size() >= self._max_size():
+            for height, compactor in enumerate(self.compactors):
+                if len(compactor) >= self._capacity(height):
+                    if height + 1 >= len(self.compactors):
+                        self.compactors.append([])
+                    # Keep one item out of two (randomly the odd or even ones), each worth twice more one level up.
+                    compactor.sort()
+                    offset = self._random.randint(0, 1)
+                    kept = len(compactor) // 2 * 2
+                    self.compactors[height + 1].extend(compactor[offset:kept:2])
+                    del compactor[:kept]
+                    break
+
+    def add(self, value):
+        self.compactors[0].append(value)
+        self.count += 1
+        if len(self.compactors[0]) >= self._capacity(0):
+            self._compress()
+
+    def merge(self, other):
+        """Union with another sketch (in place)."""
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append([])
+        for height, compactor in enumerate(other.compactors):
+            self.compactors[height].extend(compactor)
+        self.count += other.count
+        self._compress()
+        return self
+
+    def quantiles(self, qs):
+        """Approximate values at given ranks (between 0 and 1)."""
+        weighted = sorted(
+            (value, 1 << height)
+            for height, compactor in enumerate(self.compactors)
+            for value in compactor
+        )
+        if not len(weighted):
+            return [None for q in qs]
+
+        total = sum(weight for value, weight in weighted)
+        results = []
+        for q in qs:
+            target, cumulated = q * total, 0
+            for value, weight in weighted:
+                cumulated += weight
+                if cumulated >= target:
+                    break
+            results.append(value)
+        return results
+
+    def quantile(self, q):
+        return self.quantiles((q, ))[0]
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012-2014 Romain Dorgueil
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import time
+import unittest
+from sqlalchemy import create_engine, event
+from rdc.etl.extra.db.extract import DatabaseExtract, PartitionedDatabaseExtract, prefetch
+
+
+class DatabaseExtractTestCase(unittest.TestCase):
+    def setUp(self):
+        # Not in memory, so that each connection (and each thread) sees the same database.
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.engine = create_engine('sqlite:///' + self.path)
+        self.engine.execute('CREATE TABLE item (a INTEGER, b INTEGER, name TEXT)')
+        # Inserted out of order, so the results only are sorted if the extract sorts them.
+        for a in (2, 0, 1):
+            for b in (3, 1, 2, 0):
+                self.engine.execute('INSERT INTO item VALUES (?, ?, ?)', (a, b, '%d.%d' % (a, b)))
+
+    def tearDown(self):
+        self.engine.dispose()
+        os.unlink(self.path)
+
+    def _extract(self, **kwargs):
+        t = DatabaseExtract(self.engine, 'SELECT a, b, name FROM item;', **kwargs)
+        return [row['name'] for row in t.extract()]
+
+    def test_offset_pagination(self):
+        self.assertEqual(len(self._extract(pack_size=5)), 12)
+
+    def test_keyset_pagination(self):
+        expected = ['%d.%d' % (a, b) for a in range(3) for b in range(4)]
+        for pack_size in (1, 3, 5, 12, 100):
+            self.assertEqual(self._extract(key=('a', 'b', ), pack_size=pack_size), expected)
+
+    def test_keyset_limit(self):
+        # Like offset pagination, limit is applied per page.
+        self.assertEqual(self._extract(key=('a', 'b', ), pack_size=5, limit=6),
+                         ['0.0', '0.1', '0.2', '0.3', '1.0', '1.1', '1.2', '1.3', '2.0', '2.1'])
+
+    def test_stream(self):
+        for pack_size in (1, 5, 100):
+            self.assertEqual(sorted(self._extract(stream=True, pack_size=pack_size)),
+                             sorted(self._extract(pack_size=pack_size)))
+        self.assertEqual(len(self._extract(stream=True, pack_size=5, limit=6)), 10)
+
+    def test_stream_yields_before_end(self):
+        checked_in = []
+        event.listen(self.engine, 'checkin', lambda *args: checked_in.append(True))
+
+        t = DatabaseExtract(self.engine, 'SELECT a, b, name FROM item', stream=True, pack_size=2)
+        rows = t.extract()
+        next(rows)
+        # The connection stays open while the extraction is in progress, and is released once complete.
+        self.assertEqual(len(checked_in), 0)
+        self.assertEqual(len(list(rows)), 11)
+        self.assertEqual(len(checked_in), 1)
+
+    def test_prefetch(self):
+        for kwargs in ({}, {'key': ('a', 'b', )}, {'stream': True}, {'limit': 6}, ):
+            self.assertEqual(self._extract(prefetch=2, pack_size=5, **kwargs), self._extract(pack_size=5, **kwargs))
+
+    def test_prefetch_depth(self):
+        produced = []
+
+        def pages():
+            for i in range(10):
+                produced.append(i)
+                yield i
+
+        items = prefetch(pages(), 2)
+        self.assertEqual(next(items), 0)
+        time.sleep(0.1)
+        # Two pages ready, and one waiting for room in the queue.
+        self.assertEqual(len(produced), 4)
+        self.assertEqual(list(items), range(1, 10))
+
+    def test_prefetch_error(self):
+        def pages():
+            yield 1
+            raise RuntimeError('Boom.')
+
+        items = prefetch(pages(), 2)
+        self.assertEqual(next(items), 1)
+        self.assertRaises(RuntimeError, next, items)
+
+    def _extract_partitioned(self, **kwargs):
+        t = PartitionedDatabaseExtract(self.engine, 'SELECT a, b, name FROM item', 'b', **kwargs)
+        return t, [row['name'] for row in t.extract()]
+
+    def test_partitioned(self):
+        self.engine.execute('INSERT INTO item VALUES (?, ?, ?)', (3, None, 'null'))
+        expected = sorted(self._extract())
+
+        for kwargs in ({'partitions': 2}, {'partitions': 3, 'pack_size': 1}, {'partitions': 10},
+                       {'boundaries': (1, 3, )}, ):
+            t, names = self._extract_partitioned(**kwargs)
+            self.assertEqual(sorted(names), expected)
+            stats = dict(t.get_stats())
+            self.assertEqual(sum(value for name, value in stats.items() if name.startswith('part')), 13)
+
+        t, names = self._extract_partitioned(boundaries=(1, 3, ))
+        self.assertEqual([dict(t.get_stats())[part] for part in ('part1', 'part2', 'part3')], [4, 6, 3])
+        self.assertEqual(dict(t.get_stats())['done'], '3/3')
+
+    def test_partitioned_ordered(self):
+        t, names = self._extract_partitioned(partitions=3, ordered=True, pack_size=2)
+        self.assertEqual([name[-1] for name in names], list('000111222333'))
+
+    def test_partitioned_interrupted(self):
+        t = PartitionedDatabaseExtract(self.engine, 'SELECT a, b, name FROM item', 'b', partitions=3, pack_size=1)
+        rows = t.extract()
+        next(rows)
+        rows.close()
+        self.assertEqual(len(self._extract()), 12)
+
+
+if __name__ == '__main__':
+    unittest.main()
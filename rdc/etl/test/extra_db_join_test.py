@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012-2014 Romain Dorgueil
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from sqlalchemy import create_engine, event
+from rdc.etl.extra.db.join import DatabaseJoin, DatabaseJoinOrCreate
+from rdc.etl.extra.db.util import DbEngineThreadsafeWrapper
+from rdc.etl.hash import Hash
+from rdc.etl.io import STDERR
+
+INPUT_DATA = [Hash((('n', n), ('cid', cid), ('rid', 1), )) for n, cid in enumerate((1, 2, 1, 9, 3, 2, 1))]
+
+
+class DatabaseJoinTestCase(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        self.engine.execute('CREATE TABLE customer (id INTEGER, region_id INTEGER, name TEXT)')
+        self.engine.execute('CREATE TABLE phone (customer_id INTEGER, phone TEXT)')
+        for row in ((1, 1, 'alice'), (2, 1, 'bob'), (3, 1, 'carol'), (3, 2, 'dave')):
+            self.engine.execute('INSERT INTO customer VALUES (?, ?, ?)', row)
+        for row in ((1, '111'), (1, '112'), (2, '222')):
+            self.engine.execute('INSERT INTO phone VALUES (?, ?)', row)
+
+    def _run(self, t):
+        t.initialize()
+        return [dict(row) for row in list(t(*INPUT_DATA)) + list(t.finalize() or ())]
+
+    def _join(self, **kwargs):
+        return DatabaseJoin(
+            self.engine,
+            'SELECT phone FROM phone WHERE customer_id = ?',
+            ('cid', ),
+            batch_query='SELECT customer_id, phone FROM phone WHERE {criteria}',
+            key_columns=('customer_id', ),
+            **kwargs
+        )
+
+    def test_batch_inner_join(self):
+        expected = self._run(self._join())
+        self.assertEqual([(row['n'], row['phone']) for row in expected],
+                         [(0, '111'), (0, '112'), (1, '222'), (2, '111'), (2, '112'), (5, '222'), (6, '111'),
+                          (6, '112')])
+
+        for batch_size in (1, 2, 3, 100):
+            self.assertEqual(
+                [(row['n'], row['phone']) for row in self._run(self._join(batch_size=batch_size, in_list_size=2))],
+                [(row['n'], row['phone']) for row in expected],
+            )
+
+    def test_batch_outer_join(self):
+        expected = self._run(self._join(is_outer=True))
+        self.assertEqual(len(expected), 10)
+        self.assertEqual([row['n'] for row in self._run(self._join(is_outer=True, batch_size=4))],
+                         [row['n'] for row in expected])
+
+    def test_batch_composite_key(self):
+        t = DatabaseJoin(
+            self.engine,
+            dataset_keys_for_values=('cid', 'rid', ),
+            batch_query='SELECT id, region_id, name FROM customer WHERE {criteria}',
+            key_columns=('id', 'region_id', ),
+            batch_size=3,
+        )
+        self.assertEqual([(row['n'], row['name']) for row in self._run(t)],
+                         [(0, 'alice'), (1, 'bob'), (2, 'alice'), (4, 'carol'), (5, 'bob'), (6, 'alice')])
+
+    def test_preload(self):
+        for on_disk in (False, True, ):
+            for is_outer in (False, True, ):
+                t = self._join(is_outer=is_outer, preload_query='SELECT customer_id, phone FROM phone',
+                               preload_on_disk=on_disk)
+                self.assertEqual([(row['n'], row.get('phone')) for row in self._run(t)],
+                                 [(row['n'], row.get('phone')) for row in self._run(self._join(is_outer=is_outer))])
+                stats = dict(t.get_stats())
+                self.assertEqual((stats['keys'], stats['rows']), (2, 3))
+                self.assertTrue(stats['preload'].endswith('s'))
+
+
+class DatabaseJoinOrCreateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        self.engine.execute('CREATE TABLE country (id INTEGER PRIMARY KEY, code TEXT, name TEXT)')
+        self.engine.execute("INSERT INTO country (code, name) VALUES ('fr', 'France')")
+        self.statements = []
+        event.listen(self.engine, 'before_cursor_execute', lambda conn, cursor, statement, *args: (
+            self.statements.append(statement.split()[0])
+        ))
+
+    def _run(self, engine=None, **kwargs):
+        t = DatabaseJoinOrCreate(
+            engine or self.engine, 'country',
+            identity=lambda hash: {'code': hash['code']},
+            params=lambda hash: {'name': hash['code'].upper()},
+            output=lambda mapped: {'country_id': mapped['id']},
+            **kwargs
+        )
+        t.initialize()
+        codes = ('fr', 'de', 'fr', 'it', 'de', 'es', )
+        out = list(t(*[Hash((('n', n), ('code', code), )) for n, code in enumerate(codes)])) + list(t.finalize())
+        self.executed = list(self.statements)
+        self.assertEqual([(row['n'], row['code']) for row in out], list(enumerate(codes)))
+        self.assertEqual(
+            dict((row['code'], row['country_id']) for row in out),
+            dict(self.engine.execute('SELECT code, id FROM country').fetchall()),
+        )
+        return t, dict(t.get_stats())
+
+    def test_row_by_row(self):
+        t, stats = self._run()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 4))
+        self.assertEqual(self.executed.count('INSERT'), 3)
+
+    def test_bounded_cache(self):
+        t, stats = self._run(result_cache_size=1)
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (0, 6, 5))
+        self.assertEqual(self.executed.count('INSERT'), 3)
+
+    def test_prewarm(self):
+        t, stats = self._run(prewarm=True, identity_fields=('code', ))
+        self.assertEqual((stats['hits'], stats['misses'], stats['prewarmed']), (3, 3, 1))
+
+    def test_prewarm_needs_identity_fields(self):
+        self.assertRaises(ValueError, DatabaseJoinOrCreate, self.engine, 'country', prewarm=True)
+
+    def test_batch(self):
+        t, stats = self._run(batch_size=10)
+        # One find, one multi-row insert, one find to read created rows back.
+        self.assertEqual(self.executed, ['SELECT', 'INSERT', 'SELECT'])
+        self.assertEqual((stats['hits'], stats['misses']), (0, 4))
+
+    def test_batch_failure(self):
+        self.engine.execute('CREATE TABLE city (id INTEGER PRIMARY KEY, code TEXT, name TEXT NOT NULL)')
+        t = DatabaseJoinOrCreate(
+            self.engine, 'city',
+            identity=lambda hash: {'code': hash['code']},
+            params=lambda hash: {'name': hash['code'].upper() if hash['code'] != 'xx' else None},
+            output=lambda mapped: {'city_id': mapped['id']},
+            batch_size=10,
+        )
+        t.initialize()
+        codes = ('par', 'xx', 'ber', 'xx', 'rom', )
+        out = list(t(*[Hash((('n', n), ('code', code), )) for n, code in enumerate(codes)])) + list(t.finalize())
+
+        self.assertEqual([row['n'] for row in out if not isinstance(row, tuple)], [0, 2, 4])
+        self.assertEqual([(row[0]['_input']['n'], row[1]) for row in out if isinstance(row, tuple)],
+                         [(1, STDERR), (3, STDERR)])
+        self.assertEqual(sorted(code for code, in self.engine.execute('SELECT code FROM city')), ['ber', 'par', 'rom'])
+
+    def test_threadsafe_wrapper(self):
+        t, stats = self._run(engine=DbEngineThreadsafeWrapper(self.engine))
+        self.assertEqual((stats['hits'], stats['misses']), (2, 4))
+
+    def test_batch_in_list_size(self):
+        t, stats = self._run(batch_size=4, in_list_size=2)
+        self.assertEqual(self.executed.count('INSERT'), 3)
+
+if __name__ == '__main__':
+    unittest.main()
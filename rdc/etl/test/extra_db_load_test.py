@@ -0,0 +1,474 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012-2014 Romain Dorgueil
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import time
+import unittest
+from sqlalchemy import create_engine, event
+from sqlalchemy.dialects import postgresql
+from rdc.etl.extra.db.load import DatabaseLoad, DatabaseStagingLoad
+from rdc.etl.hash import Hash
+from rdc.etl.io import STDERR, INSERT, UPDATE, UPSERT, UNCHANGED, SELECT
+
+
+class FailingLoad(DatabaseLoad):
+    """Loses its connection when beginning the transaction of a batch containing one of the failing ids."""
+    failing_ids = (12, 142, )
+
+    def commit(self):
+        self._failing = any(hash['id'] in self.failing_ids for hash in self._buffer)
+        return super(FailingLoad, self).commit()
+
+    @property
+    def connection(self):
+        if getattr(self, '_failing', False):
+            self._failing = False
+            raise RuntimeError('Connection lost.')
+        return DatabaseLoad.connection.fget(self)
+
+
+class DatabaseLoadTestCase(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        self._create_schema()
+
+    def _create_schema(self):
+        self.engine.execute('''CREATE TABLE customer (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            email TEXT,
+            created_at DATETIME,
+            updated_at DATETIME
+        )''')
+        self.engine.execute('''INSERT INTO customer (id, name, email) VALUES (1, 'alice', 'alice@example.com')''')
+
+    def _load(self, rows, factory=DatabaseLoad, **kwargs):
+        t = factory(self.engine, 'customer', **kwargs)
+        t.initialize()
+        out = list(t(*rows)) + list(t.finalize())
+        return t, [row for row in out if not isinstance(row, tuple)], [row[0] for row in out if isinstance(row, tuple)]
+
+    def _select(self):
+        return [tuple(row) for row in self.engine.execute('SELECT id, name, email FROM customer ORDER BY id')]
+
+    def _stats(self, t):
+        return (t._input._special_stats[SELECT], t._output._special_stats[INSERT], t._output._special_stats[UPDATE])
+
+    def _test_load(self, bulk, factory=DatabaseLoad, **kwargs):
+        rows = [
+            Hash((('id', 1), ('name', 'alice'), ('email', 'alice@example.org'), )),
+            Hash((('id', 2), ('name', 'bob'), )),
+            Hash((('id', 3), ('name', None), )),
+            Hash((('id', 2), ('name', 'bobby'), )),
+            Hash((('id', 4), ('name', 'carol'), ('email', 'carol@example.com'), ('unknown', 42), )),
+        ]
+        t, out, errors = self._load(rows, factory=factory, bulk=bulk, fetch_columns={'customer_id': 'id'}, **kwargs)
+
+        self.assertEqual(self._select(), [
+            (1, 'alice', 'alice@example.org'),
+            (2, 'bobby', None),
+            (4, 'carol', 'carol@example.com'),
+        ])
+        self.assertEqual([(row['name'], row['customer_id']) for row in out],
+                         [('alice', 1), ('bob', 2), ('bobby', 2), ('carol', 4)])
+        self.assertEqual(len(errors), 1)
+        self.assertIs(errors[0]['_input'], rows[2])
+        self.assertNotIn('created_at', errors[0]['_input'])
+        return t
+
+    def test_load(self):
+        t = self._test_load(bulk=False)
+        # One find by row, generated ids of inserted rows are read using lastrowid.
+        self.assertEqual(self._stats(t), (5, 2, 2))
+        self.assertEqual(t.fetch_strategy, 'lastrowid')
+
+    def test_bulk_load(self):
+        t = self._test_load(bulk=True)
+        # One find for the batch, one to check which inserts went through when the batch insert failed, and one more
+        # to fetch columns of inserted rows. The repeated key is loaded in a second round, with one more find.
+        self.assertEqual(self._stats(t), (4, 2, 2))
+
+    def _test_duplicate_key(self, bulk):
+        t, out, errors = self._load([{'id': 5, 'name': None}, {'id': 5, 'name': 'x'}], bulk=bulk)
+        self.assertEqual([row['_input']['name'] for row in errors], [None])
+        self.assertEqual([row['name'] for row in out], ['x'])
+        self.assertEqual(self._select()[1:], [(5, 'x', None)])
+        self.assertEqual(self._stats(t)[1:], (1, 0))
+
+    def test_duplicate_key(self):
+        self._test_duplicate_key(bulk=False)
+
+    def test_bulk_duplicate_key(self):
+        self._test_duplicate_key(bulk=True)
+
+    def test_bulk_update_no_match(self):
+        t = DatabaseLoad(self.engine, 'customer', bulk=True, allowed_operations=(UPDATE, ))
+        t.initialize()
+        # The row disappears between the lookup and the update.
+        t.find_many = lambda datasets, connection=None: {(2, ): {'id': 2}, (1, ): {'id': 1}}
+        out = list(t({'id': 1, 'name': 'alicia'}, {'id': 2, 'name': 'bob'})) + list(t.finalize())
+        self.assertEqual([row['id'] for row in out if not isinstance(row, tuple)], [1])
+        self.assertEqual([row[0]['_input']['id'] for row in out if isinstance(row, tuple)], [2])
+        self.assertEqual(self._stats(t)[1:], (0, 1))
+
+    def test_bulk_null_keys(self):
+        self.engine.execute('CREATE TABLE event (id INTEGER PRIMARY KEY, code TEXT, name TEXT NOT NULL)')
+        t = DatabaseLoad(self.engine, 'event', discriminant=('code', ), bulk=True, fetch_columns={'event_id': 'id'})
+        t.initialize()
+        rows = [{'code': None, 'name': 'a'}, {'code': None, 'name': 'b'}, {'code': 'c', 'name': 'c'},
+                {'code': None, 'name': None}]
+        out = list(t(*rows)) + list(t.finalize())
+
+        self.assertEqual([(row['name'], row['event_id']) for row in out[:3]], [('a', 1), ('b', 2), ('c', 3)])
+        self.assertEqual(out[3][0]['_input'], rows[3])
+        self.assertEqual(self.engine.execute('SELECT COUNT(*) FROM event').scalar(), 3)
+
+        # Without fetch columns, rows with NULL keys are inserted by the same statement, and never merged together.
+        t = DatabaseLoad(self.engine, 'event', discriminant=('code', ), bulk=True)
+        t.initialize()
+        list(t(*[{'code': None, 'name': 'd'}, {'code': None, 'name': 'e'}])) + list(t.finalize())
+        self.assertEqual(t._output._special_stats[INSERT], 2)
+        self.assertEqual(self.engine.execute('SELECT COUNT(*) FROM event').scalar(), 5)
+
+    def test_bulk_load_in_list_size(self):
+        t = DatabaseLoad(self.engine, 'customer', bulk=True)
+        t.in_list_size = 2
+        t.initialize()
+        list(t(*[{'id': i, 'name': str(i)} for i in range(5)]))
+        list(t.finalize())
+        self.assertEqual(len(self._select()), 5)
+        self.assertEqual(self._stats(t), (3, 4, 1))
+
+    def test_bulk_load_allowed_operations(self):
+        t, out, errors = self._load([{'id': 1, 'name': 'alice'}, {'id': 2, 'name': 'bob'}], bulk=True,
+                                    allowed_operations=(INSERT, ))
+        self.assertEqual([row['id'] for row in out], [2])
+        self.assertEqual([row['_input']['id'] for row in errors], [1])
+
+    def _test_upsert(self, bulk):
+        self.engine.execute("UPDATE customer SET created_at = '2014-01-01 00:00:00.000000'")
+        t, out, errors = self._load([
+            {'id': 1, 'name': 'alicia', 'email': 'alicia@example.com'},
+            {'id': 2, 'name': 'bob', 'email': 'bob@example.com'},
+            {'id': 2, 'name': 'bobby', 'email': 'bobby@example.com'},
+            {'id': 3, 'name': None},
+        ], bulk=bulk, upsert=True, insert_only_fields=('email', ))
+
+        self.assertEqual(self._select(), [(1, 'alicia', 'alice@example.com'), (2, 'bobby', 'bob@example.com')])
+        self.assertEqual(len(out), 3)
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(self._stats(t), (0, 0, 0))
+        self.assertEqual(t._output._special_stats[UPSERT], 3)
+
+        created_at, updated_at = self.engine.execute('SELECT created_at, updated_at FROM customer WHERE id = 1').first()
+        self.assertTrue(created_at.startswith('2014-'))
+        self.assertGreater(updated_at, created_at)
+
+    def test_upsert(self):
+        self._test_upsert(bulk=False)
+
+    def test_bulk_upsert(self):
+        self._test_upsert(bulk=True)
+
+    def test_upsert_fallback(self):
+        t, out, errors = self._load([{'id': 1, 'name': 'alicia'}, {'id': 2, 'name': 'bob'}], upsert=True,
+                                    allowed_operations=(INSERT, ))
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(self._stats(t), (2, 1, 0))
+
+    def _test_generated_ids(self, bulk):
+        t, out, errors = self._load([
+            {'name': 'bob', 'email': 'bob@example.com'},
+            {'name': 'alicia', 'email': 'alice@example.com'},
+            {'name': 'carol', 'email': 'carol@example.com'},
+        ], bulk=bulk, discriminant=('email', ), fetch_columns={'customer_id': 'id'})
+        self.assertEqual([(row['name'], row['customer_id']) for row in out], [('bob', 2), ('alicia', 1), ('carol', 3)])
+        return t
+
+    def test_generated_ids(self):
+        t = self._test_generated_ids(bulk=False)
+        self.assertEqual(self._stats(t), (3, 2, 1))
+
+    def test_bulk_generated_ids(self):
+        t = self._test_generated_ids(bulk=True)
+        # No lastrowid with executemany, inserted rows are read again with one query.
+        self.assertEqual(self._stats(t), (2, 2, 1))
+
+    def test_fetch_strategy(self):
+        self.assertEqual(DatabaseLoad(self.engine, 'customer', fetch_columns=('id', 'name', )).fetch_strategy, 'select')
+
+        class Engine(object):
+            dialect = postgresql.dialect()
+
+        t = DatabaseLoad(self.engine, 'customer', fetch_columns=('id', ), discriminant=('email', ))
+        t.table
+        t.engine = Engine()
+        self.assertEqual(t.fetch_strategy, 'returning')
+        self.assertEqual(str(t.get_statement(INSERT, ('name', 'email', ))),
+                         'INSERT INTO customer (name, email) VALUES (%(v_name)s, %(v_email)s) '
+                         'RETURNING customer.email, customer.id')
+
+    def _test_skip_unchanged(self, bulk):
+        rows = [
+            {'id': 1, 'name': 'alice', 'email': 'alice@example.com'},
+            {'id': 1, 'name': 'alice', 'email': 'alice@example.org'},
+            {'id': 1, 'name': 'alice', 'email': 'alice@example.org'},
+            {'id': 2, 'name': 'bob'},
+            {'id': 2, 'name': 'bob'},
+        ]
+        t, out, errors = self._load(rows, bulk=bulk, skip_unchanged=True)
+        self.assertEqual(len(out), 5)
+        self.assertEqual(self._select(), [(1, 'alice', 'alice@example.org'), (2, 'bob', None)])
+        self.assertEqual([t._output._special_stats[channel] for channel in (INSERT, UPDATE, UNCHANGED)], [1, 1, 3])
+
+    def test_skip_unchanged(self):
+        self._test_skip_unchanged(bulk=False)
+
+    def test_bulk_skip_unchanged(self):
+        self._test_skip_unchanged(bulk=True)
+
+    def test_content_hash(self):
+        self.engine.execute('CREATE TABLE product (id INTEGER PRIMARY KEY, name TEXT, price REAL, content_hash BIGINT)')
+
+        def load(*rows):
+            t = DatabaseLoad(self.engine, 'product', skip_unchanged=True, content_hash_field='content_hash')
+            t.initialize()
+            list(t(*rows)) + list(t.finalize())
+            return [t._output._special_stats[channel] for channel in (INSERT, UPDATE, UNCHANGED)]
+
+        self.assertEqual(load({'id': 1, 'name': 'foo', 'price': 1.5}, {'id': 2, 'name': 'bar', 'price': 2.0}),
+                         [2, 0, 0])
+        self.assertEqual(load({'id': 1, 'name': 'foo', 'price': 1.5}, {'id': 2, 'name': 'bar', 'price': 2.5}),
+                         [0, 1, 1])
+        self.assertEqual(load({'id': 1, 'name': 'foo', 'price': 1.5}, {'id': 2, 'name': 'bar', 'price': 2.5}),
+                         [0, 0, 2])
+
+    def test_statement_cache(self):
+        t, out, errors = self._load([{'id': i, 'name': str(i)} for i in range(1, 11)])
+        self.assertEqual(len(t._statements), 2)
+        self.assertEqual(dict(t.get_stats())['statement_hits'], '80.0%')
+
+    def test_adaptive_commit_size(self):
+        t = DatabaseLoad(self.engine, 'customer', commit_size=100, target_commit_duration=3600)
+        t.initialize()
+        list(t(*[{'id': i, 'name': str(i)} for i in range(10, 710)]))
+        # Commits are fast, so the commit size doubled after each one (100 + 200 + 400 rows committed).
+        self.assertEqual(dict(t.get_stats())['commit_size'], 800)
+        self.assertEqual(len(self._select()), 701)
+
+        self.assertEqual(t.get_next_commit_size(800, 3600 * 1.6), 500)
+        self.assertEqual(t.get_next_commit_size(800, 3600 * 100), 400)
+        t.max_commit_size = 1000
+        self.assertEqual(t.get_next_commit_size(800, 1), 1000)
+
+    def test_adaptive_commit_size_excludes_consumer_time(self):
+        t = DatabaseLoad(self.engine, 'customer', commit_size=10, target_commit_duration=0.05)
+        t.initialize()
+        # Rows are consumed slowly downstream, which must not count in the commit duration.
+        for row in t(*[{'id': i, 'name': str(i)} for i in range(10, 20)]):
+            time.sleep(0.01)
+        self.assertEqual(dict(t.get_stats())['commit_size'], 20)
+
+    def test_adaptive_commit_size_ignores_expired_buffers(self):
+        t = DatabaseLoad(self.engine, 'customer', commit_size=100, target_commit_duration=3600, max_commit_age=0.01)
+        t.initialize()
+        for i in range(10, 13):
+            time.sleep(0.02)
+            list(t({'id': i, 'name': str(i)}))
+        self.assertEqual(len(self._select()), 4)
+        self.assertEqual(dict(t.get_stats())['commit_size'], 100)
+
+    def test_max_commit_age(self):
+        t = DatabaseLoad(self.engine, 'customer', max_commit_age=0.05)
+        t.initialize()
+        self.assertEqual(len(list(t({'id': 2, 'name': 'bob'}))), 0)
+        self.assertEqual(t.idle(), None)
+        time.sleep(0.1)
+        self.assertEqual(len(list(t.idle() or ())), 1)
+        self.assertEqual(len(self._select()), 2)
+        self.assertRegexpMatches(dict(t.get_stats())['commits'], r'^<[0-9.]+s:1$')
+
+    def _test_savepoints(self, bulk):
+        # Let SQLAlchemy handle transactions, so that pysqlite supports savepoints.
+        event.listen(self.engine, 'connect', lambda dbapi_connection, record: setattr(
+            dbapi_connection, 'isolation_level', None
+        ))
+        event.listen(self.engine, 'begin', lambda connection: connection.execute('BEGIN'))
+        self.engine.dispose()
+        self._create_schema()
+
+        rows = [{'id': i, 'name': str(i) if not i in (3, 17, ) else None} for i in range(1, 21)]
+        t, out, errors = self._load(rows, bulk=bulk, savepoints=True)
+
+        self.assertEqual([row['id'] for row in out], [i for i in range(1, 21) if not i in (3, 17, )])
+        self.assertEqual([row['_input']['id'] for row in errors], [3, 17])
+        self.assertEqual(len(self._select()), 18)
+        self.assertEqual(self._stats(t)[1:], (17, 1))
+
+    def test_savepoints(self):
+        self._test_savepoints(bulk=False)
+
+    def test_bulk_savepoints(self):
+        self._test_savepoints(bulk=True)
+
+    def test_parallel_writers(self):
+        # Not in memory, so that each writer connection sees the same database.
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.engine = create_engine('sqlite:///' + path)
+        try:
+            self._create_schema()
+            rows = [{'id': i, 'name': str(i) if i != 42 else None} for i in range(100)]
+            t, out, errors = self._load(rows, writers=4, commit_size=10)
+
+            self.assertEqual(sorted(row['id'] for row in out), range(42) + range(43, 100))
+            self.assertEqual([row['_input']['id'] for row in errors], [42])
+            self.assertEqual([row[0] for row in self._select()], range(42) + range(43, 100))
+            self.assertEqual(self._stats(t)[1:], (98, 1))
+            self.assertEqual(len(t._writers), 4)
+            self.assertTrue(all(writer._output._special_stats[INSERT] for writer, queue, thread in t._writers))
+        finally:
+            self.engine.dispose()
+            os.unlink(path)
+
+    def _drain(self, results, out):
+        """Appends results to out, ignoring the error raised by a failed commit once its rows were yielded."""
+        try:
+            for row in results:
+                out.append(row)
+        except RuntimeError:
+            pass
+
+    def test_commit_failure(self):
+        t = FailingLoad(self.engine, 'customer', commit_size=3)
+        t.initialize()
+        out = []
+        for i in range(10, 16):
+            self._drain(t.transform(Hash((('id', i), ('name', str(i)), ))), out)
+        self._drain(t.finalize(), out)
+
+        # Rows of the failed batch are sent to STDERR, and not loaded again by the next flush.
+        self.assertEqual(sorted(row[0]['_input']['id'] for row in out if isinstance(row, tuple)), [10, 11, 12])
+        self.assertEqual(sorted(row['id'] for row in out if not isinstance(row, tuple)), [13, 14, 15])
+        self.assertEqual([row[0] for row in self._select()], [1, 13, 14, 15])
+
+    def test_parallel_writers_failure(self):
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.engine = create_engine('sqlite:///' + path)
+        try:
+            self._create_schema()
+            t = FailingLoad(self.engine, 'customer', writers=4, commit_size=10)
+            t.initialize()
+            self.assertTrue(all(writer.transform.__self__ is writer for writer, queue, thread in t._writers))
+
+            out = []
+            for i in range(100, 200):
+                self._drain(t.transform(Hash((('id', i), ('name', str(i)), ))), out)
+            # Finalize does not raise, so that downstream transforms get the end of the stream.
+            out.extend(t.finalize())
+
+            loaded = sorted(row['id'] for row in out if not isinstance(row, tuple))
+            failed = sorted(row[0]['_input']['id'] for row in out if isinstance(row, tuple))
+            # Only rows of the failed batch go to STDERR, other writers (and the failed one) go on loading.
+            self.assertIn(142, failed)
+            self.assertTrue(len(failed) <= 10)
+            self.assertEqual(sorted(loaded + failed), range(100, 200))
+            self.assertTrue(all(str(row[0]['_error']) == 'Connection lost.' for row in out if isinstance(row, tuple)))
+            self.assertEqual([row[0] for row in self._select()], [1] + loaded)
+            self.assertFalse(any(thread.is_alive() for writer, queue, thread in t._writers))
+            self.assertEqual(list(t.finalize()), [])
+        finally:
+            self.engine.dispose()
+            os.unlink(path)
+
+    def test_staging_load(self):
+        rows = [
+            {'id': 1, 'name': 'alicia', 'email': 'alicia@example.com'},
+            {'id': 2, 'name': 'bob'},
+            {'id': 3, 'name': 'carol'},
+            {'id': 2, 'name': 'bobby'},
+        ]
+        t, out, errors = self._load(rows, factory=DatabaseStagingLoad, insert_only_fields=('email', ),
+                                    fetch_columns={'customer_id': 'id'})
+
+        self.assertEqual(self._select(), [(1, 'alicia', 'alice@example.com'), (2, 'bobby', None), (3, 'carol', None)])
+        # The replaced row is not yielded.
+        self.assertEqual([(row['name'], row['customer_id']) for row in out],
+                         [('alicia', 1), ('carol', 3), ('bobby', 2)])
+        self.assertEqual(errors, [])
+        # One set-based merge for each set of columns, and one find to read fetch columns.
+        self.assertEqual(self._stats(t), (1, 2, 1))
+
+        created_at, updated_at = self.engine.execute('SELECT created_at, updated_at FROM customer WHERE id = 3').first()
+        self.assertIsNotNone(created_at)
+        self.assertIsNotNone(updated_at)
+
+    def test_staging_load_duplicate_key_across_columns(self):
+        # Rows with the same key and different sets of columns, the last one wins whatever its columns.
+        rows = [
+            {'id': 2, 'name': 'bob', 'email': 'bob@example.com'},
+            {'id': 3, 'name': 'carol'},
+            {'id': 2, 'name': 'bobby'},
+            {'id': 3, 'name': 'caroline', 'email': 'caroline@example.com'},
+        ]
+        t, out, errors = self._load(rows, factory=DatabaseStagingLoad)
+
+        self.assertEqual(self._select(), [(1, 'alice', 'alice@example.com'), (2, 'bobby', None),
+                                          (3, 'caroline', 'caroline@example.com')])
+        self.assertEqual([row['name'] for row in out], ['bobby', 'caroline'])
+        self.assertEqual(errors, [])
+        self.assertEqual(self._stats(t)[1:], (2, 0))
+
+    def test_staging_load_fallback(self):
+        t = self._test_load(bulk=False, factory=DatabaseStagingLoad)
+        # The merge failed on the NULL name, so the batch was loaded again row by row.
+        self.assertEqual(self._stats(t)[1:], (2, 2))
+
+    def test_staging_load_fallback_stats(self):
+        # Lookups done by the failed merge are not counted.
+        t = self._test_load(bulk=False, factory=DatabaseStagingLoad, skip_unchanged=True)
+        self.assertEqual(self._stats(t), (5, 2, 2))
+
+    def test_staging_load_positional_arguments(self):
+        t = DatabaseStagingLoad(self.engine, 'customer', ('id', ))
+        self.assertEqual(t.fetch_columns, {'id': 'id'})
+        self.assertEqual(t.staging_table_name, '_staging_customer')
+
+    def test_staging_table_reused(self):
+        # The in memory database pool keeps the same connection, as if a previous load did not drop its table.
+        self.engine.execute('CREATE TEMPORARY TABLE _staging_customer AS SELECT * FROM customer')
+        t, out, errors = self._load([{'id': 2, 'name': 'bob'}], factory=DatabaseStagingLoad)
+        self.assertEqual(errors, [])
+        # Loaded by the set-based merge, not by the row by row fallback (which would find each row first).
+        self.assertEqual(self._stats(t), (0, 1, 0))
+
+    def test_staging_load_allowed_operations(self):
+        t, out, errors = self._load([{'id': 1, 'name': 'alicia'}, {'id': 2, 'name': 'bob'}],
+                                    factory=DatabaseStagingLoad, allowed_operations=(UPDATE, ))
+        self.assertEqual([row['id'] for row in out], [1])
+        self.assertEqual([row['_input']['id'] for row in errors], [2])
+        self.assertEqual(self._select(), [(1, 'alicia', 'alice@example.com')])
+
+    def test_staging_table_dropped(self):
+        self._load([{'id': 2, 'name': 'bob'}], factory=DatabaseStagingLoad)
+        connection = self.engine.connect()
+        self.assertEqual(connection.execute("SELECT COUNT(*) FROM sqlite_temp_master WHERE type = 'table'").scalar(), 0)
+        connection.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012-2014 Romain Dorgueil
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+import unittest
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import StaticPool
+from rdc.etl.extra.db.sql import SqlExec
+from rdc.etl.hash import Hash
+from rdc.etl.io import STDIN
+from rdc.etl.job import Job
+from rdc.etl.transform import Transform
+from rdc.etl.transform.extract import Extract
+
+
+def delete_or_rename(hash, channel):
+    if hash['action'] == 'delete':
+        return 'DELETE FROM customer WHERE id = ?', hash['id']
+    if hash['action'] == 'rename':
+        return 'UPDATE customer SET name = ? WHERE id = ?', hash['name'], hash['id']
+
+
+class SqlExecTestCase(unittest.TestCase):
+    def setUp(self):
+        # The same in-memory database is used from job threads.
+        self.engine = create_engine('sqlite://', connect_args={'check_same_thread': False}, poolclass=StaticPool)
+        self.engine.execute('CREATE TABLE customer (id INTEGER PRIMARY KEY, name TEXT NOT NULL)')
+        for i in range(1, 7):
+            self.engine.execute('INSERT INTO customer VALUES (?, ?)', (i, 'customer %d' % (i, )))
+        self.calls = []
+        event.listen(self.engine, 'before_cursor_execute', lambda conn, cursor, statement, parameters, context,
+                     executemany: self.calls.append((statement.split()[0], executemany, )))
+
+    def _input(self):
+        return [Hash(row) for row in (
+            {'id': 1, 'action': 'delete'},
+            {'id': 2, 'action': 'rename', 'name': 'bob'},
+            {'id': 3, 'action': 'none'},
+            {'id': 4, 'action': 'delete'},
+            {'id': 5, 'action': 'rename', 'name': 'eve'},
+        )]
+
+    def _select(self):
+        return [tuple(row) for row in self.engine.execute('SELECT id, name FROM customer ORDER BY id')]
+
+    def _status(self, t, rows):
+        return [row.get(t.status_field) for row in rows]
+
+    def test_row_by_row(self):
+        t = SqlExec(delete_or_rename, self.engine)
+        out = list(t(*self._input()))
+        self.assertEqual(self._status(t, out), ['success', 'success', None, 'success', 'success'])
+        self.assertEqual(len(self.calls), 4)
+
+    def test_batch(self):
+        t = SqlExec(delete_or_rename, self.engine, batch_size=5)
+        t.initialize()
+        out = list(t(*self._input()))
+        self.assertEqual(list(t.finalize()), [])
+
+        self.assertEqual([row['id'] for row in out], [1, 2, 3, 4, 5])
+        self.assertEqual(self._status(t, out), ['success', 'success', None, 'success', 'success'])
+        # One executemany call by SQL text.
+        self.assertEqual(self.calls, [('DELETE', True), ('UPDATE', True)])
+        self.assertEqual(self._select(), [(2, 'bob'), (3, 'customer 3'), (5, 'eve'), (6, 'customer 6')])
+
+    def test_batch_failure(self):
+        rows = self._input()
+        rows[4]['name'] = None
+        t = SqlExec(delete_or_rename, self.engine, batch_size=10)
+        t.initialize()
+        self.assertEqual(list(t(*rows)), [])
+        # Failures are not raised, failed rows carry the failure status.
+        out = list(t.finalize())
+
+        # The whole UPDATE group failed, and was rolled back.
+        self.assertEqual(self._status(t, out), ['success', 'failure', None, 'success', 'failure'])
+        self.assertEqual(self._select(), [(2, 'customer 2'), (3, 'customer 3'), (5, 'customer 5'),
+                                          (6, 'customer 6')])
+
+    def test_batch_failure_job(self):
+        rows = self._input()
+        rows[4]['name'] = None
+        t, output = SqlExec(delete_or_rename, self.engine, batch_size=10), []
+        job = Job().add_chain(Extract(rows), t, Transform(lambda hash, channel: output.append(hash)))
+
+        # A failure in the last batch must not prevent the job (and downstream transforms) from finishing.
+        thread = threading.Thread(target=job)
+        thread.daemon = True
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self._status(t, output), ['success', 'failure', None, 'success', 'failure'])
+
+    def test_batch_statement_failure(self):
+        def statement(hash, channel):
+            if hash['id'] == 3:
+                raise KeyError('name')
+            return delete_or_rename(hash, channel)
+
+        t = SqlExec(statement, self.engine, batch_size=10)
+        t.initialize()
+        out = []
+        with self.assertRaises(KeyError):
+            for row in t(*self._input()):
+                out.append(row)
+
+        # Buffered rows were executed and yielded before the failing one.
+        self.assertEqual([row['id'] for row in out], [1, 2, 3])
+        self.assertEqual(self._status(t, out), ['success', 'success', 'failure'])
+
+    def test_max_latency(self):
+        t = SqlExec(delete_or_rename, self.engine, batch_size=100, max_latency=0.05)
+        t.initialize()
+        self.assertEqual(list(t.transform(Hash({'id': 1, 'action': 'delete'}), STDIN)), [])
+        self.assertIsNone(t.idle())
+        time.sleep(0.1)
+        self.assertEqual([row['id'] for row in t.idle()], [1])
+        self.assertEqual(list(t.finalize()), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012-2014 Romain Dorgueil
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError, TimeoutError
+from rdc.etl.extra.db.util import DbEnginePool, DbEngineThreadsafeWrapper, get_placeholder
+
+
+class DbEnginePoolTestCase(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        # Connections are shared between threads, and do not wait for locks so that the retry logic is exercised.
+        self.engine = create_engine('sqlite:///' + self.path, connect_args={'timeout': 0, 'check_same_thread': False})
+        self.engine.execute('CREATE TABLE t (id INTEGER)')
+
+    def tearDown(self):
+        self.engine.dispose()
+        os.unlink(self.path)
+
+    def test_connection_by_thread(self):
+        pool = DbEnginePool(self.engine, pool_size=2, max_overflow=2)
+        started, results = threading.Event(), []
+
+        def target():
+            # Assertions are made in the main thread, failures in workers would go unnoticed.
+            connection = pool.connection
+            count = pool.execute('SELECT COUNT(*) FROM t').scalar()
+            results.append((connection, pool.connection is connection, count, ))
+            started.wait(1)
+
+        threads = [threading.Thread(target=target) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        self.assertEqual(dict(pool.get_stats())['in_use'], 4)
+        started.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([(same, count) for connection, same, count in results], [(True, 0)] * 4)
+        self.assertEqual(len(set(id(connection) for connection, same, count in results)), 4)
+        # Connections of finished threads are reclaimed, and at most pool_size of them are kept open.
+        pool.execute('SELECT 1')
+        stats = dict(pool.get_stats())
+        self.assertEqual((stats['in_use'], stats['idle'], stats['peak']), (1, 1, 4))
+
+        pool.release()
+        self.assertEqual(dict(pool.get_stats())['idle'], 2)
+        pool.dispose()
+        self.assertEqual(dict(pool.get_stats())['size'], 0)
+
+    def test_timeout(self):
+        pool = DbEnginePool(self.engine, pool_size=1, max_overflow=0, timeout=0.2)
+        release = threading.Event()
+
+        def target():
+            pool.execute('SELECT 1')
+            release.wait(1)
+
+        thread = threading.Thread(target=target)
+        thread.start()
+        time.sleep(0.05)
+        self.assertRaises(TimeoutError, pool.execute, 'SELECT 1')
+        release.set()
+        thread.join()
+
+        self.assertEqual(pool.execute('SELECT 1').scalar(), 1)
+        self.assertEqual(dict(pool.get_stats())['waits'], 1)
+
+    def test_connect_failure(self):
+        pool = DbEnginePool(self.engine, pool_size=1, max_overflow=0, timeout=0.2)
+        connect, self.engine.connect = self.engine.connect, lambda: 1 / 0
+        try:
+            self.assertRaises(ZeroDivisionError, pool.execute, 'SELECT 1')
+        finally:
+            self.engine.connect = connect
+
+        # The reserved slot was given back, so the pool is not exhausted.
+        self.assertEqual(pool.execute('SELECT 1').scalar(), 1)
+        self.assertEqual(dict(pool.get_stats())['waits'], 0)
+
+    def _lock_database(self, duration):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.isolation_level = None
+        db.execute('BEGIN EXCLUSIVE')
+
+        def unlock():
+            time.sleep(duration)
+            db.execute('ROLLBACK')
+            db.close()
+
+        thread = threading.Thread(target=unlock)
+        thread.start()
+        return thread
+
+    def test_retry(self):
+        pool = DbEnginePool(self.engine, retries=20, retry_delay=0.05)
+        thread = self._lock_database(0.2)
+        pool.execute('INSERT INTO t VALUES (1)')
+        thread.join()
+
+        self.assertEqual(pool.execute('SELECT COUNT(*) FROM t').scalar(), 1)
+        self.assertTrue(dict(pool.get_stats())['retries'] > 0)
+
+    def test_no_retry(self):
+        pool = DbEnginePool(self.engine)
+        thread = self._lock_database(0.2)
+        try:
+            self.assertRaises(OperationalError, pool.execute, 'INSERT INTO t VALUES (1)')
+        finally:
+            thread.join()
+
+    def test_engine_attributes(self):
+        self.assertEqual(get_placeholder(DbEnginePool(self.engine)), '?')
+        self.assertEqual(get_placeholder(DbEngineThreadsafeWrapper(self.engine)), '?')
+
+        class Dialect(object):
+            paramstyle = 'format'
+
+        class Engine(object):
+            dialect = Dialect()
+
+        self.assertEqual(get_placeholder(DbEngineThreadsafeWrapper(Engine())), '%s')
+
+
+if __name__ == '__main__':
+    unittest.main()
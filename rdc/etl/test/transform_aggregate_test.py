@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012-2014 Romain Dorgueil
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from collections import OrderedDict
+
+import unittest
+from rdc.etl.extra.unittest import BaseTestCase
+from rdc.etl.transform.flow.aggregate import Aggregate, Aggregator, Avg, Collect, Count, First, Last, Max, Min, Sum
+
+INPUT_DATA = (
+    {'k': 'a', 'v': 1},
+    {'k': 'b', 'v': 10},
+    {'k': 'a', 'v': 3},
+    {'k': 'c', 'v': None},
+    {'k': 'b', 'v': 20},
+    {'k': 'a', 'v': 2},
+)
+
+AGGREGATIONS = (
+    ('count', Count()),
+    ('values', Count('v')),
+    ('sum', Sum('v')),
+    ('min', Min('v')),
+    ('max', Max('v')),
+    ('avg', Avg('v')),
+    ('first', First('v')),
+    ('last', Last('v')),
+    ('all', Collect('v')),
+)
+
+EXPECTED = (
+    OrderedDict((('k', 'a'), ('count', 3), ('values', 3), ('sum', 6), ('min', 1), ('max', 3), ('avg', 2.0),
+                 ('first', 1), ('last', 2), ('all', [1, 3, 2]), )),
+    OrderedDict((('k', 'b'), ('count', 2), ('values', 2), ('sum', 30), ('min', 10), ('max', 20), ('avg', 15.0),
+                 ('first', 10), ('last', 20), ('all', [10, 20]), )),
+    OrderedDict((('k', 'c'), ('count', 1), ('values', 0), ('sum', 0), ('min', None), ('max', None), ('avg', None),
+                 ('first', None), ('last', None), ('all', [None]), )),
+)
+
+
+class Product(Aggregator):
+    def initial(self):
+        return 1
+
+    def add(self, state, hash):
+        return state * hash[self.field]
+
+    def merge(self, state, other):
+        return state * other
+
+
+class TransformAggregateTestCase(BaseTestCase):
+    def _run(self, t, data):
+        t.initialize()
+        return list(t(*data)) + list(t.finalize())
+
+    def test_hash_aggregation(self):
+        t = Aggregate(('k', ), AGGREGATIONS)
+        self.assertStreamEqual(self._run(t, INPUT_DATA), EXPECTED)
+
+    def test_sorted_input_yields_groups_on_key_change(self):
+        t = Aggregate(('k', ), AGGREGATIONS, sorted=True)
+        t.initialize()
+        data = sorted(INPUT_DATA, key=lambda row: row['k'])
+
+        # group "a" is complete as soon as the first "b" comes in.
+        self.assertEqual(list(t(*data[0:3])), [])
+        self.assertStreamEqual(t(data[3]), EXPECTED[0:1])
+        self.assertStreamEqual(list(t(*data[4:])) + list(t.finalize()), EXPECTED[1:])
+
+    def test_spill(self):
+        t = Aggregate(('k', ), AGGREGATIONS, max_groups=1)
+        t.initialize()
+        list(t(*INPUT_DATA))
+        self.assertTrue(len(t._runs) > 1)
+        self.assertStreamEqual(t.finalize(), EXPECTED)
+
+    def test_aggregator_names_and_custom_aggregator(self):
+        t = Aggregate(('k', ), (('v', 'sum'), ('product', Product('v')), ))
+        self.assertStreamEqual(self._run(t, INPUT_DATA[0:3] + INPUT_DATA[4:]), (
+            OrderedDict((('k', 'a'), ('v', 6), ('product', 6), )),
+            OrderedDict((('k', 'b'), ('v', 30), ('product', 200), )),
+        ))
+
+
+if __name__ == '__main__':
+    unittest.main()
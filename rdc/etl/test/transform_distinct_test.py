@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012-2014 Romain Dorgueil
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from rdc.etl.extra.unittest import BaseTestCase
+from rdc.etl.sketch import BloomFilter
+from rdc.etl.transform.filter.distinct import Distinct, FingerprintSet, EXACT, SORTED, APPROXIMATE
+from rdc.etl.util import fingerprint
+
+INPUT_DATA = (
+    {'a': 1, 'b': 'x', 'n': 0},
+    {'a': 1, 'b': 'y', 'n': 1},
+    {'a': 1, 'b': 'x', 'n': 2},
+    {'a': 2, 'b': 'x', 'n': 3},
+    {'a': 2, 'b': 'x', 'n': 4},
+)
+
+
+class TransformDistinctTestCase(BaseTestCase):
+    def _run(self, t, data):
+        t.initialize()
+        return list(t(*data))
+
+    def test_exact(self):
+        t = Distinct(('a', 'b', ), mode=EXACT)
+        self.assertStreamEqual(self._run(t, INPUT_DATA), [INPUT_DATA[i] for i in (0, 1, 3)])
+        self.assertIn(('duplicates', 2), list(t.get_stats()))
+
+    def test_sorted(self):
+        t = Distinct(('a', ), mode=SORTED)
+        self.assertStreamEqual(self._run(t, INPUT_DATA), [INPUT_DATA[i] for i in (0, 3)])
+
+    def test_approximate(self):
+        t = Distinct(('a', 'b', ), mode=APPROXIMATE, capacity=100)
+        self.assertStreamEqual(self._run(t, INPUT_DATA), [INPUT_DATA[i] for i in (0, 1, 3)])
+
+    def test_fingerprint_set(self):
+        s = FingerprintSet(bucket_bits=2)
+        values = [fingerprint((i, )) for i in xrange(1000)]
+        self.assertTrue(all(s.add(v) for v in values))
+        self.assertFalse(any(s.add(v) for v in values))
+        self.assertEqual(len(s), 1000)
+        self.assertNotIn(fingerprint((1000, )), s)
+        # Fingerprints use the full signed 64 bits range.
+        for v in (-2 ** 63, 2 ** 63 - 1):
+            self.assertTrue(s.add(v))
+            self.assertIn(v, s)
+
+    def test_bloom_filter_error_rate(self):
+        bf = BloomFilter(10000, 0.01)
+        for i in xrange(10000):
+            bf.add(fingerprint((i, )))
+        false_positives = sum(1 for i in xrange(10000, 20000) if fingerprint((i, )) in bf)
+        self.assertTrue(false_positives < 200, false_positives)
+
+
+if __name__ == '__main__':
+    unittest.main()
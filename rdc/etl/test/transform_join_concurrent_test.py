@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012-2014 Romain Dorgueil
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+import unittest
+from rdc.etl.extra.unittest import BaseTestCase
+from rdc.etl.hash import Hash
+from rdc.etl.io import STDIN, STDERR
+from rdc.etl.transform.join.concurrent import ConcurrentJoin
+
+
+class SlowJoin(ConcurrentJoin):
+    def __init__(self, **kwargs):
+        super(SlowJoin, self).__init__(**kwargs)
+        self.lock = threading.Lock()
+        self.running = self.max_running = 0
+
+    def join(self, hash, channel=STDIN):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        # Later rows complete first.
+        time.sleep(0.01 * (5 - hash['n'] % 5))
+        with self.lock:
+            self.running -= 1
+        if hash['n'] == 13:
+            raise RuntimeError('Unlucky.')
+        return ({'square': hash['n'] ** 2}, ) if hash['n'] % 2 else ()
+
+    def run(self, *rows):
+        self.initialize()
+        out = list(self(*rows))
+        return out + list(self.finalize())
+
+
+class TransformConcurrentJoinTestCase(BaseTestCase):
+    def test_ordered(self):
+        t = SlowJoin(max_in_flight=4, is_outer=True)
+        out = t.run(*[{'n': n} for n in xrange(10)])
+
+        self.assertEqual([row['n'] for row in out], range(10))
+        self.assertEqual([row.get('square') for row in out], [n ** 2 if n % 2 else None for n in xrange(10)])
+        self.assertEqual(t.max_running, 4)
+
+        stats = dict(t.get_stats())
+        self.assertEqual(stats['in_flight'], 0)
+        self.assertTrue(stats['p50'].endswith('ms'))
+
+    def test_unordered(self):
+        t = SlowJoin(max_in_flight=5, ordered=False)
+        out = t.run(*[{'n': n} for n in xrange(10)])
+
+        self.assertEqual(sorted(row['n'] for row in out), [1, 3, 5, 7, 9])
+        self.assertNotEqual([row['n'] for row in out], [1, 3, 5, 7, 9])
+
+    def test_idle(self):
+        t = SlowJoin(max_in_flight=4)
+        t.initialize()
+        self.assertIsNone(t.idle())
+        self.assertEqual(list(t.transform(Hash(n=1))) + list(t.transform(Hash(n=3))), [])
+
+        # Completed calls are released without waiting for the next input row.
+        time.sleep(0.2)
+        self.assertEqual([row['square'] for row in t.idle()], [1, 9])
+        self.assertIsNone(t.idle())
+        self.assertEqual(list(t.finalize()), [])
+
+    def _test_error(self, max_in_flight):
+        t = SlowJoin(max_in_flight=max_in_flight)
+        out = t.run(*[{'n': n} for n in xrange(20)])
+
+        self.assertEqual([row['n'] for row in out if not isinstance(row, tuple)], [1, 3, 5, 7, 9, 11, 15, 17, 19])
+        errors = [row for row in out if isinstance(row, tuple)]
+        self.assertEqual([(row[0]['_input']['n'], row[1]) for row in errors], [(13, STDERR)])
+        self.assertIsInstance(errors[0][0]['_error'], RuntimeError)
+        # The error row is released in order.
+        self.assertEqual(out.index(errors[0]), 6)
+
+    def test_error(self):
+        self._test_error(max_in_flight=4)
+
+    def test_error_in_finalize(self):
+        # All rows are still in flight when finalize starts draining.
+        self._test_error(max_in_flight=32)
+
+if __name__ == '__main__':
+    unittest.main()
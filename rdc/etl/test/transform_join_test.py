@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012-2014 Romain Dorgueil
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import unittest
+from collections import OrderedDict
+from rdc.etl.extra.unittest import BaseTestCase
+from rdc.etl.io import STDIN
+from rdc.etl.transform.join import Join
+
+COUNTRIES = {
+    'fr': ({'country': 'France'}, ),
+    'de': ({'country': 'Germany'}, ),
+}
+
+
+class CountryJoin(Join):
+    def __init__(self, **kwargs):
+        super(CountryJoin, self).__init__(**kwargs)
+        self.calls = []
+
+    def join(self, hash, channel=STDIN):
+        self.calls.append(hash['code'])
+        return COUNTRIES.get(hash['code'], ())
+
+
+class TransformJoinTestCase(BaseTestCase):
+    def test_cache(self):
+        t = CountryJoin(cache_key=('code', ), is_outer=True)
+        codes = ('fr', 'de', 'fr', 'xx', 'xx', )
+        out = list(t(*[OrderedDict((('code', code), ('n', n), )) for n, code in enumerate(codes, 1)]))
+
+        self.assertStreamEqual(out, (
+            OrderedDict((('code', 'fr'), ('n', 1), ('country', 'France'), )),
+            OrderedDict((('code', 'de'), ('n', 2), ('country', 'Germany'), )),
+            OrderedDict((('code', 'fr'), ('n', 3), ('country', 'France'), )),
+            OrderedDict((('code', 'xx'), ('n', 4), )),
+            OrderedDict((('code', 'xx'), ('n', 5), )),
+        ))
+        self.assertEqual(t.calls, ['fr', 'de', 'xx'])
+        stats = dict(t.get_stats())
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (2, 3, 0))
+
+    def test_no_negative_cache(self):
+        t = CountryJoin(cache_key=('code', ), cache_negative=False)
+        self.assertEqual(len(list(t({'code': 'xx'}, {'code': 'xx'}, {'code': 'fr'}, {'code': 'fr'}))), 2)
+        self.assertEqual(t.calls, ['xx', 'xx', 'fr'])
+
+    def test_lru_eviction(self):
+        t = CountryJoin(cache_key=('code', ), cache_size=1)
+        list(t({'code': 'fr'}, {'code': 'de'}, {'code': 'fr'}, {'code': 'fr'}))
+        self.assertEqual(t.calls, ['fr', 'de', 'fr'])
+        self.assertEqual(dict(t.get_stats())['evictions'], 2)
+
+    def test_ttl(self):
+        t = CountryJoin(cache_key=('code', ), cache_ttl=0.05)
+        list(t({'code': 'fr'}, {'code': 'fr'}))
+        time.sleep(0.1)
+        list(t({'code': 'fr'}))
+        self.assertEqual(t.calls, ['fr', 'fr'])
+
+    def test_no_cache_by_default(self):
+        t = CountryJoin()
+        list(t({'code': 'fr'}, {'code': 'fr'}))
+        self.assertEqual(t.calls, ['fr', 'fr'])
+        self.assertNotIn('hits', dict(t.get_stats()))
+
+
+if __name__ == '__main__':
+    unittest.main()
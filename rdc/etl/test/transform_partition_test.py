@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012-2014 Romain Dorgueil
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from rdc.etl.hash import Hash
+from rdc.etl.job import Job
+from rdc.etl.transform import Transform
+from rdc.etl.transform.extract import Extract
+from rdc.etl.transform.flow.partition import Partition
+
+INPUT_DATA = [{'id': i, 'v': i % 7} for i in xrange(100)]
+
+
+class TransformPartitionTestCase(unittest.TestCase):
+    def test_hash_partitioning_is_stable(self):
+        t = Partition(('v', ), 4)
+        self.assertEqual(t.OUTPUT_CHANNELS, (0, 1, 2, 3, -1, ))
+
+        routes = {}
+        for hash, channel in t(*INPUT_DATA):
+            self.assertEqual(routes.setdefault(hash['v'], channel), channel)
+        self.assertEqual(routes, dict((v, Partition(('v', ), 4).select_output(Hash(v=v))) for v in xrange(7)))
+
+    def test_range_partitioning(self):
+        t = Partition(('id', ), boundaries=(10, 50))
+        self.assertEqual(t.n, 3)
+        self.assertEqual([t.select_output(Hash(id=i)) for i in (0, 9, 10, 49, 50, 99)], [0, 0, 1, 1, 2, 2])
+
+        t = Partition(('a', 'b', ), boundaries=((1, 'm'), ))
+        self.assertEqual([t.select_output(Hash(a=a, b=b)) for a, b in ((0, 'z'), (1, 'a'), (1, 'm'), (2, 'a'))],
+                         [0, 0, 1, 1])
+
+        self.assertRaises(ValueError, Partition, ('id', ), 2, (10, 50))
+        self.assertRaises(ValueError, Partition, ('id', ))
+
+    def test_harness(self):
+        partition = Partition(('v', ), 3)
+        outputs = dict((i, []) for i in xrange(3))
+
+        job = Job().add_chain(Extract(INPUT_DATA), partition)
+        for i in xrange(3):
+            job.add_chain(Transform(lambda hash, channel, output=outputs[i]: output.append(hash)), input=(partition, i))
+        job()
+
+        self.assertEqual(sorted(h['id'] for i in xrange(3) for h in outputs[i]), range(100))
+        stats = dict(partition.get_stats())
+        self.assertEqual([stats['partition_%d' % (i, )] for i in xrange(3)], [len(outputs[i]) for i in xrange(3)])
+
+    def test_stats_names(self):
+        # Partition channels 10 to 13 are not confused with insert, update, upsert and unchanged special channels.
+        t = Partition(('v', ), 14)
+        for row in t(*[Hash(v=v) for v in xrange(100)]):
+            t._output.put(row)
+        stats = dict(t.get_stats())
+        self.assertEqual(sorted(name for name in stats if name.startswith('partition_')),
+                         sorted('partition_%d' % (i, ) for i in xrange(14)))
+        self.assertFalse(set(('insert', 'update', 'upsert', 'unchanged', )) & set(stats))
+        self.assertEqual(sum(stats['partition_%d' % (i, )] for i in xrange(14)), 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
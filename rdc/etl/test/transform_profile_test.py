@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012-2014 Romain Dorgueil
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from rdc.etl.sketch import HyperLogLog, QuantileSketch
+from rdc.etl.transform.profile import Profile
+from rdc.etl.util import fingerprint
+
+INPUT_DATA = [{'id': i, 'even': i % 2 == 0 or None} for i in xrange(20000)]
+
+
+class TransformProfileTestCase(unittest.TestCase):
+    def _profile(self, data, **kwargs):
+        t = Profile(**kwargs)
+        t.initialize()
+        list(t(*data))
+        return dict((summary['field'], summary) for summary in t.finalize())
+
+    def test_profile(self):
+        summaries = self._profile(INPUT_DATA + [{'late': 'x'}])
+
+        self.assertEqual(sorted(summaries), ['even', 'id', 'late'])
+        self.assertEqual(summaries['id']['rows'], 20001)
+        self.assertEqual(summaries['id']['nulls'], 1)
+        self.assertEqual((summaries['id']['min'], summaries['id']['max']), (0, 19999))
+        self.assertTrue(abs(summaries['id']['distinct'] - 20000) < 600, summaries['id']['distinct'])
+        self.assertTrue(abs(summaries['id']['p50'] - 10000) < 400, summaries['id']['p50'])
+        self.assertTrue(abs(summaries['id']['p99'] - 19800) < 400, summaries['id']['p99'])
+        self.assertEqual(summaries['even']['null_ratio'], 10001 / 20001.0)
+        self.assertEqual(summaries['even']['distinct'], 1)
+        self.assertEqual((summaries['late']['rows'], summaries['late']['nulls']), (20001, 20000))
+
+    def test_merge_replicas(self):
+        replicas = [self._profile(INPUT_DATA[i::3], fields=('id', )) for i in xrange(3)]
+
+        t = Profile()
+        t.initialize()
+        list(t(*[replica['id'] for replica in replicas]))
+        merged = list(t.finalize())
+
+        self.assertEqual(len(merged), 1)
+        self.assertEqual((merged[0]['field'], merged[0]['rows'], merged[0]['min'], merged[0]['max']),
+                         ('id', 20000, 0, 19999))
+        self.assertTrue(abs(merged[0]['distinct'] - 20000) < 600, merged[0]['distinct'])
+        self.assertTrue(abs(merged[0]['p50'] - 10000) < 400, merged[0]['p50'])
+
+    def test_new_field_after_merge(self):
+        replica = self._profile(INPUT_DATA[:10])
+
+        t = Profile()
+        t.initialize()
+        list(t(replica['id'], replica['even'], {'id': 10, 'late': 'x'}))
+        merged = dict((summary['field'], summary) for summary in t.finalize())
+
+        self.assertEqual(merged['id']['rows'], 11)
+        self.assertEqual((merged['even']['rows'], merged['even']['nulls']), (11, 6))
+        # The new field was null in the 10 merged rows.
+        self.assertEqual((merged['late']['rows'], merged['late']['nulls']), (11, 10))
+
+    def test_sketches_are_bounded(self):
+        hll, qs = HyperLogLog(), QuantileSketch()
+        for i in xrange(100000):
+            hll.add(fingerprint((i, )))
+            qs.add(i)
+        self.assertEqual(len(hll.registers), 16384)
+        self.assertTrue(sum(len(compactor) for compactor in qs.compactors) < 3 * qs.k)
+        self.assertTrue(abs(hll.cardinality() - 100000) < 3000, hll.cardinality())
+        self.assertTrue(abs(qs.quantile(0.9) - 90000) < 2000, qs.quantile(0.9))
+
+
+if __name__ == '__main__':
+    unittest.main()
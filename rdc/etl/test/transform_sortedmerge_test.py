@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012-2014 Romain Dorgueil
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from rdc.etl.io import Begin, End
+from rdc.etl.job import Job
+from rdc.etl.transform import Transform
+from rdc.etl.transform.extract import Extract
+from rdc.etl.transform.flow.aggregate import Aggregate, Count
+from rdc.etl.transform.flow.sortedmerge import SortedMerge
+
+
+class TransformSortedMergeTestCase(unittest.TestCase):
+    def _ids(self, stream):
+        return [(h['id'], h['src']) for h in stream]
+
+    def test_waits_for_all_channels(self):
+        t = SortedMerge(('id', ), inputs=3)
+        t.initialize()
+        for channel in t.INPUT_CHANNELS:
+            t._input[channel].put(Begin)
+
+        self.assertEqual(self._ids(t({'id': 1, 'src': 0}, {'id': 4, 'src': 0}, channel=0)), [])
+        self.assertEqual(self._ids(t({'id': 2, 'src': 1}, channel=1)), [])
+        self.assertEqual(self._ids(t({'id': 3, 'src': 2}, channel=2)), [(1, 0), (2, 1)])
+        stats = dict(t.get_stats())
+        self.assertEqual((stats['buffered'], stats['peak_buffered']), (2, 4))
+
+        # channel 1 is finished, so only channel 0 can block the merge now.
+        t._input[1].put(End)
+        self.assertEqual(self._ids(t({'id': 5, 'src': 2}, channel=2)), [(3, 2), (4, 0)])
+
+        self.assertEqual(self._ids(t.finalize()), [(5, 2)])
+        self.assertEqual(dict(t.get_stats())['buffered'], 0)
+
+    def test_unsorted_input(self):
+        t = SortedMerge(('id', ), inputs=2)
+        t.initialize()
+        list(t({'id': 2}, channel=0))
+        self.assertRaises(ValueError, list, t({'id': 1}, channel=0))
+
+    def test_harness(self):
+        merge = SortedMerge(('id', ), inputs=3)
+        aggregate = Aggregate(('id', ), (('n', Count()), ), sorted=True)
+        output = []
+
+        job = Job()
+        for channel, ids in enumerate(((1, 3, 5, 7, 9, 11), (2, 3, 4), (), )):
+            job.add_chain(Extract([{'id': id} for id in ids]), output=(merge, channel))
+        job.add_chain(merge, aggregate, Transform(lambda hash, channel: output.append(hash)))
+        job()
+
+        self.assertEqual([(h['id'], h['n']) for h in output],
+                         [(1, 1), (2, 1), (3, 2), (4, 1), (5, 1), (7, 1), (9, 1), (11, 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
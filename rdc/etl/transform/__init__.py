@@ -16,6 +16,7 @@
 
 import itertools
 import types
+from Queue import Empty
 from abc import ABCMeta, abstractmethod
 from rdc.etl import H
 from rdc.etl.error import AbstractError
@@ -93,8 +94,12 @@ class Transform(ITransform, Statisticable):
             if not isinstance(hash, Hash):
                 hash = Hash(hash)
 
-            for line in self.transform(hash, channel):
-                yield line
+            results = self.transform(hash, channel)
+
+            # Same as in the harness, a transform can return None if it has nothing to yield for this row.
+            if results is not None:
+                for line in results:
+                    yield line
 
     # ITransform implementation
 
@@ -116,7 +121,14 @@ class Transform(ITransform, Statisticable):
 
         try:
             # Pull data from the first available input channel (blocking)
-            data, channel = self._input.get(timeout=1)
+            try:
+                data, channel = self._input.get(timeout=1)
+            except Empty:
+                # Nothing to transform for now, but buffered data may need to be flushed.
+                results = self.idle()
+                if results is not None:
+                    self.__execute_and_handle_output(lambda: results)
+                raise
             # Execute actual transformation
             try:
                 self.__execute_and_handle_output(self.transform, data, channel)
@@ -142,6 +154,11 @@ class Transform(ITransform, Statisticable):
         buffering transformations, or other blocking types."""
         pass
 
+    def idle(self):
+        """Called when no input came for a while (about a second), so that buffering transformations can flush
+        their buffer on a timer even if input is slow. Can yield output like transform."""
+        pass
+
     @property
     def virgin(self):
         """Whether or not this transformation already contains a yucca (spéciale dédicace)."""
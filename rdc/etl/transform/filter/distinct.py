@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012-2014 Romain Dorgueil
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from array import array
+from bisect import bisect_left
+from rdc.etl.io import STDIN
+from rdc.etl.sketch import BloomFilter
+from rdc.etl.transform.filter import Filter
+from rdc.etl.util import fingerprint
+
+EXACT = 'exact'
+SORTED = 'sorted'
+APPROXIMATE = 'approximate'
+
+
+def _get_int64_typecode():
+    """Array typecode of signed 64 bits integers, or None if the platform has none (python 2 has no 'q', and 'l' is
+    only 32 bits on some platforms)."""
+    for typecode in ('q', 'l', ):
+        try:
+            if array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:
+            pass
+
+_INT64_TYPECODE = _get_int64_typecode()
+
+
+class FingerprintSet(object):
+    """Set of 64 bits integers, stored as sorted machine integers arrays (8 bytes per item instead of ~60 for a
+    python set of ints). Items are spread over 2**bucket_bits buckets on their low bits, so insertion only moves a
+    small array. On platforms without a 64 bits array typecode, buckets are lists (correct, but not compact).
+
+    """
+
+    def __init__(self, bucket_bits=16):
+        self._mask = (1 << bucket_bits) - 1
+        self._buckets = [None] * (1 << bucket_bits)
+        self._len = 0
+
+    def add(self, fingerprint):
+        """Adds a fingerprint, returns False if it was already there."""
+        bucket = self._buckets[fingerprint & self._mask]
+        if bucket is None:
+            bucket = self._buckets[fingerprint & self._mask] = array(_INT64_TYPECODE) if _INT64_TYPECODE else []
+
+        i = bisect_left(bucket, fingerprint)
+        if i < len(bucket) and bucket[i] == fingerprint:
+            return False
+
+        bucket.insert(i, fingerprint)
+        self._len += 1
+        return True
+
+    def __contains__(self, fingerprint):
+        bucket = self._buckets[fingerprint & self._mask]
+        if bucket is None:
+            return False
+        i = bisect_left(bucket, fingerprint)
+        return i < len(bucket) and bucket[i] == fingerprint
+
+    def __len__(self):
+        return self._len
+
+
+class Distinct(Filter):
+    """
+    Only let the first row of each distinct :attr:`key` pass through.
+
+    :attr:`key`
+        A tuple of keys that define row identity.
+
+    :attr:`mode`
+        How seen keys are remembered. Memory usage for 10 millions distinct keys is given as an order of magnitude.
+
+        - ``exact`` (default): 64 bits fingerprints of the key values are kept in a compact set. About 90 MB for 10M
+          keys. Two different keys could only be mistaken if their fingerprints collide, which is roughly one chance
+          in 370000 for 10M keys.
+        - ``sorted``: input is supposed to be sorted on :attr:`key` (or at least, duplicates are supposed to be
+          consecutive). Only the last key is kept, constant memory.
+        - ``approximate``: fingerprints are added to a bloom filter sized for :attr:`capacity` keys. A row can be
+          wrongly considered as a duplicate (and dropped) with a probability of :attr:`error_rate`, but a duplicate
+          will never pass. About 12 MB for 10M keys at 1%, 18 MB at 0.1%. If more than :attr:`capacity` keys are
+          seen, error rate will grow.
+
+    :attr:`error_rate`
+        Target false positive rate in approximate mode.
+
+    :attr:`capacity`
+        Expected number of distinct keys in approximate mode.
+
+    Example::
+
+        >>> from rdc.etl.transform.filter.distinct import Distinct
+
+        >>> t = Distinct(('id', ))
+        >>> t.initialize()
+        >>> list(t({'id': 1, 'v': 'a'}, {'id': 2, 'v': 'b'}, {'id': 1, 'v': 'c'}))
+        [H{'id': 1, 'v': 'a'}, H{'id': 2, 'v': 'b'}]
+
+    """
+
+    key = ()
+    mode = EXACT
+    error_rate = 0.01
+    capacity = 10000000
+
+    def __init__(self, key=None, mode=None, error_rate=None, capacity=None):
+        super(Distinct, self).__init__()
+
+        self.key = key or self.key
+        self.mode = mode or self.mode
+        self.error_rate = error_rate or self.error_rate
+        self.capacity = capacity or self.capacity
+
+        if not self.mode in (EXACT, SORTED, APPROXIMATE, ):
+            raise ValueError('Unknown distinct mode %r.' % (self.mode, ))
+
+        self._duplicates = 0
+
+    def initialize(self):
+        super(Distinct, self).initialize()
+
+        self._last = None
+        self._duplicates = 0
+        if self.mode == EXACT:
+            self._seen = FingerprintSet()
+        elif self.mode == APPROXIMATE:
+            self._seen = BloomFilter(self.capacity, self.error_rate)
+
+    def filter(self, hash, channel=STDIN):
+        key = hash.get_values(self.key)
+
+        if self.mode == SORTED:
+            is_new = self._last is None or key != self._last
+            self._last = key
+        else:
+            is_new = self._seen.add(fingerprint(key))
+
+        if not is_new:
+            self._duplicates += 1
+        return is_new
+
+    def get_local_stats(self, debug=False, profile=False):
+        return (
+            ('duplicates', self._duplicates, ),
+        ) + tuple(super(Distinct, self).get_local_stats(debug=debug, profile=profile))
@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012-2014 Romain Dorgueil
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import cPickle
+import heapq
+import tempfile
+from collections import OrderedDict
+from rdc.etl.error import AbstractError
+from rdc.etl.hash import Hash
+from rdc.etl.io import STDIN
+from rdc.etl.transform import Transform
+
+
+class Aggregator(object):
+    """Base class for incremental aggregators.
+
+    An aggregator never sees more than one row at a time. It works on a "state", created by :meth:`initial`, updated
+    for each row of the group by :meth:`add`, and turned into the final value by :meth:`result`. When partial states
+    have been computed separately (for example, spilled to disk by :class:`Aggregate`), :meth:`merge` combines them,
+    the first argument being always the oldest one.
+
+    States must be picklable.
+
+    """
+
+    def __init__(self, field=None):
+        self.field = field
+
+    def initial(self):
+        return None
+
+    def add(self, state, hash):
+        raise AbstractError(self.add)
+
+    def merge(self, state, other):
+        raise AbstractError(self.merge)
+
+    def result(self, state):
+        return state
+
+
+class Count(Aggregator):
+    """Number of rows in group, or number of non-null values if a field is given."""
+
+    def initial(self):
+        return 0
+
+    def add(self, state, hash):
+        if self.field is None or hash.get(self.field) is not None:
+            return state + 1
+        return state
+
+    def merge(self, state, other):
+        return state + other
+
+
+class Sum(Aggregator):
+    def initial(self):
+        return 0
+
+    def add(self, state, hash):
+        value = hash.get(self.field)
+        if value is None:
+            return state
+        return state + value
+
+    def merge(self, state, other):
+        return state + other
+
+
+class Min(Aggregator):
+    def add(self, state, hash):
+        return self.merge(state, hash.get(self.field))
+
+    def merge(self, state, other):
+        if state is None:
+            return other
+        if other is None:
+            return state
+        return min(state, other)
+
+
+class Max(Aggregator):
+    def add(self, state, hash):
+        return self.merge(state, hash.get(self.field))
+
+    def merge(self, state, other):
+        if state is None:
+            return other
+        if other is None:
+            return state
+        return max(state, other)
+
+
+class Avg(Aggregator):
+    """Arithmetic mean of non-null values, None for a group without values."""
+
+    def initial(self):
+        return 0, 0
+
+    def add(self, state, hash):
+        value = hash.get(self.field)
+        if value is None:
+            return state
+        return state[0] + value, state[1] + 1
+
+    def merge(self, state, other):
+        return state[0] + other[0], state[1] + other[1]
+
+    def result(self, state):
+        if not state[1]:
+            return None
+        return state[0] / float(state[1])
+
+
+class First(Aggregator):
+    def initial(self):
+        return ()
+
+    def add(self, state, hash):
+        return state or (hash.get(self.field), )
+
+    def merge(self, state, other):
+        return state or other
+
+    def result(self, state):
+        return state[0] if state else None
+
+
+class Last(Aggregator):
+    def initial(self):
+        return ()
+
+    def add(self, state, hash):
+        return (hash.get(self.field), )
+
+    def merge(self, state, other):
+        return other or state
+
+    def result(self, state):
+        return state[0] if state else None
+
+
+class Collect(Aggregator):
+    """List of all the values of the group, in input order."""
+
+    def initial(self):
+        return []
+
+    def add(self, state, hash):
+        state.append(hash.get(self.field))
+        return state
+
+    def merge(self, state, other):
+        return state + other
+
+
+AGGREGATORS = {
+    'count': Count,
+    'sum': Sum,
+    'min': Min,
+    'max': Max,
+    'avg': Avg,
+    'first': First,
+    'last': Last,
+    'collect': Collect,
+}
+
+
+class Aggregate(Transform):
+    """
+    Group rows by :attr:`key` and compute one output row per group, using incremental aggregators. Only one state per
+    aggregation and per group is kept in memory, never the rows themselves.
+
+    :attr:`key`
+        A tuple of keys on which to group data. They will be copied to the output rows.
+
+    :attr:`aggregations`
+        An ordered sequence (or dict) of ``(output_field, aggregator)`` pairs. Aggregator can be an
+        :class:`Aggregator` instance (count, sum, min, max, avg, first, last, collect or your own subclass), or the
+        name of a builtin aggregator, in which case it will work on the field named like the output field.
+
+    :attr:`sorted`
+        If true, input is supposed to be sorted on :attr:`key` (for example by a DatabaseExtract with an ORDER BY
+        clause, or a SortedJoin), and each group is yielded as soon as the key changes. Memory usage is then limited to
+        one group.
+
+    :attr:`max_groups`
+        In unsorted mode, maximum number of groups to keep in memory. When exceeded, partial aggregates are spilled
+        to a temporary file, and merged back in :meth:`finalize`. Output is sorted on :attr:`key` if anything has been
+        spilled, it follows the first appearance of each key otherwise.
+
+    Example::
+
+        >>> from rdc.etl.transform.flow.aggregate import Aggregate, Count
+
+        >>> t = Aggregate(('color', ), (('n', Count()), ('weight', 'sum'), ))
+        >>> t.initialize()
+        >>> _ = list(t(
+        ...     {'color': 'red', 'weight': 2},
+        ...     {'color': 'blue', 'weight': 3},
+        ...     {'color': 'red', 'weight': 5},
+        ... ))
+        >>> list(t.finalize())
+        [H{'color': 'red', 'n': 2, 'weight': 7}, H{'color': 'blue', 'n': 1, 'weight': 3}]
+
+    """
+
+    key = ()
+    aggregations = ()
+    sorted = False
+    max_groups = None
+
+    def __init__(self, key=None, aggregations=None, sorted=None, max_groups=None):
+        super(Aggregate, self).__init__()
+
+        self.key = key or self.key
+        self.aggregations = self._get_aggregators(aggregations or self.aggregations)
+        self.sorted = sorted or self.sorted
+        self.max_groups = max_groups or self.max_groups
+
+        self._groups = OrderedDict()
+        self._runs = []
+
+    def initialize(self):
+        super(Aggregate, self).initialize()
+        self._groups = OrderedDict()
+        self._runs = []
+
+    def transform(self, hash, channel=STDIN):
+        key = tuple(hash.get_values(self.key))
+
+        if not key in self._groups:
+            # Sorted input, a new key means the previous group is complete.
+            if self.sorted:
+                for row in self.flush():
+                    yield row
+            self._groups[key] = [aggregator.initial() for name, aggregator in self.aggregations]
+
+        states = self._groups[key]
+        for i, (name, aggregator) in enumerate(self.aggregations):
+            states[i] = aggregator.add(states[i], hash)
+
+        if not self.sorted and self.max_groups and len(self._groups) > self.max_groups:
+            self.spill()
+
+    def finalize(self):
+        super(Aggregate, self).finalize()
+
+        if len(self._runs):
+            for row in self.merge_runs():
+                yield row
+        else:
+            for row in self.flush():
+                yield row
+
+    def flush(self):
+        """Yields all groups currently in memory, and forget about them."""
+        for key, states in self._groups.iteritems():
+            yield self.build(key, states)
+        self._groups.clear()
+
+    def spill(self):
+        """Writes the in-memory partial aggregates to a temporary file, sorted on key."""
+        run = tempfile.TemporaryFile()
+        for key in sorted(self._groups):
+            cPickle.dump((key, self._groups[key], ), run, cPickle.HIGHEST_PROTOCOL)
+        run.seek(0)
+        self._runs.append(run)
+        self._groups.clear()
+
+    def merge_runs(self):
+        """Merges spilled runs and in-memory groups, yielding one row per key in key order."""
+        self.spill()
+
+        iterators = [self._read_run(i, run) for i, run in enumerate(self._runs)]
+        current_key, current_states = None, None
+        for (key, i), states in heapq.merge(*iterators):
+            if current_states is not None and key == current_key:
+                current_states = [
+                    aggregator.merge(state, other)
+                    for (name, aggregator), state, other in zip(self.aggregations, current_states, states)
+                ]
+                continue
+
+            if current_states is not None:
+                yield self.build(current_key, current_states)
+            current_key, current_states = key, states
+
+        if current_states is not None:
+            yield self.build(current_key, current_states)
+
+        for run in self._runs:
+            run.close()
+        self._runs = []
+
+    def build(self, key, states):
+        """Creates the output row of a group."""
+        hash = Hash(zip(self.key, key))
+        for (name, aggregator), state in zip(self.aggregations, states):
+            hash[name] = aggregator.result(state)
+        return hash
+
+    def get_local_stats(self, debug=False, profile=False):
+        return (
+            ('groups', len(self._groups), ),
+            ('spilled', len(self._runs), ),
+        ) + tuple(super(Aggregate, self).get_local_stats(debug=debug, profile=profile))
+
+    @staticmethod
+    def _read_run(i, run):
+        # Run index is part of the sort key so that equal keys are merged in chronological order, and states are
+        # never compared.
+        while True:
+            try:
+                key, states = cPickle.load(run)
+            except EOFError:
+                return
+            yield (key, i, ), states
+
+    @staticmethod
+    def _get_aggregators(aggregations):
+        if isinstance(aggregations, dict):
+            aggregations = aggregations.items()
+
+        return tuple(
+            (name, aggregator if isinstance(aggregator, Aggregator) else AGGREGATORS[aggregator](name), )
+            for name, aggregator in aggregations
+        )
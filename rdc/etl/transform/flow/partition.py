@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012-2014 Romain Dorgueil
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from bisect import bisect_right
+from rdc.etl.io import STDIN, STDERR
+from rdc.etl.transform import Transform
+from rdc.etl.util import fingerprint
+
+
+class Partition(Transform):
+    """
+    Routes each input row to one of `n` output channels, numbered from 0 to n-1 (0, 1 and 2 being STDOUT, STDOUT2 and
+    STDOUT3), so the stream can be processed by parallel chains. Rows with the same :attr:`key` always go to the same
+    channel, and per-channel row counts are available in the transform statistics (partition_0, partition_1, ...).
+
+    :attr:`key`
+        A tuple of keys on which to partition data.
+
+    :attr:`n`
+        Number of partitions, for hash partitioning. The channel is chosen using a stable fingerprint of the key
+        values (see :func:`rdc.etl.util.fingerprint`), so it does not change from one run to another.
+
+    :attr:`boundaries`
+        Sorted sequence of key values, for range partitioning. Rows with a key lower than the first boundary go to
+        channel 0, rows with a key between the first (included) and the second (excluded) boundaries to channel 1,
+        etc. There are len(boundaries) + 1 partitions. With a composite key, boundaries are tuples.
+
+    Example::
+
+        >>> from rdc.etl.job import Job
+        >>> from rdc.etl.transform import Transform
+        >>> from rdc.etl.transform.flow.partition import Partition
+
+        >>> partition = Partition(('customer_id', ), 3)
+        >>> job = Job().add_chain(Transform(), partition)
+        >>> for i in range(3):
+        ...     _ = job.add_chain(Transform(), input=(partition, i))
+
+    """
+
+    key = ()
+    n = None
+    boundaries = None
+
+    def __init__(self, key=None, n=None, boundaries=None):
+        self.key = key or self.key
+        self.n = n or self.n
+        self.boundaries = boundaries or self.boundaries
+
+        if self.boundaries is not None:
+            self.boundaries = list(self.boundaries)
+            if self.n is not None and self.n != len(self.boundaries) + 1:
+                raise ValueError('Inconsistent partition count %r for %d boundaries.' % (self.n, len(self.boundaries)))
+            self.n = len(self.boundaries) + 1
+        elif not self.n or self.n < 1:
+            raise ValueError('Partition needs either a positive partition count or range boundaries.')
+
+        super(Partition, self).__init__(output_channels=tuple(range(self.n)) + (STDERR, ))
+
+        # Own names, as partition numbers would clash with the special channel names (insert, update...) otherwise.
+        self._output.names.update((i, 'partition_%d' % (i, ), ) for i in range(self.n))
+
+    def select_output(self, hash):
+        values = hash.get_values(self.key)
+
+        if self.boundaries is None:
+            return fingerprint(values) % self.n
+
+        return bisect_right(self.boundaries, values[0] if len(values) == 1 else tuple(values))
+
+    def transform(self, hash, channel=STDIN):
+        yield hash, self.select_output(hash)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012-2014 Romain Dorgueil
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import heapq
+from collections import deque
+from rdc.etl.io import STDIN
+from rdc.etl.transform import Transform
+
+
+class SortedMerge(Transform):
+    """
+    Merges N input channels, each of them sorted on :attr:`key`, into one output stream sorted on the same key (a
+    k-way merge using a heap). Output can be fed directly into transforms expecting sorted data, like SortedJoin or a
+    sorted Aggregate, without the need of a global Sort.
+
+    A row is only yielded when every input channel either has a buffered row, or is terminated, so channels can finish
+    at different times. Rows with equal keys are yielded in input channel order. Empty rows (like the one the harness
+    sends into unplugged inputs) are ignored.
+
+    Buffering is unbounded: while a channel has no buffered row and is not terminated, nothing can be yielded, and
+    rows of the other channels accumulate in memory. If a channel is much slower than the others (or only starts
+    sending once its own upstream is complete), up to the whole content of the other channels can end up buffered.
+    Rows of all channels arrive through the same input queue, so there is no way to pause a single channel; feed this
+    transform from channels producing at comparable rates. Buffered rows count is available in statistics.
+
+    :attr:`key`
+        A tuple of keys on which input channels are sorted.
+
+    :attr:`inputs`
+        Number of input channels, numbered from 0 to inputs-1 (0, 1 and 2 being STDIN, STDIN2 and STDIN3).
+
+    Example::
+
+        >>> from rdc.etl.job import Job
+        >>> from rdc.etl.transform import Transform
+        >>> from rdc.etl.transform.flow.sortedmerge import SortedMerge
+
+        >>> merge = SortedMerge(('id', ), inputs=2)
+        >>> job = Job().add_chain(Transform(), output=(merge, 0)).add_chain(Transform(), output=(merge, 1))
+
+    """
+
+    key = ()
+    inputs = 2
+
+    def __init__(self, key=None, inputs=None):
+        self.key = key or self.key
+        self.inputs = inputs or self.inputs
+
+        super(SortedMerge, self).__init__(input_channels=tuple(range(self.inputs)))
+
+        self._buffered = self._peak_buffered = 0
+
+    def initialize(self):
+        super(SortedMerge, self).initialize()
+
+        self._buffers = dict((channel, deque()) for channel in self.INPUT_CHANNELS)
+        self._last_keys = {}
+        self._heap = []
+        self._buffered = self._peak_buffered = 0
+
+    def transform(self, hash, channel=STDIN):
+        if not len(hash):
+            return
+
+        key = hash.get_values(self.key)
+        if channel in self._last_keys and key < self._last_keys[channel]:
+            raise ValueError('Input channel %r is not sorted: %r after %r.' % (channel, key, self._last_keys[channel]))
+        self._last_keys[channel] = key
+
+        buffer = self._buffers[channel]
+        if not len(buffer):
+            heapq.heappush(self._heap, (key, channel, ))
+        buffer.append(hash)
+        self._buffered += 1
+        self._peak_buffered = max(self._peak_buffered, self._buffered)
+
+        for row in self.consume():
+            yield row
+
+    def consume(self, finalize=False):
+        while len(self._heap):
+            # We can only be sure of the minimum if no channel may still send something lower.
+            if not finalize:
+                for channel, buffer in self._buffers.iteritems():
+                    if not len(buffer) and not self._input[channel].terminated:
+                        return
+
+            key, channel = heapq.heappop(self._heap)
+            buffer = self._buffers[channel]
+            self._buffered -= 1
+            yield buffer.popleft()
+
+            if len(buffer):
+                heapq.heappush(self._heap, (buffer[0].get_values(self.key), channel, ))
+
+    def finalize(self):
+        super(SortedMerge, self).finalize()
+
+        for row in self.consume(finalize=True):
+            yield row
+
+    def get_local_stats(self, debug=False, profile=False):
+        return (
+            ('buffered', self._buffered, ),
+            ('peak_buffered', self._peak_buffered, ),
+        ) + tuple(super(SortedMerge, self).get_local_stats(debug=debug, profile=profile))
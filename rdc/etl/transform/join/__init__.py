@@ -14,11 +14,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from repoze.lru import LRUCache, ExpiringLRUCache
 from rdc.etl.error import AbstractError
 from rdc.etl.hash import Hash
 from rdc.etl.io import STDIN
 from rdc.etl.transform import Transform
 
+_marker = object()
+
 
 class Join(Transform):
     """
@@ -28,6 +31,26 @@ class Join(Transform):
 
     .. automethod:: join
 
+    .. attribute:: cache_key
+
+        Opt-in cache of join results. If set to a tuple of input fields, rows with the same values for those fields
+        will share the same join data, and :meth:`join` will only be called once for them (as long as the result stays
+        in the cache). Only use this if the join result depends on those fields only.
+
+    .. attribute:: cache_size
+
+        Maximum number of cached join results. Least recently used results are evicted first.
+
+    .. attribute:: cache_ttl
+
+        Optional number of seconds after which a cached join result expires.
+
+    .. attribute:: cache_negative
+
+        Whether or not to cache empty join results (default True).
+
+    Cache hits, misses and evictions are available in the transform statistics.
+
     Example::
 
         >>> from rdc.etl.transform.join import Join
@@ -51,12 +74,30 @@ class Join(Transform):
     """
     default_outer_join_data = Hash()
 
-    def __init__(self, join = None, is_outer=False, default_outer_join_data=None):
+    cache_key = None
+    cache_size = 10000
+    cache_ttl = None
+    cache_negative = True
+
+    def __init__(self, join = None, is_outer=False, default_outer_join_data=None, cache_key=None, cache_size=None,
+                 cache_ttl=None, cache_negative=None):
         super(Join, self).__init__()
         self.is_outer = is_outer or self.is_outer
         self.default_outer_join_data = default_outer_join_data or self.default_outer_join_data
         self.join = join or self.join
 
+        self.cache_key = cache_key or self.cache_key
+        self.cache_size = cache_size or self.cache_size
+        self.cache_ttl = cache_ttl or self.cache_ttl
+        self.cache_negative = cache_negative if cache_negative is not None else self.cache_negative
+
+        self._cache = None
+        if self.cache_key:
+            if self.cache_ttl:
+                self._cache = ExpiringLRUCache(self.cache_size, default_timeout=self.cache_ttl)
+            else:
+                self._cache = LRUCache(self.cache_size)
+
     def join(self, hash, channel=STDIN):
         """
         Abtract method that must be implemented in concrete subclasses, to return the data that should be joined with
@@ -79,9 +120,21 @@ class Join(Transform):
         """
         raise AbstractError(self.join)
 
-    def transform(self, hash, channel=STDIN):
-        join_data = self.join(hash, channel)
-
+    def get_join_data(self, hash, channel=STDIN):
+        """Calls :meth:`join`, or get its result from cache if enabled."""
+        if self._cache is None:
+            return self.join(hash, channel)
+
+        key = (channel, tuple(hash.get(field) for field in self.cache_key), )
+        join_data = self._cache.get(key, _marker)
+        if join_data is _marker:
+            join_data = list(self.join(hash, channel) or ())
+            if len(join_data) or self.cache_negative:
+                self._cache.put(key, join_data)
+        return join_data
+
+    def product(self, hash, join_data):
+        """Cartesian product between a row and its join data, taking the join type into account."""
         cnt = 0
         if join_data:
             for data in join_data:
@@ -91,3 +144,17 @@ class Join(Transform):
         if not cnt and self.is_outer:
             yield hash.copy(self.default_outer_join_data)
 
+    def transform(self, hash, channel=STDIN):
+        for row in self.product(hash, self.get_join_data(hash, channel)):
+            yield row
+
+    def get_local_stats(self, debug=False, profile=False):
+        stats = tuple(super(Join, self).get_local_stats(debug=debug, profile=profile))
+        if self._cache is None:
+            return stats
+        return (
+            ('hits', self._cache.hits, ),
+            ('misses', self._cache.misses, ),
+            ('evictions', self._cache.evictions, ),
+        ) + stats
+
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012-2014 Romain Dorgueil
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+from Queue import Queue, Empty
+from rdc.etl.hash import Hash
+from rdc.etl.io import STDIN, STDERR
+from rdc.etl.sketch import QuantileSketch
+from rdc.etl.transform.join import Join
+
+
+class ConcurrentJoin(Join):
+    """
+    Join variant that runs :meth:`join` calls on a pool of threads, for joins that spend most of their time waiting
+    for slow external resources (HTTP APIs, remote databases, ...). The join callable must be thread safe (for
+    example, do not share one database connection between calls).
+
+    .. attribute:: max_in_flight
+
+        Number of worker threads, and maximum number of concurrent join calls. When this limit is reached, the
+        transform waits for a call to complete before accepting the next input row. Completed calls are released on
+        the next input row, or when no input came for a while.
+
+    .. attribute:: ordered
+
+        If true (default), output rows are released in input order, through a reorder buffer. As the buffer is bounded
+        by max_in_flight too, a slow call delays the following ones. If false, rows are released as soon as their join
+        call completes.
+
+    Number of calls in flight and latency percentiles (p50, p90, p99) are available in the transform statistics.
+
+    If :meth:`join` raises, the input row is sent to STDERR (with the exception) when it would have been released,
+    and the other rows are not affected.
+
+    """
+
+    max_in_flight = 8
+    ordered = True
+
+    def __init__(self, join=None, is_outer=False, default_outer_join_data=None, max_in_flight=None, ordered=None,
+                 cache_key=None, cache_size=None, cache_ttl=None, cache_negative=None):
+        super(ConcurrentJoin, self).__init__(join=join, is_outer=is_outer,
+                                             default_outer_join_data=default_outer_join_data, cache_key=cache_key,
+                                             cache_size=cache_size, cache_ttl=cache_ttl,
+                                             cache_negative=cache_negative)
+
+        self.max_in_flight = max_in_flight or self.max_in_flight
+        self.ordered = ordered if ordered is not None else self.ordered
+
+        self._workers = []
+        self._in_flight = 0
+        self._latencies = QuantileSketch()
+        # Statistics are read from another thread.
+        self._latencies_lock = threading.Lock()
+
+    def initialize(self):
+        super(ConcurrentJoin, self).initialize()
+
+        self._requests = Queue()
+        self._results = Queue()
+        self._reorder_buffer = {}
+        self._submitted = 0
+        self._released = 0
+        self._in_flight = 0
+
+        self._workers = [threading.Thread(target=self._work) for i in xrange(self.max_in_flight)]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+
+    def transform(self, hash, channel=STDIN):
+        self._requests.put((self._submitted, hash, channel, ))
+        self._submitted += 1
+        self._in_flight += 1
+
+        for row in self.collect(self.max_in_flight - 1):
+            yield row
+
+    def idle(self):
+        if self._in_flight:
+            # Never waits (at most max_in_flight rows are pending), only releases calls completed since the last row.
+            return self.collect(self.max_in_flight)
+
+    def finalize(self):
+        super(ConcurrentJoin, self).finalize()
+
+        try:
+            for row in self.collect(0):
+                yield row
+        finally:
+            for worker in self._workers:
+                self._requests.put(None)
+            for worker in self._workers:
+                worker.join()
+            self._workers = []
+
+    def collect(self, limit):
+        """Gathers completed join calls, waiting while more than `limit` rows are not released yet, and yields the
+        rows that can be released."""
+        while True:
+            pending = (self._submitted - self._released) if self.ordered else self._in_flight
+            try:
+                seq, hash, join_data, error, duration = self._results.get(pending > limit)
+            except Empty:
+                return
+
+            self._in_flight -= 1
+            with self._latencies_lock:
+                self._latencies.add(duration)
+
+            if not self.ordered:
+                self._released += 1
+                for row in self._release(hash, join_data, error):
+                    yield row
+                continue
+
+            self._reorder_buffer[seq] = hash, join_data, error
+            while self._released in self._reorder_buffer:
+                hash, join_data, error = self._reorder_buffer.pop(self._released)
+                self._released += 1
+                for row in self._release(hash, join_data, error):
+                    yield row
+
+    def get_local_stats(self, debug=False, profile=False):
+        with self._latencies_lock:
+            latencies = self._latencies.quantiles((0.5, 0.9, 0.99, ))
+        return (
+            ('in_flight', self._in_flight, ),
+            ('p50', latencies[0] is not None and '%.1fms' % (1000 * latencies[0], ) or 0, ),
+            ('p90', latencies[1] is not None and '%.1fms' % (1000 * latencies[1], ) or 0, ),
+            ('p99', latencies[2] is not None and '%.1fms' % (1000 * latencies[2], ) or 0, ),
+        ) + tuple(super(ConcurrentJoin, self).get_local_stats(debug=debug, profile=profile))
+
+    def _release(self, hash, join_data, error):
+        if error is not None:
+            return [(Hash((
+                ('_input', hash, ),
+                ('_transform', self, ),
+                ('_error', error, ),
+            )), STDERR, )]
+        return self.product(hash, join_data)
+
+    def _work(self):
+        while True:
+            request = self._requests.get()
+            if request is None:
+                return
+
+            seq, hash, channel = request
+            started_at = time.time()
+            try:
+                join_data, error = list(self.get_join_data(hash, channel) or ()), None
+            except Exception as e:
+                join_data, error = None, e
+            self._results.put((seq, hash, join_data, error, time.time() - started_at, ))
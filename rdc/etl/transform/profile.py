@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012-2014 Romain Dorgueil
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numbers
+from collections import OrderedDict
+from rdc.etl.hash import Hash
+from rdc.etl.io import STDIN
+from rdc.etl.sketch import HyperLogLog, QuantileSketch
+from rdc.etl.transform import Transform
+from rdc.etl.util import fingerprint
+
+PROFILE_FIELD = '_profile'
+
+
+class FieldProfile(object):
+    """Constant memory, mergeable statistics about the values of one field."""
+
+    def __init__(self, precision=14, k=200):
+        self.rows = 0
+        self.nulls = 0
+        self.min = None
+        self.max = None
+        self.distinct = HyperLogLog(precision)
+        self.quantiles = QuantileSketch(k)
+
+    def add(self, value):
+        self.rows += 1
+
+        if value is None:
+            self.nulls += 1
+            return
+
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+        self.distinct.add(fingerprint((value, )))
+
+        # Quantiles only make sense on numbers.
+        if isinstance(value, numbers.Number) and not isinstance(value, bool):
+            self.quantiles.add(value)
+
+    def merge(self, other):
+        self.rows += other.rows
+        self.nulls += other.nulls
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+        self.distinct.merge(other.distinct)
+        self.quantiles.merge(other.quantiles)
+        return self
+
+
+class Profile(Transform):
+    """
+    Computes statistics about the values of each field, in constant memory: row and null counts, null ratio, min and
+    max values, approximate number of distinct values (HyperLogLog) and approximate quantiles for numeric values (KLL
+    sketch). Input rows are consumed, and one summary row per field is yielded in :meth:`finalize`.
+
+    Summary rows contain the field's :class:`FieldProfile` under the "_profile" key. If a Profile transform receives
+    such rows, they are merged into its own statistics instead of being profiled, so the summaries of parallel
+    replicas can be sent to a last Profile transform to get the statistics of the whole stream.
+
+    :attr:`fields`
+        Fields to profile. By default, every field seen is profiled (a field missing from a row counts as null).
+
+    :attr:`quantiles`
+        Ranks of the quantiles to compute, each one will be in a "p<100*rank>" summary field (p50, p90, p99, ...).
+
+    :attr:`precision`
+        HyperLogLog precision. 2**precision bytes are used by field, standard error is 1.04/sqrt(2**precision).
+
+    :attr:`k`
+        Quantile sketch size. About 3*k values are kept by field, rank error is about 1.7/k.
+
+    Example::
+
+        >>> from rdc.etl.transform.profile import Profile
+
+        >>> t = Profile(('age', ), quantiles=(0.5, ))
+        >>> t.initialize()
+        >>> _ = list(t({'age': 20}, {'age': None}, {'age': 40}, {'age': 30}))
+        >>> list(map(lambda h: h.remove('_profile'), t.finalize()))
+        [H{'field': 'age', 'rows': 4, 'nulls': 1, 'null_ratio': 0.25, 'distinct': 3, 'min': 20, 'max': 40, 'p50': 30}]
+
+    """
+
+    fields = None
+    quantiles = (0.5, 0.9, 0.99, )
+    precision = 14
+    k = 200
+
+    def __init__(self, fields=None, quantiles=None, precision=None, k=None):
+        super(Profile, self).__init__()
+
+        self.fields = fields or self.fields
+        self.quantiles = quantiles or self.quantiles
+        self.precision = precision or self.precision
+        self.k = k or self.k
+
+        self._profiles = OrderedDict()
+        self._rows = 0
+
+    def initialize(self):
+        super(Profile, self).initialize()
+
+        self._profiles = OrderedDict()
+        self._rows = 0
+        for field in self.fields or ():
+            self._profiles[field] = FieldProfile(self.precision, self.k)
+
+    def transform(self, hash, channel=STDIN):
+        if PROFILE_FIELD in hash:
+            profile = self.get_profile(hash['field']).merge(hash[PROFILE_FIELD])
+            # Each summary of a replica has the replica row count, which must only be counted once (a field seen
+            # later is null in the merged rows too).
+            self._rows = max(self._rows, profile.rows)
+            return
+
+        if not self.fields:
+            for field in hash:
+                if not field in self._profiles:
+                    # Field never seen before, it was null in all previous rows.
+                    profile = self._profiles[field] = FieldProfile(self.precision, self.k)
+                    profile.rows = profile.nulls = self._rows
+
+        for field, profile in self._profiles.iteritems():
+            profile.add(hash.get(field))
+        self._rows += 1
+
+    def finalize(self):
+        super(Profile, self).finalize()
+
+        for field, profile in self._profiles.iteritems():
+            yield self.summarize(field, profile)
+
+    def get_profile(self, field):
+        if not field in self._profiles:
+            self._profiles[field] = FieldProfile(self.precision, self.k)
+        return self._profiles[field]
+
+    def summarize(self, field, profile):
+        summary = Hash((
+            ('field', field, ),
+            ('rows', profile.rows, ),
+            ('nulls', profile.nulls, ),
+            ('null_ratio', profile.nulls / float(profile.rows) if profile.rows else None, ),
+            ('distinct', profile.distinct.cardinality(), ),
+            ('min', profile.min, ),
+            ('max', profile.max, ),
+        ))
+        for q, value in zip(self.quantiles, profile.quantiles.quantiles(self.quantiles)):
+            summary['p%g' % (100 * q, )] = value
+        summary[PROFILE_FIELD] = profile
+        return summary
+
+    def get_local_stats(self, debug=False, profile=False):
+        return (
+            ('fields', len(self._profiles), ),
+        ) + tuple(super(Profile, self).get_local_stats(debug=debug, profile=profile))
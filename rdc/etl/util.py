@@ -15,7 +15,9 @@
 # limitations under the License.
 
 import cgi
+import hashlib
 import HTMLParser
+import struct
 import time
 import re
 import requests
@@ -282,6 +284,30 @@ def sbool(mixed, default=None):
     except:
         return default
 
+def fingerprint(values):
+    """Stable 64 bits (signed) integer hash of a sequence of values.
+
+    Unlike hash(), the result does not depend on the platform or on the process, so it can be used to route rows or
+    to compare values computed elsewhere. Strings (str or unicode) and integers (int or long) are normalized, other
+    types are hashed through their repr().
+
+    >>> fingerprint(('foo', 42)) == fingerprint((u'foo', 42L))
+    True
+
+    """
+    digest = hashlib.md5()
+    for value in values:
+        if isinstance(value, unicode):
+            value = 's' + value.encode('utf-8')
+        elif isinstance(value, str):
+            value = 's' + value
+        elif isinstance(value, (int, long)) and not isinstance(value, bool):
+            value = 'i' + str(value)
+        else:
+            value = 'r' + repr(value)
+        digest.update(str(len(value)) + ':' + value)
+    return struct.unpack('<q', digest.digest()[:8])[0]
+
 # Exports
 try:
     terminal = _Terminal()